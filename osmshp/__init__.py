@@ -1,17 +1,16 @@
 import os
 import os.path
 import shlex
-import shutil
 import subprocess
 import re
 import tempfile
 from datetime import datetime
+import json
 import logging
 import logging.config
+import threading
 import yaml
-from xml.etree.ElementTree import ElementTree
 from importlib import import_module
-from multiprocessing.pool import ThreadPool
 
 from sqlalchemy import create_engine
 from sqlalchemy.sql.expression import text
@@ -19,13 +18,18 @@ from sqlalchemy.sql.expression import text
 import psycopg2
 import psycopg2.extensions
 
+from . import chunk
+from . import datasource
+from . import trace
+from .executor import Executor
+from . import export as exportmod
 from .layer import Layer
-from .sql import SqlStatement
-from .models import Base, DBSession, DumpVersion, RegionGroup, Region, LayerVersion
-from .util import YAMLLoader
+from .sql import SqlStatement, dedent
+from .models import Base, DBSession, DumpVersion, RegionGroup, Region, LayerVersion, LayerStatState, MembershipLayer
+from .util import YAMLLoader, connection_params
 
 
-def _sql_template(name, data=None, log=None):
+def _sql_template(name, data=None, log=None, **kwargs):
     if data is None:
         data = dict()
     if log is None:
@@ -37,7 +41,9 @@ def _sql_template(name, data=None, log=None):
 
     sql = template.format(**data)
 
-    return SqlStatement(sql=sql, log=log)
+    kwargs['trace'] = dict(kwargs.get('trace') or {}, template=name)
+
+    return SqlStatement(sql=sql, log=log, **kwargs)
 
 
 class Env(object):
@@ -65,8 +71,7 @@ class Env(object):
             self.config['export'] = dict()
 
         export = self.config['export']
-        export['pgsql2shp'] = export.get('pgsql2shp', 'pgsql2shp')
-        export['shptree'] = export.get('shptree', 'shptree')
+        export['qix'] = bool(export.get('qix', True))
         export['7z'] = export.get('7z', '7z')
 
         if not 'options' in self.config:
@@ -75,6 +80,41 @@ class Env(object):
         options = self.config['options']
         options['worker_count'] = int(options.get('worker_count', 4))
         options['chunk_size'] = int(options.get('chunk_size', 10000))
+        options['chunk_mode'] = options.get('chunk_mode', 'tile')
+        options['chunk_estimate'] = options.get('chunk_estimate', 'explain')
+        options['multi_region'] = bool(options.get('multi_region', False))
+        options['incremental_layers'] = bool(options.get('incremental_layers', True))
+        options['batch_diffs'] = int(options.get('batch_diffs', 30))
+        options['batch_bytes'] = int(options.get('batch_bytes', 512 * 1024 * 1024))
+        options['bulk_load'] = bool(options.get('bulk_load', True))
+        options['compact_keep'] = int(options.get('compact_keep', 1))
+        options['compact_batch'] = int(options.get('compact_batch', 50000))
+
+        export['workers'] = int(export.get('workers', options['worker_count']))
+        export['connections'] = int(export.get('connections', export['workers']))
+
+        if options['chunk_mode'] not in chunk.CHUNK_MODES:
+            raise ValueError("Unknown chunk mode '%s'" % options['chunk_mode'])
+
+        if not 'pool' in self.config:
+            self.config['pool'] = dict()
+
+        # Connections for executor workers, main thread and web requests
+        pool = self.config['pool']
+        pool['web'] = int(pool.get('web', 2))
+        pool['size'] = int(pool.get('size', options['worker_count'] + 1 + pool['web']))
+        pool['overflow'] = int(pool.get('overflow', 0))
+        pool['timeout'] = float(pool.get('timeout', 300))
+
+        # Session settings by statement class (intersection, layer, stat,
+        # export, ...), default ones are applied to every statement
+        if not 'sessions' in self.config:
+            self.config['sessions'] = dict()
+
+        for sclass, settings in self.config['sessions'].iteritems():
+            for name in settings:
+                if not re.match(r'^[a-z_][a-z0-9_\.]*$', name):
+                    raise ValueError("Invalid setting '%s' for %s statements" % (name, sclass))
 
         if not 'logging' in self.config:
             self.config['logging'] = dict(
@@ -102,6 +142,12 @@ class Env(object):
         if configure_logging:
             logging.config.dictConfig(self.config['logging'])
 
+        self.trace = None
+        if 'trace' in self.config:
+            self.trace = trace.Trace(
+                self.config['trace']['path'],
+                explain=float(self.config['trace'].get('explain', 0.0)))
+
         self.layers = {}
         for lname, ldef in self.config['layers'].iteritems():
             self.layers[lname] = Layer(lname, ldef, self.config['fieldmap'])
@@ -110,15 +156,32 @@ class Env(object):
         self.dsoptions = self.config['datasource']
         self.dsmod = import_module(self.dsoptions['driver'])
 
+        driver = self.dsmod
+        if 'cache' in self.dsoptions:
+            cache = self.dsoptions['cache']
+            driver = datasource.Cache(
+                driver, cache['path'],
+                budget=int(cache.get('size', 10 * 1024 ** 3)))
+
+        self.datasource = datasource.Prefetcher(
+            driver, self.dsoptions,
+            prefetch=bool(self.dsoptions.get('prefetch', True)))
+
         # SQLAclhemy engine initialization
         self.engine = create_engine(
             'postgresql://%(user)s%(password)s@%(host)s/%(name)s' % dict(
                 self.config['database'],
                 password=(':' + self.config['database']['password'])
                 if 'password' in self.config['database'] else ''
-            )
+            ),
+            pool_size=pool['size'],
+            max_overflow=pool['overflow'],
+            pool_timeout=pool['timeout']
         )
 
+        self._pool_lock = threading.Lock()
+        self._pool_wait = dict(count=0, total=0.0, max=0.0)
+
         DBSession.configure(bind=self.engine)
         Base.metadata.bind = self.engine
 
@@ -140,18 +203,38 @@ class Env(object):
         RegionGroup(id=0).add()
         self.commit()
 
+    def upgrade(self):
+        """ Bring database initialized and loaded by an earlier version up
+        to date without reloading the dump, can be run more than once """
+
+        self.logger.info("Upgrading database")
+        Base.metadata.create_all()
+        self.execute_sql(_sql_template('initialize'))
+        self.execute_sql(_sql_template('upgrade'))
+
     def cleanup(self):
         self.logger.info("Cleaning database")
         self.execute_sql(_sql_template('cleanup'))
         Base.metadata.drop_all()
 
     def load(self, version=None):
-        dump, dump_version = self.dsmod.dump(version=version, options=self.dsoptions)
+        dump, dump_version = self.datasource.dump(version=version)
         self.logger.info('Loading dump from %s (%s)', dump.name, dump_version)
 
         for v in DumpVersion.query():
             v.delete()
 
+        # Layers and statistics built from previous dump can't be updated
+        # incrementally
+        for v in LayerVersion.query():
+            v.delete()
+
+        for v in LayerStatState.query():
+            v.delete()
+
+        for v in MembershipLayer.query():
+            v.delete()
+
         self.commit()
 
         osm2pgsql = self._osm2pgsql() + ['--slim', '--create', dump.name]
@@ -168,7 +251,7 @@ class Env(object):
         DumpVersion(ts=dump_version, ready=False).add()
         self.commit()
 
-        self.post_update()
+        self.post_update(full=True, initial=True)
 
         self.logger.info('Dump loaded')
 
@@ -177,14 +260,8 @@ class Env(object):
 
         return dump_version
 
-    def update(self):
+    def _append(self, diff, diff_version):
         version = DumpVersion.query().one()
-        data = self.dsmod.diff(version.ts, self.dsoptions)
-
-        if data is None:
-            return None
-
-        diff, diff_version = data
 
         osm2pgsql = self._osm2pgsql() + ['--slim', '--append', diff.name]
 
@@ -203,6 +280,17 @@ class Env(object):
 
         self.logger.info('Database updated.')
 
+    def update(self):
+        version = DumpVersion.query().one()
+        data = self.datasource.diff(version.ts)
+
+        if data is None:
+            return None
+
+        diff, diff_version = data
+
+        self._append(diff, diff_version)
+
         self.post_update()
 
         # Prevent temporary file deletion
@@ -210,152 +298,601 @@ class Env(object):
 
         return version.ts
 
+    def get_batch_size(self, ts):
+        """ Number of daily diffs to append before post-processing, the
+        whole lag up to options.batch_diffs """
+
+        lag = (datetime.now() - ts).days
+        return max(1, min(lag, self.config['options']['batch_diffs']))
+
     def forward(self, to_version=None, update_stat=True):
-        while True:
-            version = DumpVersion.query().one()
-            if to_version is not None and version.ts >= to_version:
-                return version.ts
+        """ Catch up with datasource. Diffs are appended in batches, change
+        buffers accumulate between appends, so post_update() and
+        update_stat() run once per batch. Batch is also closed when total
+        size of appended diffs exceeds options.batch_bytes. """
+
+        try:
+            while True:
+                version = DumpVersion.query().one()
+                if to_version is not None and version.ts >= to_version:
+                    return version.ts
+
+                batch = self.get_batch_size(version.ts)
+
+                applied = 0
+                size = 0
+                exhausted = False
+                while applied < batch and size < self.config['options']['batch_bytes']:
+                    if to_version is not None and version.ts >= to_version:
+                        break
+
+                    data = self.datasource.diff(version.ts)
+                    if data is None:
+                        exhausted = True
+                        break
 
-            if self.update() is None:
-                return version.ts
+                    diff, diff_version = data
+                    size += os.path.getsize(diff.name)
 
-            if update_stat:
-                self.update_stat()
+                    self._append(diff, diff_version)
+                    applied += 1
+
+                    version = DumpVersion.query().one()
+
+                    # Prevent temporary file deletion
+                    diff.close()
+
+                # Appended but not post-processed changes are left from
+                # interrupted run if version isn't ready
+                if applied == 0 and version.ready:
+                    return version.ts
+
+                self.logger.info('Post-processing %d diffs (%d bytes) up to %s...', applied, size, version.ts)
+
+                self.post_update()
+
+                if update_stat:
+                    self.update_stat()
+
+                self.compact()
+
+                if exhausted:
+                    return version.ts
+        finally:
+            # Prefetched diff of the version after the last one
+            self.datasource.close()
 
     def commit(self):
         DBSession.commit()
 
+    def trace_version(self, ts):
+        if self.trace is not None:
+            self.trace.version = ts
+
     def get_tag_columns(self):
+        """ Tag columns of osm_point, osm_line and osm_polygon by object
+        type, osm2pgsql style can promote different keys for each """
+
         if not hasattr(self, 'tag_columns'):
             curr = self.connection.cursor()
-            curr.execute("""SELECT column_name FROM information_schema.columns
-                         WHERE table_name = 'osm_point' AND NOT column_name IN ('way', 'osm_id', 'ver', 'flag')
+            curr.execute("""SELECT table_name, column_name FROM information_schema.columns
+                         WHERE table_name IN ('osm_point', 'osm_line', 'osm_polygon')
+                           AND NOT column_name IN ('way', 'osm_id', 'ver', 'flag')
                          ORDER BY ordinal_position;""")
-            self.tag_columns = [c for (c, ) in curr]
+            self.tag_columns = dict(point=[], line=[], polygon=[])
+            for table, column in curr:
+                self.tag_columns[table[len('osm_'):]].append(column)
 
         return self.tag_columns
 
-    def expand_tag_columns(self, sql):
+    def expand_tag_columns(self, sql, objtype='point'):
         self.get_tag_columns()
 
         def repl(m):
-            if m.group(1) in self.tag_columns:
+            if m.group(1) in self.tag_columns[objtype]:
                 return '"%s"' % m.group(1)
             else:
                 return "(tags->'%s')" % m.group(1)
         return re.sub('\<([\w\:\_]+)\>', repl, sql)
 
-    def get_connection(self):
-        params = dict()
-        for k, v in self.config['database'].iteritems():
-            if k == 'name':
-                k = 'database'
-            params[k] = v
+    def tag_expander(self, objtype):
+        return lambda sql: self.expand_tag_columns(sql, objtype)
+
+    def get_region_extents(self):
+        curr = self.connection.cursor()
+        curr.execute("""SELECT id, ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+                     FROM region""")
+        return dict((row[0], row[1:]) for row in curr)
+
+    def get_region_hashes(self):
+        curr = self.connection.cursor()
+        curr.execute("""SELECT id, md5(ST_AsEWKB(geom) || ST_AsEWKB(geom_in) || ST_AsEWKB(geom_out))
+                     FROM region""")
+        return dict(curr.fetchall())
+
+    def get_total_extent(self):
+        curr = self.connection.cursor()
+        curr.execute("""SELECT ST_XMin(ext), ST_YMin(ext), ST_XMax(ext), ST_YMax(ext)
+                     FROM (SELECT ST_Extent(geom) AS ext FROM region) sub""")
+        return curr.fetchone()
+
+    def get_id_range(self, objtype):
+        curr = self.connection.cursor()
+        curr.execute("SELECT MIN(osm_id), MAX(osm_id) FROM osm_%s" % objtype)
+        return curr.fetchone()
+
+    def chunk_filters(self, objtype, chunk_count, extent=None, id_range=None):
+        mode = self.config['options']['chunk_mode']
+
+        if mode == 'tile':
+            return chunk.tile_chunks(chunk_count, extent)
+        elif mode == 'range':
+            if id_range is None:
+                id_range = self.get_id_range(objtype)
+            return chunk.range_chunks(chunk_count, *id_range)
+        else:
+            return chunk.modulo_chunks(chunk_count)
+
+    def estimate_rows(self, sql):
+        curr = self.connection.cursor()
+
+        if self.config['options']['chunk_estimate'] == 'count':
+            curr.execute("SELECT COUNT(*) FROM (%s) sub" % sql)
+            return curr.fetchone()[0]
+
+        curr.execute("EXPLAIN (FORMAT JSON) %s" % sql)
+        (plan, ) = curr.fetchone()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def get_missing_capture(self):
+        """ Object types which changes aren't captured into buffer tables,
+        osm_* tables of database created by an earlier version don't have
+        triggers until upgrade """
+
+        curr = self.connection.cursor()
+        curr.execute("""SELECT t FROM unnest(ARRAY['point', 'line', 'polygon']) t
+                     WHERE NOT EXISTS(
+                       SELECT * FROM pg_trigger
+                       WHERE tgrelid = to_regclass('osm_' || t)
+                         AND tgname = 'osm_' || t || '_buffer')""")
+        return [t for (t, ) in curr]
+
+    def relation_exists(self, name):
+        curr = self.connection.cursor()
+        curr.execute("SELECT to_regclass('%s') IS NOT NULL" % name)
+        (result, ) = curr.fetchone()
+        return result
+
+    def get_missing_keys(self):
+        """ Tables keyed by the initial full pass which don't have primary
+        key, the pass didn't complete if any """
+
+        curr = self.connection.cursor()
+        curr.execute("""SELECT t FROM unnest(ARRAY['intersection_point',
+                       'intersection_line', 'intersection_polygon',
+                       'obj_membership']) t
+                     WHERE to_regclass(t) IS NOT NULL AND NOT EXISTS(
+                       SELECT * FROM pg_constraint
+                       WHERE conrelid = to_regclass(t) AND contype = 'p')""")
+        return [t for (t, ) in curr]
+
+    def get_pending_regions(self):
+        curr = self.connection.cursor()
+        curr.execute("SELECT DISTINCT region_id FROM buffer_region")
+        return set([r for (r, ) in curr])
+
+    def plan_intersections(self, context, rebuilt=None):
+        options = self.config['options']
+
+        # Regions listed in buffer_region (new regions, regions with changed
+        # geom_in or geom_out, everything after load) need a full pass. The
+        # others are processed only for objects from the change set and
+        # objects near changed boundaries, which membership rebuild extends
+        # with existing objects of new and changed layers (filters by object
+        # type in rebuilt).
+
+        if rebuilt is None:
+            rebuilt = dict()
+
+        pending = self.get_pending_regions()
+
+        # In multi-region mode every chunk is joined against all regions at
+        # once, so each source row is read once per update instead of once
+        # per region containing it.
+
+        scopes = []
+        if options['multi_region']:
+            extent = self.get_total_extent()
+            if pending:
+                scopes.append(('* pending', 'rgn.id IN (SELECT region_id FROM buffer_region)', extent, False))
+            scopes.append(('*', 'rgn.id NOT IN (SELECT region_id FROM buffer_region)', extent, True))
+        else:
+            extents = self.get_region_extents()
+            for region in Region.query():
+                scopes.append((
+                    region.code, 'rgn.id = %d' % region.id,
+                    extents.get(region.id), region.id not in pending))
+
+        id_ranges = dict()
+        if options['chunk_mode'] == 'range':
+            for objtype in ('polygon', 'point', 'line'):
+                id_ranges[objtype] = self.get_id_range(objtype)
+
+        plan = []
+        for scope, region_filter, extent, changes in scopes:
+            for objtype in ('polygon', 'point', 'line'):
+                change_filter = context['intersect_' + objtype] if changes else 'true'
+
+                estimate = self.estimate_rows(chunk.candidate_sql(
+                    objtype, extent, context['filter_' + objtype], change_filter))
+
+                if changes and objtype in rebuilt:
+                    estimate += self.estimate_rows(chunk.candidate_sql(
+                        objtype, extent, rebuilt[objtype]))
+
+                filters = list(self.chunk_filters(
+                    objtype, chunk.chunk_count(estimate, options['chunk_size']),
+                    extent=extent,
+                    id_range=id_ranges.get(objtype)
+                ))
+
+                self.logger.debug(
+                    "Chunk plan table=%s; region=%s; changes=%s: estimated=%d; chunks=%d",
+                    objtype, scope, changes, estimate, len(filters))
+
+                plan.append(chunk.ChunkPlan(
+                    objtype, scope, region_filter, change_filter, estimate, filters))
 
-        conn = psycopg2.connect(**params)
+        return plan
+
+    def get_connection(self):
+        conn = psycopg2.connect(**connection_params(self.config['database']))
         conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         return conn
 
     def post_load(self):
         self.logger.info('Starting post-load operations.')
 
-        self.execute_queries([
-            _sql_template('load-point'),
-            _sql_template('load-line'),
-            _sql_template('load-polygon')
-        ])
+        # obj_version and intersection tables are created without keys
+        # and indexes (unlogged with options.bulk_load), obj_version is
+        # filled per object type in parallel and indexed afterwards.
+        # Intersection tables get their keys after the initial full pass
+        # of post_update(initial=True).
+
+        context = self.bulk_context()
+        loads = ('load-point', 'load-line', 'load-polygon')
+        fills = ('version-fill-point', 'version-fill-line', 'version-fill-polygon')
 
         self.execute_queries([
-            _sql_template('load-version'),
-            _sql_template('load-intersection')
+            _sql_template(name, key=name, trace=dict(phase='load'))
+            for name in loads
+        ] + [
+            _sql_template('load-version', context, key='load-version',
+                          trace=dict(phase='load')),
+        ] + [
+            _sql_template('load-version-fill', dict(objtype=objtype),
+                          log='SQL load-version-fill %s' % objtype,
+                          key='version-fill-%s' % objtype,
+                          deps=('load-version', 'load-%s' % objtype),
+                          trace=dict(phase='load'))
+            for objtype in ('point', 'line', 'polygon')
+        ] + [
+            _sql_template('load-version-index', dict(
+                context, set_logged=self.set_logged('obj_version')),
+                deps=fills, trace=dict(phase='load')),
+            _sql_template('load-intersection', context, deps=loads,
+                          trace=dict(phase='load')),
+            _sql_template('load-membership', context, trace=dict(phase='load'))
         ])
 
         self.logger.info('Post-load operations completed.')
 
-    def post_update(self):
+    def bulk_context(self):
+        bulk = self.config['options']['bulk_load']
+        return dict(unlogged='UNLOGGED' if bulk else '')
+
+    def set_logged(self, table):
+        if self.config['options']['bulk_load']:
+            return 'ALTER TABLE %s SET LOGGED;' % table
+        return ''
+
+    def set_logged_partitions(self, table):
+        if self.config['options']['bulk_load']:
+            return "SELECT intersection_set_logged('%s');" % table
+        return ''
+
+    def sync_membership(self):
+        """ Assign membership_layer numbers to configured layers, a layer
+        with changed filter or classification gets a new number. Returns
+        numbers by layer id and ids of layers which membership isn't
+        evaluated yet. Numbers no longer assigned are removed from
+        obj_membership and obj_category in the same transaction. """
+
+        existing = dict((m.layer_id, m) for m in MembershipLayer.query())
+        stale = []
+
+        for lid, lobj in self.layers.iteritems():
+            definition = lobj.stat_definition_hash(self.tag_expander(lobj.type))
+            m = existing.pop(lid, None)
+            if m is not None and m.definition != definition:
+                stale.append(m.id)
+                m.delete()
+                DBSession.flush()
+                m = None
+            if m is None:
+                MembershipLayer(layer_id=lid, definition=definition).add()
+
+        for m in existing.itervalues():
+            stale.append(m.id)
+            m.delete()
+
+        if stale:
+            DBSession.flush()
+            self.execute_sql(_sql_template('update-membership-strip', dict(
+                stale='ARRAY[%s]::int[]' % ', '.join(str(n) for n in sorted(stale)))))
+
+        self.commit()
+
+        members = dict()
+        pending = []
+        for m in MembershipLayer.query():
+            members[m.layer_id] = m.id
+            if m.ts is None:
+                pending.append(m.layer_id)
+
+        return members, pending
+
+    def get_membership(self):
+        """ Numbers of layers with evaluated membership """
+
+        return dict(
+            (m.layer_id, m.id) for m in MembershipLayer.query()
+            if m.ts is not None and m.layer_id in self.layers)
+
+    def membership_context(self, objtype, members, lids):
+        layers = [self.layers[lid] for lid in sorted(lids)
+                  if self.layers[lid].type == objtype]
+
+        numbers = [members[l.id] for l in layers]
+        expand = self.tag_expander(objtype)
+        categories = []
+        for l in layers:
+            categories.extend(l.sql_categories(expand, members[l.id]))
+
+        return dict(
+            numbers='ARRAY[%s]::int[]' % ', '.join(str(n) for n in numbers),
+            layers="array_remove(ARRAY[%s]::int[], NULL)" % ', '.join([
+                l.sql_member(expand, members[l.id])
+                for l in layers
+            ]) if layers else "'{}'::int[]",
+            filter=' OR '.join([
+                '(%s)' % expand(l.filter) for l in layers
+            ]) or 'false',
+            categories=',\n    '.join(categories)
+            or '(NULL::int, NULL::text, false, NULL::text)',
+        )
+
+    def post_update(self, full=False, initial=False):
+        """ Process changes captured since the last post-update, every
+        object if full. The initial pass after post_load() fills
+        intersection tables without duplicate checks and builds their keys,
+        it's repeated by the next post-update if it didn't complete. """
+
         self.logger.info('Starting post-update operations...')
 
+        missing = self.get_missing_capture()
+        if missing:
+            raise RuntimeError(
+                "Changes of osm_%s aren't captured, database created by an "
+                "earlier version must be upgraded first" % ', osm_'.join(missing))
+
+        # Keys are built by the initial pass, tables left without them
+        # (unlogged with options.bulk_load) by a failed one are emptied
+        # and the pass is run again
+        if not initial:
+            unkeyed = self.get_missing_keys()
+            if unkeyed:
+                self.logger.warning(
+                    "Initial post-update wasn't completed (no key on %s), running it again",
+                    ', '.join(unkeyed))
+                self.execute_sql(_sql_template('update-initial-reset'))
+                full = initial = True
+
         version = DumpVersion().query().one()
+        self.trace_version(version.ts)
         self.get_tag_columns()
 
         context = {
             'version_timestamp': version.ts,
-            'filter_point': ' OR '.join(['(%s)' % self.expand_tag_columns(l.filter) for l in self.layers.itervalues() if l.type == 'point']),
-            'filter_line': ' OR '.join(['(%s)' % self.expand_tag_columns(l.filter) for l in self.layers.itervalues() if l.type == 'line']),
-            'filter_polygon': ' OR '.join(['(%s)' % self.expand_tag_columns(l.filter) for l in self.layers.itervalues() if l.type == 'polygon']),
+            'filter_point': ' OR '.join(['(%s)' % self.expand_tag_columns(l.filter, l.type) for l in self.layers.itervalues() if l.type == 'point']),
+            'filter_line': ' OR '.join(['(%s)' % self.expand_tag_columns(l.filter, l.type) for l in self.layers.itervalues() if l.type == 'line']),
+            'filter_polygon': ' OR '.join(['(%s)' % self.expand_tag_columns(l.filter, l.type) for l in self.layers.itervalues() if l.type == 'polygon']),
+            # Intersection tables are empty and chunks don't overlap
+            'initial': 'true' if initial else 'false',
         }
 
+        # Objects changed since the last post-update are captured into
+        # buffer_insert and buffer_delete by triggers on osm_* tables. After
+        # initial load nothing is captured and every object is processed.
+        # Intersection pass also recomputes objects near changed region
+        # boundaries queued into buffer_recompute.
+
+        for objtype in ('point', 'line', 'polygon'):
+            if full:
+                context['change_' + objtype] = 'true'
+                context['intersect_' + objtype] = 'true'
+            else:
+                context['change_' + objtype] = "osm_id IN (SELECT osm_id FROM buffer_insert WHERE tab = '%s'::plp_enum)" % objtype
+                context['intersect_' + objtype] = "(%s OR osm_id IN (SELECT osm_id FROM buffer_recompute WHERE tab = '%s'::plp_enum))" % (
+                    context['change_' + objtype], objtype)
+
         self.logger.debug("Point SQL filter:\n%s", context['filter_point'])
         self.logger.debug("Line SQL filter:\n%s", context['filter_line'])
         self.logger.debug("Polygon SQL filter:\n%s", context['filter_polygon'])
 
-        self.execute_sql(_sql_template('update-region'))
+        self.execute_sql(_sql_template('update-buffer-analyze'))
 
-        self.execute_queries([
-            _sql_template('update-validate-line'),
-            _sql_template('update-validate-polygon')
-        ])
+        self.execute_sql(_sql_template('update-region'))
 
-        self.execute_queries([
-            _sql_template('update-version-point', context),
-            _sql_template('update-version-line', context),
-            _sql_template('update-version-polygon', context)
-        ])
+        # Layer filters and classification are evaluated once per object
+        # version into obj_membership and obj_category, intersections,
+        # layers and statistics use them instead of tag expressions.
+        # Database upgraded from an earlier version doesn't have them yet,
+        # membership of every object is evaluated like by initial pass.
+
+        fill_membership = initial
+        if not self.relation_exists('obj_membership'):
+            self.execute_sql(_sql_template('load-membership', self.bulk_context()))
+            for m in MembershipLayer.query():
+                m.delete()
+            self.commit()
+            fill_membership = True
+
+        members, pending = self.sync_membership()
+
+        membership = dict()
+        for objtype in ('point', 'line', 'polygon'):
+            membership[objtype] = self.membership_context(objtype, members, self.layers.keys())
+            context['member_' + objtype] = dedent("""
+                EXISTS(
+                  SELECT * FROM obj_membership m
+                  WHERE m.tab = '%s'::plp_enum AND m.osm_id = osm_%s.osm_id
+                    AND m.ver = osm_%s.ver AND m.layers && %s
+                )""") % (objtype, objtype, objtype, membership[objtype]['numbers'])
+
+        rebuilt = dict()
+        if not fill_membership:
+            for objtype in ('point', 'line', 'polygon'):
+                rebuilt_filter = ' OR '.join([
+                    '(%s)' % self.expand_tag_columns(self.layers[lid].filter, objtype)
+                    for lid in pending if self.layers[lid].type == objtype])
+                if rebuilt_filter:
+                    rebuilt[objtype] = rebuilt_filter
+
+        plan = self.plan_intersections(context, rebuilt=rebuilt)
+
+        # Validation, versioning and intersection chunks are executed as
+        # one dependency graph, so phases of different object types
+        # overlap. Rows to be processed are used as cost estimate.
+
+        estimate = dict()
+        for item in plan:
+            estimate[item.objtype] = estimate.get(item.objtype, 0) + item.estimate
+
+        queries = [
+            _sql_template('update-validate-line', context, key='validate-line',
+                          cost=estimate.get('line', 0), trace=dict(phase='validate')),
+            _sql_template('update-validate-polygon', context, key='validate-polygon',
+                          cost=estimate.get('polygon', 0), trace=dict(phase='validate')),
+            _sql_template('update-version-point', context, key='version-point',
+                          cost=estimate.get('point', 0), trace=dict(phase='version')),
+            _sql_template('update-version-line', context, key='version-line',
+                          deps=('validate-line', ), cost=estimate.get('line', 0),
+                          trace=dict(phase='version')),
+            _sql_template('update-version-polygon', context, key='version-polygon',
+                          deps=('validate-polygon', ), cost=estimate.get('polygon', 0),
+                          trace=dict(phase='version')),
+        ]
+
+        for objtype in ('point', 'line', 'polygon'):
+            queries.append(_sql_template(
+                'update-membership', dict(
+                    membership[objtype], objtype=objtype,
+                    change='true' if fill_membership else context['change_' + objtype],
+                    initial='true' if fill_membership else context['initial']),
+                log='SQL update-membership %s' % objtype,
+                key='membership-%s' % objtype, deps=('version-%s' % objtype, ),
+                cost=estimate.get(objtype, 0), trace=dict(phase='membership')))
+
+            # Objects inserted by the initial pass have every layer
+            rebuilt = [lid for lid in pending if self.layers[lid].type == objtype]
+            if rebuilt and not fill_membership:
+                rebuild = self.membership_context(objtype, members, rebuilt)
+                queries.append(_sql_template(
+                    'update-membership-rebuild', dict(
+                        rebuild, objtype=objtype, rebuilt=rebuild['numbers']),
+                    log='SQL update-membership-rebuild %s' % objtype,
+                    key='membership-rebuild-%s' % objtype,
+                    deps=('membership-%s' % objtype, ),
+                    trace=dict(phase='membership')))
+
+        if fill_membership:
+            queries.append(_sql_template(
+                'load-membership-index', dict(set_logged='\n'.join([
+                    self.set_logged('obj_membership'),
+                    self.set_logged('obj_category')])),
+                key='membership-index',
+                deps=('membership-point', 'membership-line', 'membership-polygon'),
+                trace=dict(phase='load')))
+
+        query_keys = [None, ] * len(queries)
+        query_no = 0
+        chunk_keys = dict()
 
-        regions = Region.query().all()
-        cc_queries = []
-        cc_keys = []
+        for plan_no, item in enumerate(plan):
+            chunk_count = len(item.filters)
 
-        for region in regions:
-            for objtype in ('polygon', 'point', 'line'):
-                chunk_size = self.config['options']['chunk_size']
+            for chunk_no, chunk_filter in enumerate(item.filters):
+                query_no += 1
 
                 subcontext = dict(
                     context,
-                    region=region,
-                    chunk_no=0,
-                    chunk_count=chunk_size
+                    scope=item.scope,
+                    region_filter=item.region_filter,
+                    change_filter=item.change_filter,
+                    chunk_no=chunk_no,
+                    chunk_count=chunk_count,
+                    chunk_filter=chunk_filter
                 )
 
-                cc_keys.append((region.id, objtype))
-                cc_queries.append(_sql_template(
-                    'update-intersection-%s' % objtype,
-                    data=subcontext,
-                    log="Chunk size calculation table=%s; region=%s; chunk_size=%d" % (objtype, region.code, chunk_size)
-                ))
-
-        chunk_counts = dict(zip(cc_keys, self.execute_queries(cc_queries)))
-
-        queries = []
-        query_no = 0
-
-        for region in regions:
-            for objtype in ('polygon', 'point', 'line'):
-                chunk_count = max(1, chunk_counts[(region.id, objtype)])
-
-                for chunk_no in range(chunk_count):
-                    query_no += 1
+                key = 'intersection-%d' % query_no
+                chunk_keys.setdefault(item.objtype, []).append(key)
 
-                    subcontext = dict(
-                        context,
-                        region=region,
-                        chunk_no=chunk_no,
-                        chunk_count=chunk_count
-                    )
-
-                    queries.append(_sql_template(
-                        'update-intersection-%s' % objtype,
-                        data=subcontext,
-                        log="Geometry intersections #%d table=%s; region=%s; chunk=%d/%d" % (query_no, objtype, region.code, chunk_no+1, chunk_count))
-                    )
-
-        self.execute_queries(queries)
+                query_keys.append(plan_no)
+                queries.append(_sql_template(
+                    'update-intersection-%s' % item.objtype,
+                    data=subcontext,
+                    log="Geometry intersections #%d table=%s; region=%s; chunk=%d/%d" % (query_no, item.objtype, item.scope, chunk_no+1, chunk_count),
+                    key=key,
+                    deps=('membership-%s' % item.objtype,
+                          'membership-rebuild-%s' % item.objtype,
+                          'membership-index'),
+                    cost=item.estimate / chunk_count,
+                    trace=dict(phase='intersection', region=item.scope,
+                               chunk=chunk_no + 1, chunk_count=chunk_count))
+                )
 
-        self.execute_queries([
-            _sql_template('update-flag-point'),
-            _sql_template('update-flag-line'),
-            _sql_template('update-flag-polygon')
-        ])
+        if initial:
+            # Keys of each table are built as soon as its chunks are done
+            for objtype in ('point', 'line', 'polygon'):
+                query_keys.append(None)
+                queries.append(_sql_template(
+                    'load-intersection-index', dict(
+                        objtype=objtype,
+                        set_logged=self.set_logged_partitions('intersection_%s' % objtype)),
+                    log='SQL load-intersection-index %s' % objtype,
+                    deps=chunk_keys.get(objtype, ()),
+                    trace=dict(phase='load')))
+
+        inserted = dict()
+        for key, rowcount in zip(query_keys, self.execute_queries(queries)):
+            if key is not None:
+                inserted[key] = inserted.get(key, 0) + max(0, rowcount)
+
+        for plan_no, item in enumerate(plan):
+            self.logger.info(
+                "Geometry intersections table=%s; region=%s: estimated=%d; inserted=%d; chunks=%d",
+                item.objtype, item.scope, item.estimate,
+                inserted.get(plan_no, 0), len(item.filters))
+
+        self.execute_sql(_sql_template('update-buffer-clear'))
+
+        for m in MembershipLayer.query():
+            if m.ts is None:
+                m.ts = version.ts
 
         DumpVersion().query().one().ready = True
         self.commit()
@@ -365,19 +902,41 @@ class Env(object):
     def update_layers(self):
         self.logger.info('Updating layers...')
         version = DumpVersion().query().one()
+        self.trace_version(version.ts)
 
         self.get_tag_columns()
+        region_hashes = self.get_region_hashes()
+        members = self.get_membership()
 
         queries = []
         for lid, lobj in self.layers.iteritems():
+            definition = lobj.definition_hash(self.tag_expander(lobj.type))
+
             for region in Region.query():
                 layer_version = LayerVersion.filter_by(
                     region_id=region.id, layer_id=lid
                 ).first()
                 if layer_version is None or layer_version.ts < version.ts:
+                    # Full rebuild is required only if layer definition or
+                    # region geometry changed since the layer was built.
+                    delta = self.config['options']['incremental_layers'] \
+                        and layer_version is not None \
+                        and layer_version.definition == definition \
+                        and layer_version.region_hash == region_hashes[region.id] \
+                        and layer_version.widths is not None \
+                        and layer_version.content_hash is not None
+
                     queries.append(SqlStatement(
-                        sql=lobj.sql_update_layer(region, self.expand_tag_columns),
-                        log="Update layer=%s region=%s" % (lid, region.code)
+                        sql=lobj.sql_update_layer(
+                            region, self.tag_expander(lobj.type), delta=delta,
+                            definition=definition,
+                            region_hash=region_hashes[region.id],
+                            member=members.get(lid)),
+                        log="Update layer=%s region=%s%s" % (
+                            lid, region.code, ' (delta)' if delta else ''),
+                        cost=layer_version.row_count if layer_version is not None else 0,
+                        trace=dict(phase='layer', template='update-layer',
+                                   region=region.code, layer=lid, delta=delta)
                     ))
 
         self.execute_queries(queries)
@@ -393,78 +952,306 @@ class Env(object):
         f.extend(['--hstore', '--multi-geometry', '--latlong', '--prefix', 'osm'])
         return f
 
-    def update_stat(self):
-        tstamp = DumpVersion.query().one().ts
+    def update_stat(self, full=False):
+        """ With full=True statistics are recomputed from scratch for all
+        regions, verify_stat() compares them without replacing. """
+
+        version = DumpVersion.query().one()
+        tstamp = version.ts
+        self.trace_version(tstamp)
         self.logger.info('Updating statistics for %s ...', tstamp)
 
+        self.get_tag_columns()
+        region_hashes = self.get_region_hashes()
+        members = self.get_membership()
+
+        # Objects changed since the oldest state of delta regions are
+        # collected once for all layers. Compaction since the state was
+        # computed could remove rows they are found by, such regions are
+        # computed in full.
+        changed_regions = set()
+        changed_since = None
+
         queries = []
         for l_id, l_obj in self.layers.iteritems():
+            definition = l_obj.stat_definition_hash(self.tag_expander(l_obj.type))
+
+            full_regions = []
+            delta_regions = []
+            for region in Region.query():
+                state = LayerStatState.filter_by(
+                    region_id=region.id, layer_id=l_id
+                ).first()
+                if not full and state is not None \
+                        and state.definition == definition \
+                        and state.region_hash == region_hashes[region.id] \
+                        and (version.compacted is None or state.ts >= version.compacted):
+                    delta_regions.append(region.id)
+                    changed_regions.add(region.id)
+                    if changed_since is None or state.ts < changed_since:
+                        changed_since = state.ts
+                else:
+                    full_regions.append(region.id)
+
+            if not full_regions and not delta_regions:
+                continue
+
             queries.append(SqlStatement(
-                sql=l_obj.sql_stat(self.expand_tag_columns),
-                log="Update stat layer=%s" % l_id
+                sql=l_obj.sql_stat(
+                    self.tag_expander(l_obj.type), full_regions, delta_regions,
+                    definition=definition, region_hashes=region_hashes,
+                    member=members.get(l_id)),
+                log="Update stat layer=%s (full=%d; delta=%d)" % (
+                    l_id, len(full_regions), len(delta_regions)),
+                trace=dict(phase='stat', template='layer-stat', layer=l_id)
             ))
 
+        if changed_regions:
+            self.execute_sql(_sql_template('update-stat-changed', dict(
+                regions=', '.join(str(r) for r in sorted(changed_regions)),
+                since="'%s'" % changed_since), trace=dict(phase='stat')))
+
         self.execute_queries(queries)
 
         self.logger.info('Statistics updated.')
 
-    def export(self):
-        version = DumpVersion().query().one()
-        devnull = open(os.devnull, 'w')
+    def verify_stat(self):
+        """ Compute statistics from scratch and compare them with incremental
+        ones of the current dump version. Only up to date regions are
+        verified, stored statistics aren't changed. Returns list of
+        differences, each is a dict of layer, region, criterion, category
+        and stored and computed values. """
+
+        tstamp = DumpVersion.query().one().ts
+        self.logger.info('Verifying statistics for %s ...', tstamp)
+
+        self.get_tag_columns()
+        region_hashes = self.get_region_hashes()
+        members = self.get_membership()
+
+        result = []
+        cur = self.connection.cursor()
+        for l_id, l_obj in self.layers.iteritems():
+            definition = l_obj.stat_definition_hash(self.tag_expander(l_obj.type))
+
+            regions = []
+            for region in Region.query():
+                state = LayerStatState.filter_by(
+                    region_id=region.id, layer_id=l_id
+                ).first()
+                if state is not None and state.ts == tstamp \
+                        and state.definition == definition \
+                        and state.region_hash == region_hashes[region.id]:
+                    regions.append(region.id)
+                else:
+                    self.logger.warning(
+                        "Statistics of layer=%s region=%d aren't up to date, skipped",
+                        l_id, region.id)
+
+            if not regions:
+                continue
+
+            start = datetime.now()
+
+            # Temporary tables are discarded with rollback
+            cur.execute('BEGIN')
+            try:
+                for name, value in self.session_settings('stat'):
+                    cur.execute("SET LOCAL %s TO '%s'" % (name, value.replace("'", "''")))
+                cur.execute(l_obj.sql_stat_verify(
+                    self.tag_expander(l_obj.type), regions,
+                    member=members.get(l_id)))
+                cur.execute(
+                    'SELECT region_id, criterion, category, '
+                    'stored_count, computed_count, stored_points, computed_points, '
+                    'stored_length, computed_length, stored_area, computed_area '
+                    'FROM tmp_stat_verify ORDER BY region_id, criterion, category')
+                rows = cur.fetchall()
+            finally:
+                cur.execute('ROLLBACK')
+
+            for row in rows:
+                diff = dict(zip((
+                    'region', 'criterion', 'category',
+                    'stored_count', 'computed_count',
+                    'stored_points', 'computed_points',
+                    'stored_length', 'computed_length',
+                    'stored_area', 'computed_area'), row), layer=l_id)
+                self.logger.warning(
+                    'Statistics differ layer=%s region=%d criterion=%s category=%s '
+                    '(count=%s/%s; points=%s/%s; length=%s/%s; area=%s/%s)',
+                    l_id, diff['region'], diff['criterion'], diff['category'],
+                    diff['stored_count'], diff['computed_count'],
+                    diff['stored_points'], diff['computed_points'],
+                    diff['stored_length'], diff['computed_length'],
+                    diff['stored_area'], diff['computed_area'])
+                result.append(diff)
+
+            self.logger.info(
+                'Verified stat layer=%s (regions=%d; differences=%d; t=%s)',
+                l_id, len(regions), len(rows), datetime.now() - start)
+
+        self.logger.info('Statistics verified, %d differences.', len(result))
+
+        return result
+
+    def relation_size(self, table):
+        """ Total size of table with indexes and partitions """
 
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT pg_total_relation_size('%s'::regclass) + COALESCE(("
+            "SELECT SUM(pg_total_relation_size(inhrelid)) FROM pg_inherits "
+            "WHERE inhparent = '%s'::regclass), 0)" % (table, table))
+        (result, ) = cur.fetchone()
+        return result
+
+    def relation_row_size(self, table):
+        """ Average heap bytes per row of table with partitions, estimated
+        from planner statistics """
+
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT COALESCE(SUM(pg_relation_size(c.oid))::float / NULLIF(SUM(GREATEST(c.reltuples, 0)), 0), 0) "
+            "FROM pg_class c WHERE c.oid = '%s'::regclass OR c.oid IN ("
+            "SELECT inhrelid FROM pg_inherits WHERE inhparent = '%s'::regclass)" % (table, table))
+        (result, ) = cur.fetchone()
+        return float(result)
+
+    def compact(self):
+        """ Delete intersection, obj_membership and obj_category rows of
+        object versions superseded by options.compact_keep newer ones (0
+        disables compaction). Intersections are processed by region
+        partition, membership by object type, in batches of
+        options.compact_batch rows, batches run in parallel. Only objects
+        which obj_version.ts isn't older than dump_version.compacted of the
+        previous compaction are examined. Touched tables are vacuumed
+        afterwards, which makes space of deleted rows reusable but rarely
+        shrinks files. Returns deleted rows, estimate of freed bytes (deleted
+        rows by average row size) and total size before and after by
+        table. """
+
+        options = self.config['options']
+        if options['compact_keep'] <= 0:
+            return dict()
+
+        version = DumpVersion.query().one()
+        self.trace_version(version.ts)
+        self.logger.info('Compacting intersections...')
+
+        objtypes = ('point', 'line', 'polygon')
+        tables = ['intersection_%s' % t for t in objtypes] + ['obj_membership', 'obj_category']
+        size_before = dict((t, self.relation_size(t)) for t in tables)
+        row_size = dict((t, self.relation_row_size(t)) for t in tables)
+
+        # (table, template data, region code, table to vacuum)
+        pending = []
         for region in Region.query():
-            tmpdir = tempfile.mkdtemp()
+            for objtype in objtypes:
+                pending.append((
+                    'intersection_%s' % objtype, ('compact-intersection', dict(
+                        objtype=objtype, region_id=region.id)),
+                    region.code, 'intersection_%s_%d' % (objtype, region.id)))
+
+        for table in ('obj_membership', 'obj_category'):
+            for objtype in objtypes:
+                pending.append((
+                    table, ('compact-membership', dict(table=table, objtype=objtype)),
+                    None, table))
+
+        # Versions are superseded only when obj_version.latest is bumped
+        # along with ts, objects of the compacted dump version are examined
+        # again as post-update might follow compaction
+        if version.compacted is not None:
+            since = "v.ts >= '%s'" % version.compacted
+        else:
+            since = 'true'
+
+        deleted = dict()
+        touched = set()
+
+        while pending:
+            queries = [
+                _sql_template(template, dict(
+                    data, keep=options['compact_keep'], since=since,
+                    batch_size=options['compact_batch']),
+                    log='Compact %s%s' % (table, '; region=%s' % code if code else ''),
+                    trace=dict(phase='compact', region=code))
+                for (table, (template, data), code, vacuum) in pending
+            ]
+
+            remaining = []
+            for item, rowcount in zip(pending, self.execute_queries(queries)):
+                table, vacuum = item[0], item[3]
+                deleted[table] = deleted.get(table, 0) + max(0, rowcount)
+                if rowcount > 0:
+                    touched.add(vacuum)
+                # Table or partition isn't exhausted while batches are full
+                if rowcount >= options['compact_batch']:
+                    remaining.append(item)
+            pending = remaining
+
+        version.compacted = version.ts
+        self.commit()
 
-            datadir = os.path.join(tmpdir, 'data')
-            os.mkdir(datadir)
+        cur = self.connection.cursor()
+        for vacuum in sorted(touched):
+            cur.execute('VACUUM ANALYZE %s' % vacuum)
 
-            self.logger.info('Region [%s]: exporting to %s...', region.code, datadir)
-            files = [datadir, ]
+        result = dict()
+        for table in tables:
+            result[table] = dict(
+                deleted=deleted.get(table, 0),
+                freed=int(deleted.get(table, 0) * row_size[table]),
+                size_before=size_before[table],
+                size_after=self.relation_size(table))
 
-            for l_id, b_obj in self.layers.iteritems():
-                cur = self.connection.cursor()
-                cur.execute('SELECT COUNT(*) FROM layer."%s %s"' % (region.code, l_id))
-                (feature_count, ) = cur.fetchone()
+            self.logger.info(
+                'Compacted %s: deleted=%d rows (~%d bytes freed for reuse); size=%d -> %d bytes',
+                table, result[table]['deleted'], result[table]['freed'],
+                result[table]['size_before'], result[table]['size_after'])
 
-                if feature_count == 0:
-                    self.logger.info('Layer [%s %s] is empty.', region.code, l_id)
-                    continue
-
-                self.logger.info('Layer [%s %s]: exporting %d features...', region.code, l_id, feature_count)
-                filename = os.path.join(datadir, l_id)
-                args = [self.config['export']['pgsql2shp'], ] \
-                        + ['-h', self.config['database']['host'], '-u', self.config['database']['user']] \
-                        + ['-f', filename, '-b'] \
-                        + [self.config['database']['name'], '%s.%s %s' % ('layer', region.code, l_id)]
-
-                subprocess.check_call(args, stdout=devnull, stderr=devnull)
-
-                if 'shptree' in self.config['export']:
-                    self.logger.info('Layer [%s %s]: building index using shptree...', region.code, l_id)
-                    subprocess.check_call([self.config['export']['shptree'], filename], stdout=devnull, stderr=devnull)
-
-                # dbf unicode file patch
-                with open(filename + '.dbf', 'r+b') as fd:
-                    fd.seek(0x1D)
-                    fd.write('\x00')
-
-                # cpg file for arcgis
-                cpgfile = filename + '.cpg'
-                with open(cpgfile, 'w') as fd:
-                    fd.write('65001')
-                
-            if 'readme' in self.config['export']:
-                readme = os.path.split(self.config['export']['readme'])[1]
-                shutil.copy(
-                    self.config['export']['readme'],
-                    os.path.join(tmpdir, readme)
-                )
-                files.append(readme)
+        return result
+
+    def get_layer_hash(self, region, layer_id):
+        """ Content hash of region layer table, independent of row order,
+        for layers built before layer_version.content_hash was recorded """
+
+        cur = self.connection.cursor()
+        cur.execute(
+            'SELECT md5(string_agg(h, \'\' ORDER BY h)) FROM ('
+            'SELECT md5(l::text) AS h FROM layer."%s %s" l) sub' % (region.code, layer_id))
+        (result, ) = cur.fetchone()
+        return result
+
+    def export(self):
+        version = DumpVersion().query().one()
+        export = self.config['export']
 
-            # qgis projects
-            if 'qgis_projects' in self.config['export']:
-                self.logger.info('Region [%s]: building QGIS projects...', region.code)
+        regions = []
+        layers = []
 
+        extras = exportmod.extras_fingerprint(export)
+
+        for region in Region.query():
+            current_name = os.path.join(
+                export['path'], region.code,
+                region.code + '-' + version.ts.strftime('%y%m%d') + '.7z')
+            latest_name = os.path.join(
+                export['path'], 'latest', region.code + '.7z')
+
+            # Manifest of the previous export, layers with the same
+            # fingerprint are taken from its archive instead of dumping.
+            previous = exportmod.read_manifest(latest_name)
+            if previous is not None and (
+                previous.get('format') != dict(qix=export['qix'])
+                or not os.path.exists(previous['archive'])
+            ):
+                previous = None
+            prev_layers = previous['layers'] if previous else dict()
+
+            extent = None
+            if 'qgis_projects' in export:
                 curr = self.connection.cursor()
                 curr.execute("""
                     SELECT
@@ -475,104 +1262,222 @@ class Env(object):
                         FROM region WHERE id = %d
                 """ % region.id)
 
-                (xmin, xmax, ymin, ymax) = curr.fetchone()
+                extent = curr.fetchone()
 
-                self.tag_columns = [c for (c, ) in curr]
-                for proj_template in self.config['export']['qgis_projects']:
-                    et = ElementTree()
-                    et.parse(proj_template)
-                    
-                    et.find('mapcanvas/extent/xmin').text = str(xmin)
-                    et.find('mapcanvas/extent/xmax').text = str(xmax)
-                    et.find('mapcanvas/extent/ymin').text = str(ymin)
-                    et.find('mapcanvas/extent/ymax').text = str(ymax)
+            manifest = dict(
+                archive=current_name,
+                format=dict(qix=export['qix']),
+                extent=extent,
+                extras=extras,
+                layers=dict())
 
-                    target_file = os.path.join(tmpdir, os.path.split(proj_template)[1])
-                    et.write(target_file)
-                    files.append(os.path.split(proj_template)[1])
+            layer_versions = dict(
+                (lv.layer_id, lv) for lv in region.layer_versions)
 
-                # include_dirs
-                if 'include_dirs' in self.config['export']:
-                    self.logger.info('Region [%s]: copying include_dirs...', region.code)
-                    for idir in self.config['export']['include_dirs']:
-                        shutil.copytree(idir, os.path.join(tmpdir, os.path.split(idir)[1]))
-                        files.append(os.path.split(idir)[1])
+            changed = []
+            reuse = []
+            for l_id, b_obj in self.layers.iteritems():
+                lv = layer_versions.get(l_id)
+                prev = prev_layers.get(l_id)
+
+                fingerprint = dict(
+                    ts=lv.ts.isoformat() if lv is not None else None,
+                    definition=lv.definition if lv is not None else None,
+                    row_count=lv.row_count if lv is not None else None,
+                    hash=None)
+
+                if fingerprint['row_count'] is None:
+                    cur = self.connection.cursor()
+                    cur.execute('SELECT COUNT(*) FROM layer."%s %s"' % (region.code, l_id))
+                    (fingerprint['row_count'], ) = cur.fetchone()
+
+                if fingerprint['row_count'] > 0:
+                    if lv is not None and lv.content_hash is not None:
+                        # Maintained by layer build
+                        fingerprint['hash'] = lv.content_hash
+                    elif prev is not None and lv is not None and prev['ts'] == fingerprint['ts']:
+                        # Layer wasn't rebuilt since previous export
+                        fingerprint['hash'] = prev['hash']
+                    else:
+                        fingerprint['hash'] = self.get_layer_hash(region, l_id)
+
+                manifest['layers'][l_id] = fingerprint
+
+                unchanged = prev is not None and all(
+                    prev.get(k) == fingerprint[k]
+                    for k in ('definition', 'row_count', 'hash'))
+
+                if fingerprint['row_count'] == 0:
+                    if not unchanged:
+                        changed.append(l_id)
+                    self.logger.info('Layer [%s %s] is empty.', region.code, l_id)
 
-            self.logger.info('Region [%s]: compressing...', region.code)
+                elif unchanged:
+                    reuse.append(l_id)
+
+                else:
+                    changed.append(l_id)
+                    layers.append(dict(
+                        region=region.code,
+                        layer=l_id,
+                        type=b_obj.type,
+                        feature_count=fingerprint['row_count'],
+                        widths=json.loads(lv.widths) if lv is not None and lv.widths else None,
+                        export=export,
+                        session=self.session_settings('export'),
+                        database=self.config['database']
+                    ))
 
-            current_name = os.path.join(
-                self.config['export']['path'], region.code,
-                region.code + '-' + version.ts.strftime('%y%m%d') + '.7z')
+            relink = previous is not None and not changed \
+                and previous.get('extent') == (list(extent) if extent else None) \
+                and previous.get('extras') == extras \
+                and set(prev_layers) == set(manifest['layers'])
 
-            latest_name = os.path.join(
-                self.config['export']['path'],
-                'latest', region.code + '.7z')
-
-            current_path = os.path.split(current_name)[0]
-            if not os.path.exists(current_path):
-                os.makedirs(current_path)
-
-            latest_path = os.path.split(latest_name)[0]
-            if not os.path.exists(latest_path):
-                os.makedirs(latest_path)
-
-            os.chdir(tmpdir)
-            subprocess.check_call([
-                self.config['export']['7z'], 'a',
-                os.path.join(
-                    self.config['export']['path'], region.code,
-                    region.code + '-' + version.ts.strftime('%y%m%d') + '.7z'
-                )
-            ] + files, stdout=devnull, stderr=devnull)
+            tmpdir = None
+            if relink:
+                self.logger.info('Region [%s]: no changes since %s.', region.code, previous['archive'])
+            else:
+                tmpdir = tempfile.mkdtemp()
+
+                datadir = os.path.join(tmpdir, 'data')
+                os.mkdir(datadir)
+
+                self.logger.info(
+                    'Region [%s]: exporting to %s (%d layers unchanged)...',
+                    region.code, datadir, len(reuse))
+
+                for task in layers:
+                    if task['region'] == region.code:
+                        task['filename'] = os.path.join(datadir, task['layer'])
+
+            regions.append(dict(
+                region=region.code,
+                tmpdir=tmpdir,
+                files=['data', ],
+                extent=extent,
+                current_name=current_name,
+                latest_name=latest_name,
+                previous=previous['archive'] if previous else None,
+                relink=relink,
+                reuse=reuse,
+                manifest=manifest,
+                export=export
+            ))
+
+        exportmod.export_regions(
+            regions, layers,
+            workers=export['workers'],
+            connections=export['connections'])
 
-            if os.path.exists(latest_name):
-                os.remove(latest_name)
-            os.symlink(current_name, latest_name)
-            
-            shutil.rmtree(tmpdir)
+    def session_settings(self, sclass=None):
+        """ List of (name, value) session settings for statement class """
 
-            self.logger.info('Region [%s]: export completed', region.code)
+        sessions = self.config['sessions']
+        settings = dict(sessions.get('default', {}))
+        if sclass is not None:
+            settings.update(sessions.get(sclass, {}))
+
+        result = []
+        for name, value in sorted(settings.iteritems()):
+            if isinstance(value, bool):
+                # YAML turns on/off into booleans
+                value = 'on' if value else 'off'
+            result.append((name, str(value)))
+
+        return result
 
-    def _execute_query(self, query, connection):
+    def pool_stats(self):
+        """ Number of connection checkouts, total and max wait in seconds """
+
+        with self._pool_lock:
+            return dict(self._pool_wait)
+
+    def _execute_query(self, query, connection, pool_wait=None):
         if isinstance(query, SqlStatement):
             start = datetime.now()
 
             sql = query.sql
-            result = connection.execute(text(sql))
+            plans = None
+            if self.trace is not None and self.trace.sample(sql):
+                rowcount, plans = trace.explain_analyze(connection, sql)
+            else:
+                rowcount = connection.execute(text(sql)).rowcount
 
             end = datetime.now()
-            if result.rowcount > 0:
-                self.logger.info(query.log + ' (t=%s; rows=%d)' % (end - start, result.rowcount))
+            if rowcount > 0:
+                self.logger.info(query.log + ' (t=%s; rows=%d)' % (end - start, rowcount))
             else:
                 self.logger.info(query.log + ' (t=%s)' % (end - start))
 
+            if self.trace is not None:
+                self.trace.write(dict(
+                    query.trace or {},
+                    log=query.log,
+                    start=start,
+                    end=end,
+                    duration=(end - start).total_seconds(),
+                    pool_wait=pool_wait,
+                    rows=rowcount,
+                    thread=threading.current_thread().name,
+                    plans=plans))
+
         else:
             sql = query
-            result = connection.execute(text(sql))
+            rowcount = connection.execute(text(sql)).rowcount
 
-        return result.rowcount
+        return rowcount
 
-    def execute_sql(self, query):
+    def _run_statement(self, query):
+        """ Execute statement on pooled connection with session settings
+        of its class, which are local to statement transaction """
+
+        start = datetime.now()
         connection = DBSession.connection()
+        pool_wait = (datetime.now() - start).total_seconds()
+
+        with self._pool_lock:
+            self._pool_wait['count'] += 1
+            self._pool_wait['total'] += pool_wait
+            self._pool_wait['max'] = max(self._pool_wait['max'], pool_wait)
 
         try:
-            result = self._execute_query(query, connection)
+            sclass = None
+            if isinstance(query, SqlStatement) and query.trace:
+                sclass = query.trace.get('phase')
+
+            for name, value in self.session_settings(sclass):
+                connection.execute(
+                    "SET LOCAL %s TO '%s'" % (name, value.replace("'", "''")))
+
+            result = self._execute_query(query, connection, pool_wait=pool_wait)
             DBSession.commit()
         finally:
             connection.close()
 
         return result
 
+    def execute_sql(self, query):
+        return self._run_statement(query)
+
+    @property
+    def executor(self):
+        if not hasattr(self, '_executor'):
+            self._executor = Executor(
+                self.config['options']['worker_count'], self._run_statement)
+
+        return self._executor
+
     def execute_queries(self, queries):
-        def worker(query):
-            connection = DBSession.connection()
-            try:
-                result = self._execute_query(query, connection)
-                DBSession.commit()
-            finally:
-                connection.close()
+        start = datetime.now()
+        pool_wait = self.pool_stats()['total']
+
+        result = self.executor.run(queries)
 
-            return result
+        stats = self.executor.stats()
+        self.logger.info(
+            'Executed %d statements (t=%s; workers=%d; utilization=%d%%; pool wait=%.1fs)',
+            len(queries), datetime.now() - start, stats['workers'],
+            round(stats['utilization'] * 100),
+            self.pool_stats()['total'] - pool_wait)
 
-        pool = ThreadPool(processes=self.config['options']['worker_count'])
-        return pool.map(worker, queries)
+        return result
@@ -0,0 +1,290 @@
+import json
+import math
+import time
+import logging
+import resource
+from datetime import datetime, timedelta
+
+from .models import DumpVersion, Region
+
+_logger = logging.getLogger(__name__)
+
+# Benchmark on synthetic data. Instead of running osm2pgsql, osm_point,
+# osm_line and osm_polygon tables are generated in the form osm2pgsql
+# creates them (osm_id, tags hstore, way), regions are circles on a grid.
+# Then the regular pipeline is run: post_load, post_update, layers, stat
+# and export, followed by simulated diffs which replace a share of objects
+# with DELETE and INSERT the same way osm2pgsql --append does.
+#
+# Random values come from PostgreSQL random() seeded with setseed(), so
+# the same settings produce the same data.
+#
+# Everything in the configured database is dropped, use a dedicated one.
+
+DEFAULTS = dict(
+    seed=0.5,
+    extent=[0.0, 0.0, 10.0, 10.0],
+    points=100000,
+    lines=50000,
+    polygons=50000,
+    line_vertices=10,
+    polygon_vertices=16,
+    object_size=0.01,
+    tags={
+        'highway': {'primary': 0.05, 'secondary': 0.1, 'residential': 0.3},
+        'building': {'yes': 0.3},
+        'name': {'Test': 0.5},
+    },
+    regions=4,
+    region_vertices=256,
+    region_overlap=0.2,
+    diffs=3,
+    diff_fraction=0.01,
+    export=True,
+)
+
+
+def _tags_sql(tags):
+    keys = []
+    values = []
+    for key in sorted(tags):
+        case = []
+        threshold = 0.0
+        for value in sorted(tags[key]):
+            threshold += tags[key][value]
+            case.append("WHEN r < %f THEN '%s'" % (threshold, value))
+        keys.append("'%s'" % key)
+        # Reference to g makes subquery correlated, so random() is
+        # evaluated for every row instead of once
+        values.append("(SELECT CASE %s END FROM (SELECT random() + 0 * g AS r) rnd)" % ' '.join(case))
+
+    if not keys:
+        return "''::hstore"
+
+    # Keys with NULL values are kept, filters like <key> IS NOT NULL
+    # treat them as absent
+    return "hstore(ARRAY[%s], ARRAY[%s])" % (', '.join(keys), ', '.join(values))
+
+
+def _geom_sql(objtype, options):
+    size = options['object_size']
+
+    if objtype == 'point':
+        return "ST_SetSRID(ST_MakePoint(x, y), 4326)"
+
+    elif objtype == 'line':
+        return (
+            "ST_SetSRID(ST_MakeLine(ARRAY("
+            "SELECT ST_MakePoint(x + (random() - 0.5) * %(size)f, y + (random() - 0.5) * %(size)f) "
+            "FROM generate_series(1, %(vertices)d))), 4326)"
+        ) % dict(size=size, vertices=max(2, options['line_vertices']))
+
+    else:
+        return (
+            "ST_Multi(ST_Buffer(ST_SetSRID(ST_MakePoint(x, y), 4326), "
+            "%(size)f * (0.5 + random()), %(quad)d))"
+        ) % dict(size=size / 2, quad=max(1, options['polygon_vertices'] // 4))
+
+
+def generate_sql(objtype, count, options, id_offset=0):
+    """ INSERT of count random objects into osm_<objtype> """
+
+    xmin, ymin, xmax, ymax = options['extent']
+
+    return (
+        "INSERT INTO osm_%(objtype)s (osm_id, tags, way)\n"
+        "SELECT g + %(id_offset)d, %(tags)s, %(geom)s\n"
+        "FROM (\n"
+        "  SELECT g, %(xmin)f + random() * %(width)f AS x, %(ymin)f + random() * %(height)f AS y\n"
+        "  FROM generate_series(1, %(count)d) g\n"
+        ") src;"
+    ) % dict(
+        objtype=objtype, id_offset=id_offset, count=count,
+        tags=_tags_sql(options['tags']), geom=_geom_sql(objtype, options),
+        xmin=xmin, ymin=ymin, width=xmax - xmin, height=ymax - ymin)
+
+
+def diff_sql(objtype, options):
+    """ Replace diff_fraction of objects with moved copies and add the same
+    number of new ones, as osm2pgsql --append does with DELETE and INSERT """
+
+    size = options['object_size']
+
+    return (
+        "DROP TABLE IF EXISTS tmp_bench_diff;\n"
+        "CREATE TEMP TABLE tmp_bench_diff AS\n"
+        "SELECT osm_id, tags, way FROM osm_%(objtype)s WHERE random() < %(fraction)f;\n"
+        "DELETE FROM osm_%(objtype)s WHERE osm_id IN (SELECT osm_id FROM tmp_bench_diff);\n"
+        "INSERT INTO osm_%(objtype)s (osm_id, tags, way)\n"
+        "SELECT osm_id, tags, ST_Translate(way, (random() - 0.5) * %(size)f, (random() - 0.5) * %(size)f)\n"
+        "FROM tmp_bench_diff;\n"
+        "INSERT INTO osm_%(objtype)s (osm_id, tags, way)\n"
+        "SELECT (SELECT MAX(osm_id) FROM osm_%(objtype)s) + row_number() OVER (), tags,\n"
+        "  ST_Translate(way, (random() - 0.5) * %(size)f, (random() - 0.5) * %(size)f)\n"
+        "FROM tmp_bench_diff;"
+    ) % dict(objtype=objtype, fraction=options['diff_fraction'], size=size)
+
+
+def region_expressions(options):
+    """ Circles on a square grid covering extent, neighbours overlap by
+    region_overlap of radius """
+
+    xmin, ymin, xmax, ymax = options['extent']
+    side = int(math.ceil(math.sqrt(options['regions'])))
+    width = (xmax - xmin) / side
+    height = (ymax - ymin) / side
+    radius = min(width, height) / 2 * (1 + options['region_overlap'])
+    quad = max(1, options['region_vertices'] // 4)
+
+    result = []
+    for i in range(options['regions']):
+        x = xmin + width * (i % side + 0.5)
+        y = ymin + height * (i // side + 0.5)
+        result.append((
+            "ST_Buffer(ST_SetSRID(ST_MakePoint(%f, %f), 4326), %f, %d)" % (x, y, radius, quad),
+            radius / 10))
+
+    return result
+
+
+class Benchmark(object):
+
+    def __init__(self, env):
+        if 'bench' not in env.config:
+            raise ValueError("Benchmark requires 'bench' section in config")
+
+        self.env = env
+        self.options = dict(DEFAULTS, **env.config['bench'])
+        self.phases = []
+
+    def phase(self, name, func, rows=None):
+        _logger.info('Benchmark phase %s...', name)
+
+        start = time.time()
+        func()
+        seconds = time.time() - start
+
+        record = dict(phase=name, seconds=seconds, rows=rows)
+        if rows:
+            record['throughput'] = rows / seconds if seconds > 0 else None
+        self.phases.append(record)
+
+        _logger.info('Benchmark phase %s: %.1f s', name, seconds)
+
+    def _execute(self, sql):
+        cur = self.env.connection.cursor()
+        cur.execute(sql)
+
+    def generate(self):
+        options = self.options
+
+        self._execute("SELECT setseed(%f)" % options['seed'])
+        for objtype in ('point', 'line', 'polygon'):
+            self._execute(
+                "CREATE TABLE osm_%s (osm_id bigint, tags hstore, way geometry(Geometry, 4326))" % objtype)
+            self._execute(generate_sql(objtype, options[objtype + 's'], options))
+            self._execute(
+                "CREATE INDEX osm_%s_pkey ON osm_%s (osm_id)" % (objtype, objtype))
+            self._execute(
+                "CREATE INDEX osm_%s_index ON osm_%s USING gist (way)" % (objtype, objtype))
+            self._execute("ANALYZE osm_%s" % objtype)
+
+    def create_regions(self):
+        for i, (expression, simpl_buf) in enumerate(region_expressions(self.options)):
+            code = 'BENCH-%02d' % (i + 1)
+            Region(code=code, name=code, expression=expression, simpl_buf=simpl_buf).add()
+        self.env.commit()
+
+    def simulate_diff(self, no):
+        env = self.env
+
+        self._execute("SELECT setseed(%f)" % ((self.options['seed'] + no * 0.1) % 1))
+        for objtype in ('point', 'line', 'polygon'):
+            self._execute(diff_sql(objtype, self.options))
+
+        version = DumpVersion.query().one()
+        version.ts = version.ts + timedelta(1)
+        version.ready = False
+        env.commit()
+
+    def run(self):
+        env = self.env
+        options = self.options
+        objects = options['points'] + options['lines'] + options['polygons']
+        changed = int(2 * objects * options['diff_fraction'])
+
+        started = datetime.now()
+
+        env.cleanup()
+        env.initialize()
+
+        self.phase('generate', self.generate, rows=objects)
+        self.phase('post_load', env.post_load, rows=objects)
+
+        DumpVersion(ts=datetime(2000, 1, 1), ready=False).add()
+        env.commit()
+
+        self.phase('regions', self.create_regions)
+        self.phase('post_update_full', lambda: env.post_update(full=True, initial=True), rows=objects)
+        self.phase('update_layers_full', env.update_layers, rows=objects)
+        self.phase('update_stat_full', env.update_stat, rows=objects)
+
+        do_export = options['export'] and 'path' in env.config['export']
+        if do_export:
+            self.phase('export_full', env.export)
+
+        for no in range(options['diffs']):
+            self.phase('diff', lambda: self.simulate_diff(no), rows=changed)
+            self.phase('post_update', env.post_update, rows=changed)
+            self.phase('update_stat', env.update_stat, rows=changed)
+            self.phase('update_layers', env.update_layers, rows=changed)
+            self.phase('compact', env.compact, rows=changed)
+            if do_export:
+                self.phase('export', env.export)
+
+        # Peak resident memory of this process and finished children
+        # (export workers), PostgreSQL backends aren't included
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        return dict(
+            started=started.isoformat(),
+            seconds=sum(p['seconds'] for p in self.phases),
+            options=options,
+            phases=self.phases,
+            totals=totals(self.phases),
+            peak_memory_kb=dict(process=self_rss, children=children_rss),
+        )
+
+
+def totals(phases):
+    """ Total seconds by phase name """
+
+    result = dict()
+    for p in phases:
+        result[p['phase']] = result.get(p['phase'], 0.0) + p['seconds']
+    return result
+
+
+def compare(report, baseline, threshold=1.1):
+    """ Phases slower than in baseline by threshold ratio and more, list
+    of (phase, baseline seconds, seconds, ratio) """
+
+    result = []
+    for phase, seconds in sorted(report['totals'].iteritems()):
+        before = baseline['totals'].get(phase)
+        if before:
+            ratio = seconds / before
+            if ratio >= threshold:
+                result.append((phase, before, seconds, ratio))
+    return result
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+
+
+def read_report(filename):
+    with open(filename, 'r') as fd:
+        return json.load(fd)
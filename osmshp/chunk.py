@@ -0,0 +1,107 @@
+import math
+from collections import namedtuple
+
+# Partitioning of the intersection phase into chunks. Every function
+# yields SQL predicates over osm_* columns (osm_id, way), one per chunk.
+# Together the predicates of a single call cover every row exactly once.
+
+CHUNK_MODES = ('tile', 'range', 'modulo')
+
+ChunkPlan = namedtuple('ChunkPlan', (
+    'objtype', 'scope', 'region_filter', 'change_filter', 'estimate', 'filters'))
+
+
+def _num(value):
+    return repr(float(value))
+
+
+def candidate_sql(objtype, extent, filter, change_filter='true'):
+    """ Candidate rows of an intersection pass for planning: only bounding
+    box and tag filter, no geometry predicates """
+
+    cond = []
+    if objtype in ('point', 'line'):
+        cond.append('osm_id > 0')
+
+    if extent is not None and None not in extent:
+        cond.append('way && ST_MakeEnvelope(%s, %s, %s, %s, 4326)' % tuple(
+            _num(v) for v in extent))
+
+    cond.append(change_filter)
+    cond.append('(%s)' % filter)
+
+    return 'SELECT osm_id FROM osm_%s WHERE %s' % (objtype, ' AND '.join(cond))
+
+
+def chunk_count(estimate, chunk_size):
+    return max(1, int(math.ceil(float(estimate) / chunk_size)))
+
+
+def modulo_filter(chunk_no, chunk_count):
+    return '(osm_id %% %d = %d OR osm_id %% %d = -%d)' % (
+        chunk_count, chunk_no, chunk_count, chunk_no)
+
+
+def modulo_chunks(chunk_count):
+    """ Fallback mode: can't use any index, every chunk scans whole table """
+
+    for chunk_no in range(chunk_count):
+        yield modulo_filter(chunk_no, chunk_count)
+
+
+def range_chunks(chunk_count, id_min, id_max):
+    """ Contiguous osm_id ranges, read through osm_id index """
+
+    if id_min is None or id_max is None:
+        yield 'true'
+        return
+
+    chunk_count = max(1, min(chunk_count, id_max - id_min + 1))
+    bounds = [
+        id_min + (id_max - id_min + 1) * i // chunk_count
+        for i in range(chunk_count + 1)
+    ]
+
+    for i in range(chunk_count):
+        cond = []
+        if i > 0:
+            cond.append('osm_id >= %d' % bounds[i])
+        if i < chunk_count - 1:
+            cond.append('osm_id < %d' % bounds[i + 1])
+        yield '(%s)' % ' AND '.join(cond) if cond else 'true'
+
+
+def tile_chunks(chunk_count, extent):
+    """ Regular grid of tiles over extent, read through GiST index on way
+
+    Each object belongs to the tile containing the lower left corner of
+    its bounding box. Outer tiles are open towards the extent boundary, so
+    objects sticking out of the extent are assigned to them too. Every
+    object that overlaps the extent overlaps its own tile, which makes
+    `way && tile` a safe index condition. """
+
+    if extent is None or None in extent:
+        yield 'true'
+        return
+
+    xmin, ymin, xmax, ymax = extent
+    side = int(math.ceil(math.sqrt(max(1, chunk_count))))
+
+    xs = [_num(xmin + (xmax - xmin) * i / side) for i in range(side + 1)]
+    ys = [_num(ymin + (ymax - ymin) * i / side) for i in range(side + 1)]
+
+    for i in range(side):
+        for j in range(side):
+            cond = ['way && ST_MakeEnvelope(%s, %s, %s, %s, 4326)' % (
+                xs[i], ys[j], xs[i + 1], ys[j + 1])]
+
+            if i > 0:
+                cond.append('ST_XMin(way) >= %s' % xs[i])
+            if i < side - 1:
+                cond.append('ST_XMin(way) < %s' % xs[i + 1])
+            if j > 0:
+                cond.append('ST_YMin(way) >= %s' % ys[j])
+            if j < side - 1:
+                cond.append('ST_YMin(way) < %s' % ys[j + 1])
+
+            yield '(%s)' % ' AND '.join(cond)
@@ -0,0 +1,382 @@
+import os
+import os.path
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile
+from ConfigParser import RawConfigParser
+from shutil import copyfileobj
+import requests
+
+_logger = logging.getLogger(__name__)
+
+# Helpers shared by datasource drivers. Driver is a module with two
+# functions:
+#
+#   dump(version=None, options=None) -> (file, version)
+#   diff(from_version, options=None) -> (file, to_version) or None
+#
+# where file is a temporary file, deleted when closed. URLs can be either
+# http(s):// or file:// ones, the latter allow drivers to work with a local
+# mirror directory without network.
+
+CHUNK_SIZE = 1024 * 1024
+
+_RETRY_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def _local_path(url):
+    if url.startswith('file://'):
+        return url[len('file://'):]
+    return None
+
+
+def read_meta(url):
+    """ Parsed .meta file for url, None if it doesn't exist """
+
+    path = _local_path(url + '.meta')
+    if path is not None:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as fd:
+            content = fd.read()
+    else:
+        response = requests.get(url + '.meta', timeout=60)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        content = response.content
+
+    cfg = RawConfigParser()
+    cfg.readfp(StringIO(content))
+    return cfg
+
+
+def download(url, suffix='', size=None, retries=5):
+    """ Download url into temporary file, None if url doesn't exist.
+    Interrupted transfers are resumed with HTTP Range requests, size of
+    result is checked against given size or Content-Length. """
+
+    path = _local_path(url)
+    if path is not None and not os.path.exists(path):
+        return None
+
+    datafile = NamedTemporaryFile(suffix=suffix)
+    try:
+        result = _download(url, path, datafile, size, retries)
+    except:
+        # Partial file is deleted on close
+        datafile.close()
+        raise
+
+    if result is None:
+        datafile.close()
+    return result
+
+
+def _download(url, path, datafile, size, retries):
+    if path is not None:
+        with open(path, 'rb') as fd:
+            copyfileobj(fd, datafile, CHUNK_SIZE)
+
+    else:
+        attempt = 0
+
+        while True:
+            offset = datafile.tell()
+            headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+
+            try:
+                response = requests.get(url, stream=True, headers=headers, timeout=60)
+                if response.status_code == 404:
+                    return None
+
+                response.raise_for_status()
+
+                if offset > 0 and response.status_code != 206:
+                    # Server ignored range, start from scratch
+                    datafile.seek(0)
+                    datafile.truncate()
+
+                if size is None:
+                    if response.status_code == 206 and '/' in response.headers.get('content-range', ''):
+                        total = response.headers['content-range'].rsplit('/', 1)[1]
+                        if total != '*':
+                            size = int(total)
+                    elif 'content-length' in response.headers and response.status_code == 200:
+                        size = int(response.headers['content-length'])
+
+                for data in response.iter_content(CHUNK_SIZE):
+                    datafile.write(data)
+
+                if size is None or datafile.tell() >= size:
+                    break
+
+                raise requests.exceptions.ConnectionError(
+                    'Connection closed at %d of %d bytes' % (datafile.tell(), size))
+
+            except _RETRY_ERRORS as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+
+                _logger.warning(
+                    'Download of %s interrupted at %d bytes (%s), resuming...',
+                    url, datafile.tell(), e)
+
+    datafile.flush()
+
+    if size is not None and datafile.tell() != size:
+        raise IOError('Size of %s is %d bytes, expected %d' % (
+            url, datafile.tell(), size))
+
+    datafile.seek(0)
+
+    return datafile
+
+
+def _sha256(fileobj):
+    digest = hashlib.sha256()
+    for data in iter(lambda: fileobj.read(CHUNK_SIZE), ''):
+        digest.update(data)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+class Cache(object):
+    """ On-disk cache in front of datasource driver, has the driver
+    interface itself. Files are stored by SHA-256 of content and verified
+    on every hit, index maps (kind, region, format, version) keys to them.
+    Least recently used entries are evicted when total size exceeds budget.
+
+    Latest dump can be cached only if the driver has latest(options)
+    function returning its version. """
+
+    VERSION_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, driver, path, budget):
+        self.driver = driver
+        self.path = path
+        self.budget = budget
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _key(self, kind, options, version):
+        return '/'.join((
+            kind, options.get('region', ''), options.get(kind + '_format', ''),
+            version.strftime('%Y%m%d%H%M%S')))
+
+    def _filename(self, entry):
+        return os.path.join(self.path, entry['sha256'] + entry['suffix'])
+
+    def _read_index(self):
+        filename = os.path.join(self.path, 'index.json')
+        if not os.path.exists(filename):
+            return dict()
+
+        with open(filename, 'r') as fd:
+            return json.load(fd)
+
+    def _write_index(self, index):
+        filename = os.path.join(self.path, 'index.json')
+        with open(filename + '.tmp', 'w') as fd:
+            json.dump(index, fd, indent=2, sort_keys=True)
+        os.rename(filename + '.tmp', filename)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._read_index().get(key)
+
+        if entry is None:
+            return None
+
+        filename = self._filename(entry)
+        datafile = open(filename, 'rb') if os.path.exists(filename) else None
+
+        if datafile is None or _sha256(datafile) != entry['sha256']:
+            _logger.warning('Cache entry %s is missing or corrupted, discarding', key)
+            if datafile is not None:
+                datafile.close()
+                os.remove(filename)
+            with self._lock:
+                index = self._read_index()
+                index.pop(key, None)
+                self._write_index(index)
+            return None
+
+        with self._lock:
+            index = self._read_index()
+            if key in index:
+                index[key]['atime'] = time.time()
+                self._write_index(index)
+
+        _logger.info('Using cached %s', key)
+
+        version = datetime.strptime(entry['version'], self.VERSION_FORMAT)
+        return (datafile, version)
+
+    def _put(self, key, datafile, version):
+        basename = os.path.basename(datafile.name)
+        entry = dict(
+            sha256=_sha256(datafile),
+            suffix=basename[basename.index('.'):] if '.' in basename else '',
+            size=os.path.getsize(datafile.name),
+            version=version.strftime(self.VERSION_FORMAT),
+            atime=time.time())
+
+        filename = self._filename(entry)
+        if not os.path.exists(filename):
+            try:
+                with open(filename + '.tmp', 'wb') as fd:
+                    copyfileobj(datafile, fd, CHUNK_SIZE)
+            except:
+                if os.path.exists(filename + '.tmp'):
+                    os.remove(filename + '.tmp')
+                raise
+            datafile.seek(0)
+            os.rename(filename + '.tmp', filename)
+
+        with self._lock:
+            index = self._read_index()
+            index[key] = entry
+            self._evict(index, key)
+            self._write_index(index)
+
+    def _evict(self, index, keep):
+        sizes = dict((e['sha256'], e['size']) for e in index.itervalues())
+        total = sum(sizes.itervalues())
+
+        for key, entry in sorted(index.items(), key=lambda i: i[1]['atime']):
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+
+            del index[key]
+            if not any(e['sha256'] == entry['sha256'] for e in index.itervalues()):
+                _logger.info('Evicting %s from cache', key)
+                os.remove(self._filename(entry))
+                total -= entry['size']
+
+    def dump(self, version=None, options=None):
+        cached = version
+        if cached is None and hasattr(self.driver, 'latest'):
+            cached = self.driver.latest(options)
+
+        if cached is not None:
+            result = self._get(self._key('dump', options, cached))
+            if result is not None:
+                return result
+
+        result = self.driver.dump(version=version, options=options)
+        self._put(self._key('dump', options, result[1]), *result)
+        return result
+
+    def diff(self, from_version, options=None):
+        key = self._key('diff', options, from_version)
+
+        result = self._get(key)
+        if result is not None:
+            return result
+
+        result = self.driver.diff(from_version, options)
+        if result is not None:
+            self._put(key, *result)
+        return result
+
+
+class _Fetch(threading.Thread):
+
+    def __init__(self, func, *args):
+        super(_Fetch, self).__init__(name='prefetch')
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._discarded = False
+        self.start()
+
+    def run(self):
+        try:
+            value = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+            return
+
+        with self._lock:
+            self.value = value
+            discarded = self._discarded
+
+        if discarded:
+            self._close(value)
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def discard(self):
+        """ Delete fetched file, now or when fetch completes """
+
+        with self._lock:
+            self._discarded = True
+            value = self.value
+
+        self._close(value)
+
+    @staticmethod
+    def _close(value):
+        # Temporary files are deleted when closed
+        if value is not None:
+            value[0].close()
+
+
+class Prefetcher(object):
+    """ Datasource driver wrapper, after a diff is returned the next one
+    is downloaded in background thread while the current one is applied """
+
+    def __init__(self, driver, options, prefetch=True):
+        self.driver = driver
+        self.options = options
+        self.prefetch = prefetch
+        self._pending = None
+
+    def dump(self, version=None):
+        return self.driver.dump(version=version, options=self.options)
+
+    def diff(self, from_version):
+        pending, self._pending = self._pending, None
+
+        if pending is not None and pending.args[0] == from_version:
+            result = pending.result()
+        else:
+            if pending is not None:
+                pending.discard()
+            result = self.driver.diff(from_version, self.options)
+
+        if result is not None and self.prefetch:
+            self._pending = _Fetch(self.driver.diff, result[1], self.options)
+
+        return result
+
+    def close(self):
+        """ Discard pending prefetch. Download in progress is waited for,
+        daemon thread killed at exit would leave its file behind. """
+
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.join()
+            pending.discard()
@@ -0,0 +1,160 @@
+import sys
+import time
+import heapq
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+# Persistent pool of worker threads executing a DAG of statements. A
+# statement becomes ready when all statements listed in its deps (by key)
+# are completed. Ready statements are started in order of rank: own cost
+# plus the largest rank among statements depending on it, so long chains
+# and huge chunks start first and don't end up running alone at the end.
+
+
+class _Job(object):
+
+    __slots__ = ('no', 'statement', 'children', 'waiting', 'rank', 'result')
+
+    def __init__(self, no, statement):
+        self.no = no
+        self.statement = statement
+        self.children = []
+        self.waiting = 0
+        self.rank = None
+        self.result = None
+
+
+def _rank(job):
+    if job.rank is None:
+        # Marker for cycle detection while children are being ranked
+        job.rank = False
+        job.rank = job.statement.cost + max(
+            [_rank(c) for c in job.children] + [0, ])
+    elif job.rank is False:
+        raise ValueError("Dependency cycle at statement '%s'" % job.statement.key)
+
+    return job.rank
+
+
+class Executor(object):
+
+    def __init__(self, worker_count, func):
+        self.worker_count = worker_count
+        self.func = func
+
+        self._cond = threading.Condition()
+        self._ready = []
+        self._running = 0
+        self._remaining = 0
+        self._error = None
+
+        self._run_start = None
+        self._run_busy = 0.0
+
+        self._threads = []
+        for i in range(worker_count):
+            thread = threading.Thread(target=self._worker, name='Executor-%d' % (i + 1))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+
+                (rank, no, job) = heapq.heappop(self._ready)
+                self._running += 1
+
+            start = time.time()
+            try:
+                result = self.func(job.statement)
+                error = None
+            except Exception:
+                error = sys.exc_info()
+                _logger.error(
+                    "Statement '%s' failed: %s", job.statement.key,
+                    error[1], exc_info=error)
+            elapsed = time.time() - start
+
+            with self._cond:
+                self._running -= 1
+                self._remaining -= 1
+                self._run_busy += elapsed
+
+                if error is not None:
+                    if self._error is None:
+                        self._error = error
+                    # Nothing else is started after a failure
+                    del self._ready[:]
+
+                else:
+                    job.result = result
+                    for child in job.children:
+                        child.waiting -= 1
+                        if child.waiting == 0 and self._error is None:
+                            heapq.heappush(self._ready, (-child.rank, child.no, child))
+
+                self._cond.notify_all()
+
+    def stats(self):
+        """ Queue depth and worker utilization of the current (or last) run """
+
+        with self._cond:
+            elapsed = time.time() - self._run_start if self._run_start else 0.0
+            return dict(
+                workers=self.worker_count,
+                running=self._running,
+                queued=len(self._ready),
+                waiting=self._remaining - self._running - len(self._ready),
+                utilization=self._run_busy / (elapsed * self.worker_count) if elapsed > 0 else 0.0
+            )
+
+    def run(self, statements):
+        """ Execute statements and return their results in the same order """
+
+        jobs = [_Job(no, st) for no, st in enumerate(statements)]
+
+        keys = dict()
+        for job in jobs:
+            if job.statement.key is not None:
+                keys[job.statement.key] = job
+
+        for job in jobs:
+            for dep in job.statement.deps:
+                # Dependencies outside of this run are considered completed
+                if dep in keys:
+                    keys[dep].children.append(job)
+                    job.waiting += 1
+
+        for job in jobs:
+            _rank(job)
+
+        with self._cond:
+            if self._remaining > 0:
+                raise RuntimeError("Executor is already running")
+
+            self._remaining = len(jobs)
+            self._error = None
+            self._run_start = time.time()
+            self._run_busy = 0.0
+
+            for job in jobs:
+                if job.waiting == 0:
+                    heapq.heappush(self._ready, (-job.rank, job.no, job))
+            self._cond.notify_all()
+
+            while self._remaining > 0 and not (self._error and self._running == 0):
+                # Timeout keeps main thread responsive to KeyboardInterrupt
+                self._cond.wait(1)
+
+            error = self._error
+            self._remaining = 0
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+        return [job.result for job in jobs]
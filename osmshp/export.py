@@ -0,0 +1,332 @@
+import os
+import os.path
+import shutil
+import json
+import subprocess
+import logging
+from multiprocessing import Pool
+from xml.etree.ElementTree import ElementTree
+
+import psycopg2
+
+from . import shapefile
+from .util import connection_params
+
+_logger = logging.getLogger(__name__)
+
+# Export pipeline. Layer dumps and region compression are executed in
+# separate process pools: dumps hold database connections, so their pool
+# is capped by export.connections, while compression is CPU bound and
+# uses export.workers processes. Compression of a region starts as soon
+# as all its layers are dumped, overlapping with dumps of other regions.
+#
+# Tasks are plain dicts, so they can be passed to worker processes, and
+# workers never change current directory.
+#
+# Every archive has a JSON manifest next to it with per-layer fingerprints
+# (layer_version ts, row count and content hash) and a fingerprint of extra
+# files (readme, QGIS projects, include_dirs). Unchanged layers are
+# extracted from the previous archive instead of being dumped, a region
+# without changes just gets its previous archive linked under the new name.
+
+
+# DBF field definitions for non-character PostgreSQL types. Numeric
+# fields overflowing their width are rejected by shapefile.Field, except
+# that fractional digits of real numbers are dropped to make them fit.
+_FIELD_TYPES = {
+    'smallint': ('N', 6, 0),
+    'integer': ('N', 11, 0),
+    'bigint': ('N', 20, 0),
+    'real': ('N', 24, 15),
+    'double precision': ('N', 24, 15),
+    'numeric': ('N', 24, 15),
+    'boolean': ('L', 1, 0),
+    'date': ('D', 8, 0),
+    # dBase has no date-time type, ISO 8601 text is used instead
+    'timestamp without time zone': ('C', 19, 0),
+    'timestamp with time zone': ('C', 20, 0),
+}
+
+# Column expressions for types converted on the server
+_FIELD_EXPRS = {
+    'timestamp without time zone': """to_char(%s, 'YYYY-MM-DD"T"HH24:MI:SS')""",
+    'timestamp with time zone': """to_char(%s AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"')""",
+}
+
+# Types exported as character fields as wide as the longest value
+_CHAR_TYPES = ('text', 'character varying', 'character')
+
+
+def _field_type(column, data_type, precision, scale):
+    """ DBF type, size and decimal count of column with fixed size """
+
+    if data_type == 'numeric' and precision is not None:
+        # Sign, integer digits, decimal point and fractional digits
+        size = 1 + max(precision - scale, 1) + (scale + 1 if scale else 0)
+        if size > 254:
+            raise ValueError("Column %s of type numeric(%d, %d) is too wide for DBF" % (
+                column, precision, scale))
+        return ('N', size, scale)
+
+    return _FIELD_TYPES[data_type]
+
+
+def dump_table(connection, schema, table, filename, layer_type, qix=False, widths=None):
+    """ Stream table into shapefile through server side cursor, widths
+    of character fields are taken from widths by column name """
+
+    qtable = '%s."%s"' % (schema, table)
+
+    cur = connection.cursor()
+    cur.execute("""SELECT column_name, data_type, numeric_precision, numeric_scale
+                FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s AND column_name <> 'geom'
+                ORDER BY ordinal_position""", (schema, table))
+    columns = cur.fetchall()
+
+    for (column, data_type, precision, scale) in columns:
+        if data_type not in _FIELD_TYPES and data_type not in _CHAR_TYPES:
+            raise ValueError("Column %s of %s has type %s unsupported by DBF" % (
+                column, qtable, data_type))
+
+    # Character fields are as wide as the longest value in bytes, which
+    # layer build records. Tables built before that are measured here.
+    char_columns = [c for (c, t, p, s) in columns if t in _CHAR_TYPES]
+    if widths is None and char_columns:
+        cur.execute('SELECT %s FROM %s' % (', '.join([
+            'MAX(octet_length("%s"::text))' % c for c in char_columns
+        ]), qtable))
+        widths = dict(zip(char_columns, cur.fetchone()))
+
+    fields = []
+    names = shapefile.unique_names([c for (c, t, p, s) in columns])
+    for (column, data_type, precision, scale), name in zip(columns, names):
+        if data_type in _FIELD_TYPES:
+            fields.append(shapefile.Field(
+                name, *_field_type(column, data_type, precision, scale)))
+        else:
+            fields.append(shapefile.Field(
+                name, 'C', min(254, max(1, (widths or {}).get(column) or 1))))
+
+    cur.execute("SELECT srtext FROM spatial_ref_sys WHERE srid = 4326")
+    row = cur.fetchone()
+    if row is not None:
+        with open(filename + '.prj', 'w') as fd:
+            fd.write(row[0])
+
+    if layer_type == 'polygon':
+        # Shapefile exterior rings are clockwise
+        geom = 'ST_AsBinary(ST_ForceRHR(geom))'
+    else:
+        geom = 'ST_AsBinary(geom)'
+
+    cur = connection.cursor(name='dump_table')
+    cur.itersize = 5000
+    cur.execute('SELECT %s FROM %s' % (
+        ', '.join([geom, ] + [
+            _FIELD_EXPRS.get(t, '%s') % ('"%s"' % c) for (c, t, p, s) in columns
+        ]), qtable))
+
+    writer = shapefile.Writer(
+        filename, shapefile.SHAPE_TYPES[layer_type], fields, qix=qix)
+
+    try:
+        for row in cur:
+            writer.write(row[0], row[1:])
+    finally:
+        writer.close()
+        cur.close()
+
+
+def dump_layer(task):
+    """ Dump region layer into shapefile """
+
+    _logger.info('Layer [%s %s]: exporting %d features...', task['region'], task['layer'], task['feature_count'])
+
+    connection = psycopg2.connect(**connection_params(task['database']))
+    try:
+        cur = connection.cursor()
+        for name, value in task['session']:
+            cur.execute("SET %s TO %%s" % name, (value, ))
+
+        dump_table(
+            connection, 'layer', '%s %s' % (task['region'], task['layer']),
+            task['filename'], task['type'], qix=task['export']['qix'],
+            widths=task.get('widths'))
+    finally:
+        connection.close()
+
+    return task['region']
+
+
+def manifest_name(archive):
+    return os.path.splitext(archive)[0] + '.json'
+
+
+def read_manifest(archive):
+    """ Layer fingerprints stored alongside archive, None if missing """
+
+    filename = manifest_name(archive)
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def extras_fingerprint(export):
+    """ Modification time and size of readme, QGIS project templates and
+    files of include_dirs by path, added to every archive """
+
+    paths = []
+    if 'readme' in export:
+        paths.append(export['readme'])
+    paths.extend(export.get('qgis_projects', []))
+    for idir in export.get('include_dirs', []):
+        for dirpath, dirnames, filenames in os.walk(idir):
+            paths.extend([os.path.join(dirpath, f) for f in filenames])
+
+    result = dict()
+    for path in paths:
+        st = os.stat(path)
+        result[path] = [st.st_mtime, st.st_size]
+    return result
+
+
+def _symlink(source, link_name):
+    if os.path.lexists(link_name):
+        os.remove(link_name)
+    os.symlink(source, link_name)
+
+
+def compress_region(task):
+    """ Add readme and QGIS projects to region directory and compress it """
+
+    export = task['export']
+    current_name = task['current_name']
+    latest_name = task['latest_name']
+
+    devnull = open(os.devnull, 'w')
+
+    for path in (os.path.split(current_name)[0], os.path.split(latest_name)[0]):
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Created concurrently by another worker
+                if not os.path.isdir(path):
+                    raise
+
+    if task['relink']:
+        # Nothing changed, previous archive is published under new name
+        if os.path.realpath(task['previous']) != os.path.realpath(current_name):
+            _logger.info('Region [%s]: linking %s...', task['region'], task['previous'])
+            if os.path.lexists(current_name):
+                os.remove(current_name)
+            try:
+                os.link(task['previous'], current_name)
+            except OSError:
+                shutil.copy(task['previous'], current_name)
+
+    else:
+        tmpdir = task['tmpdir']
+        files = list(task['files'])
+
+        if task['reuse']:
+            _logger.info('Region [%s]: reusing %d unchanged layers...', task['region'], len(task['reuse']))
+            subprocess.check_call(
+                [export['7z'], 'x', '-y', '-o' + tmpdir, task['previous']]
+                + ['data/%s.*' % l for l in task['reuse']],
+                stdout=devnull, stderr=devnull)
+
+        if 'readme' in export:
+            readme = os.path.split(export['readme'])[1]
+            shutil.copy(export['readme'], os.path.join(tmpdir, readme))
+            files.append(readme)
+
+        # qgis projects
+        if 'qgis_projects' in export:
+            _logger.info('Region [%s]: building QGIS projects...', task['region'])
+
+            (xmin, xmax, ymin, ymax) = task['extent']
+
+            for proj_template in export['qgis_projects']:
+                et = ElementTree()
+                et.parse(proj_template)
+
+                et.find('mapcanvas/extent/xmin').text = str(xmin)
+                et.find('mapcanvas/extent/xmax').text = str(xmax)
+                et.find('mapcanvas/extent/ymin').text = str(ymin)
+                et.find('mapcanvas/extent/ymax').text = str(ymax)
+
+                target_file = os.path.join(tmpdir, os.path.split(proj_template)[1])
+                et.write(target_file)
+                files.append(os.path.split(proj_template)[1])
+
+            # include_dirs
+            if 'include_dirs' in export:
+                _logger.info('Region [%s]: copying include_dirs...', task['region'])
+                for idir in export['include_dirs']:
+                    shutil.copytree(idir, os.path.join(tmpdir, os.path.split(idir)[1]))
+                    files.append(os.path.split(idir)[1])
+
+        _logger.info('Region [%s]: compressing...', task['region'])
+
+        subprocess.check_call(
+            [export['7z'], 'a', current_name] + files,
+            cwd=tmpdir, stdout=devnull, stderr=devnull)
+
+        shutil.rmtree(tmpdir)
+
+    with open(manifest_name(current_name), 'w') as fd:
+        json.dump(task['manifest'], fd, indent=2, sort_keys=True)
+
+    _symlink(current_name, latest_name)
+    _symlink(manifest_name(current_name), manifest_name(latest_name))
+
+    _logger.info('Region [%s]: export completed', task['region'])
+
+    return task['region']
+
+
+def export_regions(regions, layers, workers, connections):
+    """ Run layer dumps and region compression concurrently
+
+    regions -- list of compress_region tasks
+    layers -- list of dump_layer tasks """
+
+    dump_pool = Pool(processes=max(1, min(workers, connections)))
+    compress_pool = Pool(processes=max(1, workers))
+
+    try:
+        tasks = dict((r['region'], r) for r in regions)
+        pending = dict((r['region'], 0) for r in regions)
+        for l in layers:
+            pending[l['region']] += 1
+
+        compressions = [
+            compress_pool.apply_async(compress_region, (tasks[code], ))
+            for code, count in pending.iteritems() if count == 0
+        ]
+
+        for code in dump_pool.imap_unordered(dump_layer, layers):
+            pending[code] -= 1
+            if pending[code] == 0:
+                compressions.append(compress_pool.apply_async(
+                    compress_region, (tasks[code], )))
+
+        for result in compressions:
+            result.get()
+
+    except Exception:
+        dump_pool.terminate()
+        compress_pool.terminate()
+        raise
+
+    else:
+        dump_pool.close()
+        compress_pool.close()
+
+    finally:
+        dump_pool.join()
+        compress_pool.join()
@@ -1,39 +1,55 @@
 from datetime import datetime, timedelta
-from StringIO import StringIO
-from tempfile import NamedTemporaryFile
-from ConfigParser import RawConfigParser
-from shutil import copyfileobj
-import requests
 
+from .datasource import download, read_meta
 
-def dump(version=None, options=None):
+VERSION_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _meta_size(cfg):
+    if cfg is not None and cfg.has_option('DEFAULT', 'size'):
+        return cfg.getint('DEFAULT', 'size')
+    return None
+
+
+def _dump_url(version, options):
     region = options['region']
     format = options['dump_format']
 
     if version is None:
-        url = '/'.join((
+        return '/'.join((
             options['url'], 'dump', 'latest',
             region + '.' + format
         ))
     else:
-        url = '/'.join((
+        return '/'.join((
             options['url'], 'dump', region,
             region + '-' + version.strftime('%y%m%d') + '.' + format
         ))
 
-    print 'Load from: ' + url
-    data = requests.get(url, stream=True)
-    metadata = requests.get(url + '.meta')
 
-    datafile = NamedTemporaryFile(suffix='.' + format)
-    copyfileobj(data.raw, datafile)
-    datafile.flush()
-    datafile.seek(0)
+def latest(options=None):
+    """ Version of the latest dump """
+
+    cfg = read_meta(_dump_url(None, options))
+    if cfg is None:
+        return None
+
+    return datetime.strptime(cfg.get('DEFAULT', 'version'), VERSION_FORMAT)
+
+
+def dump(version=None, options=None):
+    format = options['dump_format']
+    url = _dump_url(version, options)
+
+    print 'Load from: ' + url
+    cfg = read_meta(url)
+    if cfg is None:
+        raise IOError('Metadata for %s not found' % url)
 
-    VERSION_FORMAT = '%Y-%m-%d %H:%M:%S'
+    datafile = download(url, suffix='.' + format, size=_meta_size(cfg))
+    if datafile is None:
+        raise IOError('Dump %s not found' % url)
 
-    cfg = RawConfigParser()
-    cfg.readfp(StringIO(metadata.content))
     version = datetime.strptime(cfg.get('DEFAULT', 'version'), VERSION_FORMAT)
 
     return (datafile, version)
@@ -51,14 +67,9 @@ def diff(from_version, options=None):
         + '.' + format
     ))
 
-    data = requests.get(url, stream=True)
+    datafile = download(url, suffix='.' + format, size=_meta_size(read_meta(url)))
 
-    if data.status_code == 404:
+    if datafile is None:
         return None
     else:
-        datafile = NamedTemporaryFile(suffix='.' + format)
-        copyfileobj(data.raw, datafile)
-        datafile.flush()
-        datafile.seek(0)
-
         return (datafile, to_version)
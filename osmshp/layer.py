@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import re
 
@@ -40,7 +41,10 @@ class Layer:
             for cname, cdef in yaml['classification'].iteritems():
                 self.classification[cname] = Classification(cname, cdef)
 
-    def sql_source(self, expand_tags):
+    def sql_source(self, expand_tags, member=None):
+        """ Objects of layer, with member number of the layer in
+        obj_membership is used instead of evaluating filter """
+
         tabfilter = []
 
         if self.type == 'line':
@@ -52,6 +56,19 @@ class Layer:
         if len(tabfilter) == 0:
             tabfilter = ['true', ]
 
+        if member is not None:
+            return dedent("""
+                SELECT '%(type)s'::plp_enum AS tab, * FROM osm_%(type)s src
+                WHERE %(tabfilter)s AND EXISTS(
+                  SELECT * FROM obj_membership m
+                  WHERE m.tab = '%(type)s'::plp_enum AND m.osm_id = src.osm_id
+                    AND m.ver = src.ver AND %(member)d = ANY(m.layers)
+                ) """) % dict(
+                type=self.type,
+                member=member,
+                tabfilter=' AND '.join(tabfilter)
+            )
+
         return dedent("""
             SELECT '%(type)s'::plp_enum AS tab, * FROM osm_%(type)s
             WHERE %(tabfilter)s AND (
@@ -62,7 +79,44 @@ class Layer:
             tabfilter=' AND '.join(tabfilter)
         )
 
-    def sql_stat(self, expand_tags):
+    def sql_member(self, expand_tags, member):
+        """ Layer number if object matches filter, NULL otherwise """
+
+        return "CASE WHEN (%s) THEN %d END" % (expand_tags(self.filter), member)
+
+    def sql_categories(self, expand_tags, member):
+        """ Rows of (layer number, criteria, criteria matched, category)
+        for obj_category, category is NULL if no class matched """
+
+        rows = []
+        for cname in sorted(self.classification):
+            criteria = self.classification[cname]
+            class_case = ' '.join([
+                "WHEN %s THEN '%s'" % (expand_tags(cls.filter), cls.id)
+                for cls in criteria.classes
+            ])
+            rows.append("(%d, '%s', (%s), %s)" % (
+                member, cname, expand_tags(criteria.filter),
+                'CASE %s END' % class_case if class_case else 'NULL::text'))
+        return rows
+
+    def stat_definition_hash(self, expand_tags):
+        definition = [self.type, expand_tags(self.filter)]
+        for cname in sorted(self.classification):
+            criteria = self.classification[cname]
+            definition.append('%s: %s' % (cname, expand_tags(criteria.filter)))
+            definition.extend([
+                '  %s: %s' % (cls.id, expand_tags(cls.filter))
+                for cls in criteria.classes
+            ])
+        return hashlib.md5('\n'.join(definition).encode('utf-8')).hexdigest()
+
+    def _stat_items(self, expand_tags, member=None):
+        """ Parameters and template of statement inserting per-object
+        contributions to statistics into tmp_stat_item, regions are
+        substituted by caller. With changed join the statement is driven
+        from set of changed objects instead of whole regions. """
+
         criteria_join = []
         criteria_class = []
 
@@ -82,90 +136,256 @@ class Layer:
                   %s
                 END """) % (cname, '\n  '.join(class_case)))
 
+        item_f = []
+        if self.type in ('line', 'polygon'):
+            item_f.extend(['ck.f_points', 'ck.f_length'])
+        else:
+            item_f.extend(['NULL::int AS f_points', 'NULL::float AS f_length'])
+
+        if self.type in ('polygon', ):
+            item_f.append('ck.f_area')
+        else:
+            item_f.append('NULL::float AS f_area')
+
         params = {
             'layer': self,
             'criteria_list': ', '.join(
                 ['NULL', ] + ["'%s'" % cname for cname in self.classification]
             ),
-            'criteria_join': indent('\n'.join(criteria_join), 3),
-            'criteria_class': indent('\n'.join(criteria_class), 4),
-            'filter': expand_tags(self.filter),
-            'source': indent(self.sql_source(expand_tags), 3)
+            'criteria_join': indent('\n'.join(criteria_join), 4),
+            'criteria_class': indent('\n'.join(criteria_class), 3),
+            'item_f': ', '.join(item_f),
+            'source': indent(self.sql_source(expand_tags, member=member), 3),
+            'changed': '',
+            'changed_on': '',
         }
 
-        agg = ['COUNT(osm_id) AS f_count', ]
-        agg_f = ['src.osm_id', ]
-
-        if self.type in ('line', 'polygon'):
-            agg.extend([
-                'SUM(f_points) AS f_points',
-                'SUM(f_length) AS f_length'
-            ])
-            agg_f.extend(['f_points', 'f_length'])
+        if member is not None:
+            params['category'] = "classification.category"
+            params['classification'] = dedent("""
+                INNER JOIN LATERAL (
+                  SELECT NULL::text AS criteria, NULL::text AS category
+                  UNION ALL
+                  SELECT oc.criteria, oc.category FROM obj_category oc
+                  WHERE oc.tab = src.tab AND oc.osm_id = src.osm_id
+                    AND oc.ver = src.ver AND oc.layer_no = %d
+                ) classification ON true""") % member
         else:
-            agg.extend(['NULL AS f_points', 'NULL AS f_length'])
-
-        if self.type in ('polygon', ):
-            agg.append('SUM(f_area) AS f_area')
-            agg_f.append('f_area')
-        else:
-            agg.append('NULL AS f_area')
+            params['category'] = dedent("""
+                CASE
+                  WHEN criteria IS NULL THEN NULL
+                  {criteria_class}
+                END""").format(**params)
+            params['classification'] = dedent("""
+                LEFT JOIN
+                  (SELECT unnest(ARRAY[{criteria_list}]) AS criteria)
+                  classification ON (criteria IS NULL)
+                    {criteria_join}""").format(**params)
 
-        params['agg'] = indent(', \n'.join(agg), 1)
-        params['agg_f'] = indent(', '.join(agg_f), 2)
+        params['category'] = indent(params['category'], 1)
+        params['classification'] = indent(params['classification'], 1)
 
-        return dedent("""
+        items = dedent("""
+            INSERT INTO tmp_stat_item
+            SELECT 1, region.id, '{layer.id}'::text, src.osm_id,
+              COALESCE(criteria, '') AS criteria,
+              COALESCE({category}, '') AS category,
+              {item_f}
+            FROM
+              (SELECT id, geom FROM region WHERE id IN ({regions})) region{changed}
+              INNER JOIN (
+                {source}
+              ) src ON {changed_on}region.geom && src.way AND EXISTS(
+                SELECT * FROM region_part rp
+                WHERE rp.region_id = region.id AND rp.kind = 'geom'
+                  AND rp.geom && src.way)
+              {classification}
+              INNER JOIN intersection_{layer.type} ck ON
+                  region.id = ck.region_id
+                AND ck.region_id IN ({regions})
+                AND src.tab = ck.tab
+                AND src.osm_id = ck.osm_id
+                AND src.ver = ck.ver
+                AND ck.intersects""")
+
+        return params, items
+
+    def sql_stat(self, expand_tags, full_regions, delta_regions,
+                 definition=None, region_hashes=None, member=None):
+        """ Per-object contributions to statistics are kept in
+        layer_stat_item. For delta_regions new statistics are previous
+        ones plus contributions of objects changed since then minus
+        contributions they replaced, for full_regions items and
+        statistics are computed from scratch. With member number
+        classification is taken from obj_category. """
+
+        params, items = self._stat_items(expand_tags, member=member)
+        params.update({
+            'full': ', '.join(str(r) for r in full_regions) or 'NULL',
+            'delta': ', '.join(str(r) for r in delta_regions) or 'NULL',
+            'definition': "'%s'" % definition if definition else 'NULL',
+            'state': ', '.join([
+                "(%d, %s)" % (r, "'%s'" % region_hashes[r]
+                              if region_hashes and r in region_hashes else 'NULL')
+                for r in list(full_regions) + list(delta_regions)
+            ]),
+        })
+
+        sql = [dedent("""
             /* {layer.id} */
-            DROP TABLE IF EXISTS tmp_layer_stat;
+            DROP TABLE IF EXISTS tmp_stat_item, tmp_layer_stat;
+
+            CREATE TEMP TABLE tmp_stat_item AS
+            SELECT 1 AS sign, * FROM layer_stat_item LIMIT 0;""").format(**params)]
+
+        if delta_regions:
+            sql.append(dedent("""
+                /* Objects changed since statistics of region were computed
+                   are in stat_changed, built by update-stat-changed */
+                INSERT INTO tmp_stat_item
+                SELECT -1, i.*
+                FROM stat_changed c
+                  INNER JOIN layer_stat_item i ON i.layer_id = '{layer.id}'
+                    AND i.region_id = c.region_id AND i.osm_id = c.osm_id
+                WHERE c.tab = '{layer.type}'::plp_enum AND c.region_id IN ({delta});
+
+                DELETE FROM layer_stat_item i
+                USING stat_changed c
+                WHERE i.layer_id = '{layer.id}'
+                  AND i.region_id = c.region_id AND i.osm_id = c.osm_id
+                  AND c.tab = '{layer.type}'::plp_enum AND c.region_id IN ({delta});""").format(**params))
+
+            sql.append(items.format(**dict(
+                params, regions=params['delta'],
+                changed=indent('\n' + dedent("""
+                    INNER JOIN stat_changed c ON c.region_id = region.id
+                      AND c.tab = '{layer.type}'::plp_enum""").format(**params), 1),
+                changed_on='c.osm_id = src.osm_id AND ')) + ';')
+
+        if full_regions:
+            sql.append(dedent("""
+                DELETE FROM layer_stat_item
+                WHERE layer_id = '{layer.id}' AND region_id IN ({full});""").format(**params))
+
+            sql.append(items.format(regions=params['full'], **params) + ';')
 
-            CREATE TEMP TABLE tmp_layer_stat AS
-            SELECT * FROM layer_stat LIMIT 0;
+        sql.append(dedent("""
+            INSERT INTO layer_stat_item
+            SELECT region_id, layer_id, osm_id, criteria, category, f_points, f_length, f_area
+            FROM tmp_stat_item WHERE sign > 0;
 
-            INSERT INTO tmp_layer_stat
-            SELECT region_id, layer,
+            /* Previous aggregates of delta regions with contributions of
+               changed objects added and replaced ones subtracted */
+            CREATE TEMP TABLE tmp_layer_stat AS
+            SELECT region_id, '{layer.id}'::text AS layer_id,
               (SELECT ts FROM dump_version LIMIT 1) AS ts,
-              criteria, cls,
-              {agg}
+              criterion, category,
+              SUM(f_count)::int AS f_count,
+              SUM(f_points)::int AS f_points,
+              SUM(f_length) AS f_length,
+              SUM(f_area) AS f_area
             FROM (
-              SELECT
-                region_id,
-                '{layer.id}'::text AS layer,
-                COALESCE(criteria, '') AS criteria,
-                COALESCE(CASE
-                  WHEN criteria IS NULL THEN NULL
-                  {criteria_class}
-                END, '') AS cls,
-                {agg_f}
-              FROM
-                (SELECT id, geom FROM region) region
-                INNER JOIN (
-                  {source}
-                ) src ON region.geom && src.way
-                LEFT JOIN
-                  (SELECT unnest(ARRAY[{criteria_list}]) AS criteria)
-                  classification ON (criteria IS NULL)
-                    {criteria_join}
-                INNER JOIN intersection_{layer.type} ck ON
-                    region.id = ck.region_id
-                  AND src.tab = ck.tab
-                  AND src.osm_id = ck.osm_id
-                  AND src.ver = ck.ver
-                  AND ck.intersects
+              SELECT st.region_id, st.criterion, st.category,
+                st.f_count, st.f_points, st.f_length, st.f_area
+              FROM layer_stat st
+                INNER JOIN layer_stat_state s ON st.region_id = s.region_id
+                  AND st.layer_id = s.layer_id AND st.ts = s.ts
+              WHERE s.layer_id = '{layer.id}' AND s.region_id IN ({delta})
+              UNION ALL
+              SELECT region_id, criteria, category,
+                sign, sign * f_points, sign * f_length, sign * f_area
+              FROM tmp_stat_item
             ) sub
-            GROUP BY region_id, layer, criteria, cls;
+            GROUP BY region_id, criterion, category
+            HAVING SUM(f_count) > 0;
 
             DELETE FROM layer_stat
             WHERE ts = (SELECT ts FROM dump_version LIMIT 1)
               AND layer_id = '{layer.id}'
-              AND EXISTS(
-                SELECT * FROM region
-                WHERE layer_stat.region_id = region.id
-            );
+              AND region_id IN ({full}, {delta});
 
             INSERT INTO layer_stat
-            SELECT * FROM tmp_layer_stat; """).format(**params)
+            SELECT * FROM tmp_layer_stat;
+
+            DELETE FROM layer_stat_state
+            WHERE layer_id = '{layer.id}' AND region_id IN ({full}, {delta});
+
+            INSERT INTO layer_stat_state (region_id, layer_id, ts, definition, region_hash)
+            SELECT st.region_id, '{layer.id}', ts, {definition}, st.region_hash
+            FROM (VALUES {state}) AS st (region_id, region_hash), dump_version; """).format(**params))
+
+        return '\n\n'.join(sql) + '\n\n'
+
+    def sql_stat_verify(self, expand_tags, regions, member=None):
+        """ Statistics of regions computed from scratch and compared with
+        stored incremental ones, differences are left in tmp_stat_verify.
+        Counts are compared exactly, length and area with relative
+        tolerance. layer_stat_item and layer_stat aren't modified. """
+
+        params, items = self._stat_items(expand_tags, member=member)
+        params['regions'] = ', '.join(str(r) for r in regions) or 'NULL'
+
+        sql = [dedent("""
+            /* {layer.id} */
+            DROP TABLE IF EXISTS tmp_stat_item, tmp_stat_verify;
+
+            CREATE TEMP TABLE tmp_stat_item AS
+            SELECT 1 AS sign, * FROM layer_stat_item LIMIT 0;""").format(**params)]
+
+        sql.append(items.format(**params) + ';')
+
+        sql.append(dedent("""
+            CREATE TEMP TABLE tmp_stat_verify AS
+            SELECT region_id, criterion, category,
+              st.f_count AS stored_count, c.f_count AS computed_count,
+              st.f_points AS stored_points, c.f_points AS computed_points,
+              st.f_length AS stored_length, c.f_length AS computed_length,
+              st.f_area AS stored_area, c.f_area AS computed_area
+            FROM (
+              SELECT region_id, criteria AS criterion, category,
+                COUNT(*)::int AS f_count,
+                SUM(f_points)::int AS f_points,
+                SUM(f_length) AS f_length,
+                SUM(f_area) AS f_area
+              FROM tmp_stat_item
+              GROUP BY region_id, criteria, category
+            ) c
+            FULL JOIN (
+              SELECT st.region_id, st.criterion, st.category,
+                st.f_count, st.f_points, st.f_length, st.f_area
+              FROM layer_stat st
+                INNER JOIN layer_stat_state s ON st.region_id = s.region_id
+                  AND st.layer_id = s.layer_id AND st.ts = s.ts
+              WHERE s.layer_id = '{layer.id}' AND s.region_id IN ({regions})
+            ) st USING (region_id, criterion, category)
+            WHERE st.f_count IS DISTINCT FROM c.f_count
+              OR st.f_points IS DISTINCT FROM c.f_points
+              OR abs(COALESCE(st.f_length, 0) - COALESCE(c.f_length, 0))
+                > 1e-6 * GREATEST(abs(st.f_length), abs(c.f_length), 1)
+              OR abs(COALESCE(st.f_area, 0) - COALESCE(c.f_area, 0))
+                > 1e-6 * GREATEST(abs(st.f_area), abs(c.f_area), 1); """).format(**params))
+
+        return '\n\n'.join(sql) + '\n\n'
+
+    def definition_hash(self, expand_tags):
+        definition = [self.type, expand_tags(self.filter)] + [
+            '%s AS "%s"' % (expand_tags(f.definition), f.name)
+            for f in self.fields
+        ]
+        return hashlib.md5('\n'.join(definition).encode('utf-8')).hexdigest()
+
+    def sql_update_layer(self, region, expand_tags, drop=True, delta=False,
+                         definition=None, region_hash=None, member=None):
+        """ With delta=True only objects with obj_version changed since
+        layer_version.ts are deleted and inserted again, otherwise the
+        layer table is recreated from scratch. Largest octet length of every
+        field is taken from inserted rows and kept in layer_version.widths
+        for export, in delta mode widths only grow.
+
+        Row count and content hash are maintained from deleted and inserted
+        rows too. Content hash is the sum of 64-bit row hashes modulo 2^64,
+        so it doesn't depend on row order and the table isn't read again. """
 
-    def sql_update_layer(self, region, expand_tags, drop=True):
         sql = ['/* %s %s */' % (region.code, self.id)]
 
         params = {
@@ -179,61 +399,145 @@ class Layer:
             'field_names': ', '.join([
                 '"%s"' % f.name for f in self.fields
             ]) + ', ',
+            'returning': ', '.join(['osm_id', ] + [
+                '"%s"' % f.name for f in self.fields
+            ]),
+            'row_hash': "('x' || substr(md5(l::text), 1, 16))::bit(64)::bigint",
+            'widths': ',\n    '.join([
+                "('%s', octet_length(ins.\"%s\"::text))" % (f.name, f.name)
+                for f in self.fields
+            ] or ['(NULL::text, NULL::int)', ]),
             'geom_type': {
                 'point': 'POINT',
                 'line': 'MULTILINESTRING',
                 'polygon': 'MULTIPOLYGON'
             }[self.type],
-            'source': indent(self.sql_source(expand_tags), 3),
-            'force_multi': '' if self.type == 'point' else 'ST_Multi'
+            'source': indent(self.sql_source(expand_tags, member=member), 3),
+            'force_multi': '' if self.type == 'point' else 'ST_Multi',
+            'definition': "'%s'" % definition if definition else 'NULL',
+            'region_hash': "'%s'" % region_hash if region_hash else 'NULL',
+            'changed': indent(dedent("""
+                SELECT v.osm_id FROM obj_version v
+                  INNER JOIN layer_version lv ON v.ts > lv.ts
+                WHERE v.tab = '{layer.type}'::plp_enum
+                  AND lv.region_id = {region.id}
+                  AND lv.layer_id = '{layer.id}' """).format(
+                layer=self, region=region), 2)
         }
 
-        if drop:
-            sql.append("DROP TABLE IF EXISTS layer.{table};")
-
         sql.append(dedent("""
-          CREATE TABLE layer.{table} WITH OIDS AS
-          SELECT
-            0::bigint AS osm_id,
-            {fields}
-            NULL::geometry({geom_type}, 4326, 2) AS geom
-          FROM osm_{layer.type}
-          LIMIT 0;
+            DROP TABLE IF EXISTS tmp_layer_width, tmp_layer_hash;
+            CREATE TEMP TABLE tmp_layer_width (field text, width int);
+            CREATE TEMP TABLE tmp_layer_hash (row_count bigint, hash numeric);"""))
+
+        if delta:
+            sql.append(dedent("""
+              INSERT INTO tmp_layer_width
+              SELECT w.key, w.value::int
+              FROM layer_version lv, json_each_text(lv.widths::json) w
+              WHERE lv.region_id = {region.id} AND lv.layer_id = '{layer.id}';
+
+              INSERT INTO tmp_layer_hash
+              SELECT row_count, content_hash::numeric FROM layer_version
+              WHERE region_id = {region.id} AND layer_id = '{layer.id}';
+
+              /* Layer tables built by an earlier version lack osm_id index */
+              CREATE INDEX IF NOT EXISTS "{region.code} {layer.id} osm_id_idx"
+                ON layer.{table} (osm_id);
+
+              WITH del AS (
+                DELETE FROM layer.{table} l
+                  WHERE osm_id IN (
+                    {changed}
+                  )
+                RETURNING {row_hash} AS hash
+              )
+              INSERT INTO tmp_layer_hash
+              SELECT -COUNT(*), -SUM(hash) FROM del; """))
 
-          CREATE INDEX "{region.code} {layer.id} geom_idx"
-            ON layer.{table} USING gist (geom);
+        else:
+            if drop:
+                sql.append("DROP TABLE IF EXISTS layer.{table};")
 
-          GRANT SELECT ON TABLE layer.{table} TO public;"""))
+            sql.append(dedent("""
+              CREATE TABLE layer.{table} WITH OIDS AS
+              SELECT
+                0::bigint AS osm_id,
+                {fields}
+                NULL::geometry({geom_type}, 4326, 2) AS geom
+              FROM osm_{layer.type}
+              LIMIT 0;
+
+              CREATE INDEX "{region.code} {layer.id} geom_idx"
+                ON layer.{table} USING gist (geom);
+
+              CREATE INDEX "{region.code} {layer.id} osm_id_idx"
+                ON layer.{table} (osm_id);
+
+              GRANT SELECT ON TABLE layer.{table} TO public;"""))
 
         sql.append(dedent("""
-          INSERT INTO layer.{table} (osm_id, {field_names} geom)
+          WITH ins AS (
+            INSERT INTO layer.{table} AS l (osm_id, {field_names} geom)
             SELECT source.osm_id,
                {fields}
-               {force_multi}(ST_Force_2D(ck.geom)) AS geom
+               {force_multi}(ST_Force_2D(COALESCE(ck.geom, source.way))) AS geom
             FROM
               (SELECT id, geom FROM region WHERE id = {region.id}) region
               INNER JOIN (
                 {source}
-              ) source ON source.way && region.geom
+              ) source ON source.way && region.geom AND EXISTS(
+                SELECT * FROM region_part rp
+                WHERE rp.region_id = region.id AND rp.kind = 'geom'
+                  AND rp.geom && source.way)
               INNER JOIN intersection_{layer.type} ck ON
                   ck.region_id = region.id
+                AND ck.region_id = {region.id}
                 AND source.tab = ck.tab
                 AND source.osm_id = ck.osm_id
                 AND source.ver = ck.ver
-                AND ck.intersects
-            ORDER BY ck.geom; """))
+                AND ck.intersects"""))
+
+        if delta:
+            sql.append('\n'.join([
+                "  WHERE source.osm_id IN (",
+                "    {changed}",
+                "  )"]))
+        else:
+            sql.append("  ORDER BY COALESCE(ck.geom, source.way)")
+
+        sql.append(dedent("""
+              RETURNING {returning}, {row_hash} AS hash
+            ), hashed AS (
+              INSERT INTO tmp_layer_hash
+              SELECT COUNT(*), SUM(hash) FROM ins
+            )
+            INSERT INTO tmp_layer_width
+            SELECT w.field, MAX(w.width)
+            FROM ins CROSS JOIN LATERAL (VALUES
+                {widths}
+              ) w (field, width)
+            WHERE w.field IS NOT NULL
+            GROUP BY w.field; """))
 
         sql.append(dedent("""
             DELETE FROM layer_version
             WHERE region_id={region.id} AND layer_id = '{layer.id}'; """))
 
         sql.append(dedent("""
-            INSERT INTO layer_version (region_id, layer_id, ts, row_count)
+            INSERT INTO layer_version (region_id, layer_id, ts, row_count, definition, region_hash, widths, content_hash)
             SELECT
               '{region.id}',
               '{layer.id}',
               ts,
-              (SELECT COUNT(*) FROM layer.{table})
+              (SELECT SUM(row_count) FROM tmp_layer_hash),
+              {definition},
+              {region_hash},
+              (SELECT COALESCE(json_object_agg(field, width), '{{}}'::json)::text
+               FROM (SELECT field, MAX(width) AS width FROM tmp_layer_width GROUP BY field) w),
+              (SELECT ((COALESCE(SUM(hash), 0) % 18446744073709551616 + 18446744073709551616)
+                 % 18446744073709551616)::text
+               FROM tmp_layer_hash)
             FROM dump_version; """))
 
         return '\n'.join(sql).format(**params) + '\n\n'
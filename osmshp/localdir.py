@@ -0,0 +1,25 @@
+import os.path
+
+from . import gislab
+
+# Driver for a local directory with the same layout as GIS-Lab mirror:
+#
+#   <path>/dump/latest/<region>.<format>(.meta)
+#   <path>/dump/<region>/<region>-<yymmdd>.<format>(.meta)
+#   <path>/diff/<region>/<region>-<yymmdd>-<yymmdd>.<format>
+
+
+def _options(options):
+    return dict(options, url='file://' + os.path.abspath(options['path']))
+
+
+def latest(options=None):
+    return gislab.latest(options=_options(options))
+
+
+def dump(version=None, options=None):
+    return gislab.dump(version=version, options=_options(options))
+
+
+def diff(from_version, options=None):
+    return gislab.diff(from_version, options=_options(options))
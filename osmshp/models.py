@@ -40,6 +40,7 @@ class DumpVersion(Base):
     __tablename__ = 'dump_version'
     ts = sa.Column(sa.DateTime, primary_key=True, nullable=False)
     ready = sa.Column(sa.Boolean, nullable=False, default=False)
+    compacted = sa.Column(sa.DateTime)
 
 
 class RegionGroup(Base):
@@ -117,11 +118,35 @@ class LayerVersion(Base):
     layer_id = sa.Column(sa.Unicode(50), primary_key=True)
     ts = sa.Column(sa.DateTime, nullable=False)
     row_count = sa.Column(sa.Integer, nullable=False)
+    definition = sa.Column(sa.Unicode(32))
+    region_hash = sa.Column(sa.Unicode(32))
+    widths = sa.Column(sa.Unicode)
+    content_hash = sa.Column(sa.Unicode(32))
 
     region = orm.relationship(
         Region, backref=orm.backref('layer_versions', order_by=layer_id))
 
 
+class LayerStatState(Base):
+    __tablename__ = 'layer_stat_state'
+    region_id = sa.Column(sa.ForeignKey(Region.id), primary_key=True)
+    layer_id = sa.Column(sa.Unicode(50), primary_key=True)
+    ts = sa.Column(sa.DateTime, nullable=False)
+    definition = sa.Column(sa.Unicode(32))
+    region_hash = sa.Column(sa.Unicode(32))
+
+
+class MembershipLayer(Base):
+    """ Number of layer in obj_membership.layers, new number is assigned
+    when layer filter or classification changes. ts is set when membership
+    of all current object versions is evaluated. """
+    __tablename__ = 'membership_layer'
+    id = sa.Column(sa.Integer, primary_key=True)
+    layer_id = sa.Column(sa.Unicode(50), nullable=False, unique=True)
+    definition = sa.Column(sa.Unicode(32), nullable=False)
+    ts = sa.Column(sa.DateTime)
+
+
 class LayerStat(Base):
     __tablename__ = 'layer_stat'
     region_id = sa.Column(sa.Integer(), primary_key=True)
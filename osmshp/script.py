@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
 import readline
 import code
 from datetime import datetime
 from argparse import ArgumentParser
 
+import yaml
+
 from . import Env, DBSession, RegionGroup, Region
+from . import trace as tracemod
+from . import bench as benchmod
+from . import tags as tagsmod
+from .util import YAMLLoader
 
 
 def main(argv=sys.argv):
@@ -13,9 +20,31 @@ def main(argv=sys.argv):
     argparser = ArgumentParser()
 
     argparser.add_argument('--config', type=str)
+    argparser.add_argument('command', nargs='?', default='shell', choices=('shell', 'trace', 'bench', 'tags', 'upgrade'))
+    argparser.add_argument('trace_files', nargs='*', metavar='trace')
+    argparser.add_argument('--top', type=int, default=10)
+    argparser.add_argument('--threshold', type=float, default=None)
+    argparser.add_argument('--output', type=str, default='bench.json')
+    argparser.add_argument('--baseline', type=str, default=None)
+    argparser.add_argument('--style', type=str, default=None)
+    argparser.add_argument('--min-count', type=int, default=2)
+    argparser.add_argument('--max-fraction', type=float, default=0.2)
+    argparser.add_argument('--create-indexes', action='store_true')
 
     args = argparser.parse_args(argv[1:])
 
+    if args.command == 'trace':
+        return trace(args)
+
+    if args.command == 'bench':
+        return bench(args)
+
+    if args.command == 'tags':
+        return tags(args)
+
+    if args.command == 'upgrade':
+        return upgrade(args)
+
     env = Env(args.config)
 
     shell = code.InteractiveConsole(dict(
@@ -26,3 +55,74 @@ def main(argv=sys.argv):
         Region=Region,
     ))
     shell.interact("env")
+
+
+def trace(args):
+    """ Report of slowest templates and regions and regressions between
+    dump versions from execution trace files """
+
+    files = args.trace_files
+    if not files:
+        with open(args.config or os.environ.get('OSMSHP_CONFIG', 'config.yaml'), 'r') as fp:
+            config = yaml.load(fp, YAMLLoader)
+        files = [config['trace']['path'], ]
+
+    print tracemod.report(
+        tracemod.load(files), top=args.top,
+        threshold=args.threshold if args.threshold is not None else 1.5)
+
+
+def bench(args):
+    """ Run benchmark on synthetic data and compare with baseline report,
+    exit code is 1 if some phase got slower than threshold """
+
+    env = Env(args.config)
+
+    report = benchmod.Benchmark(env).run()
+    benchmod.write_report(report, args.output)
+
+    print 'Benchmark completed in %.1f s, report saved to %s' % (report['seconds'], args.output)
+    for phase, seconds in sorted(report['totals'].iteritems()):
+        print '  %-24s %10.1f s' % (phase, seconds)
+
+    if args.baseline:
+        regressions = benchmod.compare(
+            report, benchmod.read_report(args.baseline),
+            threshold=args.threshold if args.threshold is not None else 1.1)
+
+        for phase, before, after, ratio in regressions:
+            print 'Regression %-24s %10.1f s -> %10.1f s (x%.2f)' % (phase, before, after, ratio)
+
+        if regressions:
+            return 1
+
+
+def tags(args):
+    """ Report of tag keys used by layers, index eligibility of filters
+    and suggested indexes. With --style osm2pgsql style promoting hot keys
+    to columns is written, with --create-indexes indexes are created. """
+
+    env = Env(args.config)
+    advisor = tagsmod.TagAdvisor(env)
+
+    print advisor.report(min_count=args.min_count, max_fraction=args.max_fraction)
+
+    if args.style:
+        with open(args.style, 'w') as fd:
+            fd.write(advisor.style(min_count=args.min_count))
+        print 'Style saved to %s' % args.style
+
+    if args.create_indexes:
+        cur = env.connection.cursor()
+        for (objtype, key, fraction), sql in advisor.indexes(args.max_fraction):
+            print 'Creating index on osm_%s <%s>...' % (objtype, key)
+            cur.execute(sql)
+
+
+def upgrade(args):
+    """ Upgrade database created by an earlier version in place """
+
+    env = Env(args.config)
+    env.upgrade()
+
+    print 'Database upgraded'
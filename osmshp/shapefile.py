@@ -0,0 +1,385 @@
+import sys
+import struct
+from array import array
+from bisect import bisect_left
+from datetime import date
+
+# Streaming ESRI Shapefile writer. Features are written one by one as they
+# come, headers with counts and extent are patched on close. Geometries
+# are passed as OGC WKB, polygon rings must already be oriented as
+# shapefile expects (exterior clockwise), see ST_ForceRHR.
+
+NULL = 0
+POINT = 1
+POLYLINE = 3
+POLYGON = 5
+
+SHAPE_TYPES = {
+    'point': POINT,
+    'line': POLYLINE,
+    'polygon': POLYGON,
+}
+
+_WKB_POINT = 1
+_WKB_LINESTRING = 2
+_WKB_POLYGON = 3
+_WKB_MULTIPOINT = 4
+_WKB_MULTILINESTRING = 5
+_WKB_MULTIPOLYGON = 6
+_WKB_COLLECTION = 7
+
+
+def _parse_wkb(buf, offset=0):
+    """ Returns (parts, offset), parts is a list of coordinate sequences
+    stored as flat arrays of doubles """
+
+    byteorder = '<' if ord(buf[offset:offset + 1]) == 1 else '>'
+    (wkbtype, ) = struct.unpack_from(byteorder + 'I', buf, offset + 1)
+    offset += 5
+
+    if wkbtype == _WKB_POINT:
+        coords = array('d', struct.unpack_from(byteorder + '2d', buf, offset))
+        return [coords, ], offset + 16
+
+    elif wkbtype == _WKB_LINESTRING:
+        (npoints, ) = struct.unpack_from(byteorder + 'I', buf, offset)
+        offset += 4
+        coords = array('d', struct.unpack_from(
+            byteorder + '%dd' % (2 * npoints), buf, offset))
+        return [coords, ], offset + 16 * npoints
+
+    elif wkbtype == _WKB_POLYGON:
+        (nrings, ) = struct.unpack_from(byteorder + 'I', buf, offset)
+        offset += 4
+        parts = []
+        for i in range(nrings):
+            (npoints, ) = struct.unpack_from(byteorder + 'I', buf, offset)
+            offset += 4
+            parts.append(array('d', struct.unpack_from(
+                byteorder + '%dd' % (2 * npoints), buf, offset)))
+            offset += 16 * npoints
+        return parts, offset
+
+    elif wkbtype in (_WKB_MULTIPOINT, _WKB_MULTILINESTRING,
+                     _WKB_MULTIPOLYGON, _WKB_COLLECTION):
+        (ngeoms, ) = struct.unpack_from(byteorder + 'I', buf, offset)
+        offset += 4
+        parts = []
+        for i in range(ngeoms):
+            subparts, offset = _parse_wkb(buf, offset)
+            parts.extend(subparts)
+        return parts, offset
+
+    raise ValueError("Unsupported WKB geometry type %d" % wkbtype)
+
+
+def _le_doubles(coords):
+    if sys.byteorder != 'little':
+        coords = array('d', coords)
+        coords.byteswap()
+    return coords.tostring()
+
+
+def _bounds(parts):
+    xs = [x for part in parts for x in part[0::2]]
+    ys = [y for part in parts for y in part[1::2]]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class Field(object):
+
+    def __init__(self, name, type='C', size=254, decimal=0):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.decimal = decimal
+
+    def encode(self, value):
+        if value is None:
+            return ' ' * self.size
+
+        if self.type == 'C':
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            else:
+                value = str(value)
+
+            if len(value) > self.size:
+                # Don't leave a broken multibyte character at the end
+                value = value[:self.size].decode('utf-8', 'ignore').encode('utf-8')
+            return value.ljust(self.size)
+
+        elif self.type == 'L':
+            return 'T' if value else 'F'
+
+        elif self.type == 'D':
+            return value.strftime('%Y%m%d')
+
+        if self.decimal > 0:
+            # format() keeps all digits of Decimal values
+            text = format(value, '.%df' % self.decimal)
+            if len(text) > self.size:
+                # Drop fractional digits that don't fit, not integer ones
+                text = format(value, '.%df' % max(0, self.decimal - (len(text) - self.size)))
+        else:
+            text = str(value)
+
+        if len(text) > self.size:
+            raise ValueError("Value %s doesn't fit field %s (%d.%d)" % (
+                text, self.name, self.size, self.decimal))
+        return text.rjust(self.size)
+
+
+def unique_names(names, size=10):
+    """ DBF field names are limited to 10 characters, truncate them and
+    resolve collisions with numeric suffixes """
+
+    result = []
+    for name in names:
+        candidate = name[:size]
+        counter = 1
+        while candidate.upper() in [n.upper() for n in result]:
+            suffix = str(counter)
+            candidate = name[:size - len(suffix)] + suffix
+            counter += 1
+        result.append(candidate)
+
+    return result
+
+
+class Writer(object):
+
+    def __init__(self, filename, shape_type, fields, qix=False):
+        self.filename = filename
+        self.shape_type = shape_type
+        self.fields = fields
+
+        self.shp = open(filename + '.shp', 'wb')
+        self.shx = open(filename + '.shx', 'wb')
+        self.dbf = open(filename + '.dbf', 'wb')
+
+        self.count = 0
+        self.bounds = None
+        self.shp_offset = 100
+
+        # Bounding boxes of all shapes for .qix, kept as flat array to
+        # stay compact: xmin, ymin, xmax, ymax, record number. The tree is
+        # built from it in a second pass on close.
+        self.index = array('d') if qix else None
+
+        self.shp.write('\x00' * 100)
+        self.shx.write('\x00' * 100)
+        self._write_dbf_header()
+
+    def _write_dbf_header(self):
+        today = date.today()
+        header_size = 32 + 32 * len(self.fields) + 1
+        record_size = 1 + sum(f.size for f in self.fields)
+
+        # Byte 0x1D is language driver: zero, encoding is given by .cpg
+        self.dbf.write(struct.pack(
+            '<BBBBIHH20x', 0x03, today.year - 1900, today.month, today.day,
+            self.count, header_size, record_size))
+
+        for field in self.fields:
+            self.dbf.write(struct.pack(
+                '<11sc4xBB14x', field.name.encode('utf-8'), field.type,
+                field.size, field.decimal))
+
+        self.dbf.write('\x0D')
+
+    def _write_header(self, fd, length):
+        xmin, ymin, xmax, ymax = self.bounds or (0.0, 0.0, 0.0, 0.0)
+        fd.write(struct.pack('>6iI', 9994, 0, 0, 0, 0, 0, length // 2))
+        fd.write(struct.pack(
+            '<2i8d', 1000, self.shape_type,
+            xmin, ymin, xmax, ymax, 0.0, 0.0, 0.0, 0.0))
+
+    def write(self, wkb, record):
+        parts = _parse_wkb(str(wkb))[0] if wkb is not None else []
+        parts = [p for p in parts if len(p) > 0 and p[0] == p[0]]
+
+        if len(parts) == 0:
+            content = struct.pack('<i', NULL)
+            bounds = None
+
+        elif self.shape_type == POINT:
+            x, y = parts[0][0], parts[0][1]
+            content = struct.pack('<i2d', POINT, x, y)
+            bounds = (x, y, x, y)
+
+        else:
+            bounds = _bounds(parts)
+
+            starts = []
+            npoints = 0
+            for part in parts:
+                starts.append(npoints)
+                npoints += len(part) // 2
+
+            content = struct.pack(
+                '<i4d2i', self.shape_type, bounds[0], bounds[1],
+                bounds[2], bounds[3], len(parts), npoints)
+            content += struct.pack('<%di' % len(starts), *starts)
+            for part in parts:
+                content += _le_doubles(part)
+
+        self.count += 1
+
+        self.shp.write(struct.pack('>2i', self.count, len(content) // 2))
+        self.shp.write(content)
+
+        self.shx.write(struct.pack('>2i', self.shp_offset // 2, len(content) // 2))
+        self.shp_offset += 8 + len(content)
+
+        if bounds is not None:
+            if self.bounds is None:
+                self.bounds = bounds
+            else:
+                self.bounds = (
+                    min(self.bounds[0], bounds[0]), min(self.bounds[1], bounds[1]),
+                    max(self.bounds[2], bounds[2]), max(self.bounds[3], bounds[3]))
+
+            if self.index is not None:
+                self.index.extend(bounds)
+                self.index.append(self.count - 1)
+
+        self.dbf.write(' ' + ''.join(
+            f.encode(v) for f, v in zip(self.fields, record)))
+
+    def close(self):
+        self.shp.seek(0)
+        self._write_header(self.shp, self.shp_offset)
+        self.shp.close()
+
+        self.shx.seek(0)
+        self._write_header(self.shx, 100 + 8 * self.count)
+        self.shx.close()
+
+        self.dbf.write('\x1A')
+        self.dbf.seek(4)
+        self.dbf.write(struct.pack('<I', self.count))
+        self.dbf.close()
+
+        with open(self.filename + '.cpg', 'w') as fd:
+            fd.write('65001')
+
+        if self.index is not None:
+            write_qix(self.filename + '.qix', self.index, self.count, self.bounds)
+            self.index = None
+
+
+# Quadtree spatial index in MapServer .qix format, the same as shptree
+# builds. Shapes are pushed down the tree while they fit into one of node
+# quadrants, quadrants overlap a bit like in MapServer. Depth is chosen
+# like shptree does and capped like shapelib does.
+#
+# The tree isn't kept in memory: node of every shape is encoded as an
+# integer sorting nodes in depth-first order, shapes are sorted by it and
+# the tree is written in one pass, subtree sizes are patched afterwards.
+
+_SPLIT_RATIO = 0.55
+_MAX_DEPTH = 12
+
+
+def _split(rect):
+    xmin, ymin, xmax, ymax = rect
+    if xmax - xmin > ymax - ymin:
+        r = (xmax - xmin) * _SPLIT_RATIO
+        return (xmin, ymin, xmin + r, ymax), (xmax - r, ymin, xmax, ymax)
+    else:
+        r = (ymax - ymin) * _SPLIT_RATIO
+        return (xmin, ymin, xmax, ymin + r), (xmin, ymax - r, xmax, ymax)
+
+
+def _quads(rect):
+    half1, half2 = _split(rect)
+    return _split(half1) + _split(half2)
+
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] \
+        and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def _node_key(root, bounds, levels):
+    """ Quadrant path of the deepest node containing bounds as base 4
+    number padded to levels digits, times 16 plus node level """
+
+    rect = root
+    path = 0
+    level = 0
+    while level < levels:
+        for q, quad in enumerate(_quads(rect)):
+            if _contains(quad, bounds):
+                rect = quad
+                path = path * 4 + q
+                level += 1
+                break
+        else:
+            break
+
+    return (path * 4 ** (levels - level)) * 16 + level
+
+
+def _write_node(fd, rect, level, levels, base, keys, ids, lo, hi):
+    """ Node with path base (padded) and its subtree, shapes of which are
+    keys[lo:hi] in depth-first order """
+
+    own = lo
+    while own < hi and keys[own] % 16 == level:
+        own += 1
+
+    children = []
+    if level < levels:
+        step = 4 ** (levels - level - 1)
+        start = own
+        for q, quad in enumerate(_quads(rect)):
+            end = bisect_left(keys, (base + (q + 1) * step) * 16, start, hi)
+            if end > start:
+                children.append((quad, base + q * step, start, end))
+            start = end
+
+    pos = fd.tell()
+    fd.write(struct.pack('<i4di', 0, rect[0], rect[1], rect[2], rect[3], own - lo))
+    fd.write(ids[lo:own].tostring())
+    fd.write(struct.pack('<i', len(children)))
+
+    subtree = fd.tell()
+    for quad, child_base, start, end in children:
+        _write_node(fd, quad, level + 1, levels, child_base, keys, ids, start, end)
+
+    end = fd.tell()
+    fd.seek(pos)
+    fd.write(struct.pack('<i', end - subtree))
+    fd.seek(end)
+
+
+def write_qix(filename, index, count, bounds):
+    depth = 0
+    nodes = 1
+    while nodes * 4 < count:
+        depth += 1
+        nodes *= 2
+    depth = min(depth, _MAX_DEPTH)
+
+    # Shapes descend at most depth - 1 levels below root
+    levels = max(depth - 1, 0)
+    root = bounds or (0.0, 0.0, 0.0, 0.0)
+
+    keys = array('i', [
+        _node_key(root, tuple(index[i:i + 4]), levels)
+        for i in xrange(0, len(index), 5)])
+    order = sorted(xrange(len(keys)), key=keys.__getitem__)
+
+    ids = array('i', [int(index[i * 5 + 4]) for i in order])
+    keys = array('i', [keys[i] for i in order])
+    del order
+    if sys.byteorder != 'little':
+        ids.byteswap()
+
+    with open(filename, 'wb') as fd:
+        # Signature, LSB byte order, version 1, reserved
+        fd.write(struct.pack('<3sBB3x', 'SQT', 1, 1))
+        fd.write(struct.pack('<2i', count, depth))
+        _write_node(fd, root, 0, levels, 0, keys, ids, 0, len(keys))
@@ -2,7 +2,11 @@ from collections import namedtuple
 import textwrap
 
 
-SqlStatement = namedtuple('SqlStatement', ('sql', 'log'))
+# key and deps (keys of statements which must be completed first) define
+# execution order, cost is a relative estimate used for scheduling, trace
+# is a dict of context fields for execution trace records.
+SqlStatement = namedtuple('SqlStatement', ('sql', 'log', 'key', 'deps', 'cost', 'trace'))
+SqlStatement.__new__.__defaults__ = (None, (), 0, None)
 
 
 def dedent(t):
@@ -1,15 +1,24 @@
 DROP TABLE IF EXISTS intersection_point, intersection_line, intersection_polygon, obj_version CASCADE;
 
-DROP TABLE IF EXISTS dump_version, region_group, region, layer_version, layer_stat CASCADE;
+DROP TABLE IF EXISTS obj_membership, obj_category CASCADE;
+
+DROP TABLE IF EXISTS region_part, region_eval, layer_stat_item, stat_changed CASCADE;
+
+DROP TABLE IF EXISTS dump_version, region_group, region, layer_version, layer_stat, layer_stat_state, membership_layer CASCADE;
 
 DROP FUNCTION IF EXISTS region_clean_itersections();
+DROP FUNCTION IF EXISTS intersection_partitions(int, text);
+DROP FUNCTION IF EXISTS intersection_set_logged(regclass);
+DROP FUNCTION IF EXISTS buffer_capture() CASCADE;
+DROP FUNCTION IF EXISTS region_part_update();
+DROP FUNCTION IF EXISTS region_part_build(int, part_enum, geometry);
 DROP FUNCTION IF EXISTS relation(bigint);
 DROP FUNCTION IF EXISTS eval(text);
 
 DROP SCHEMA IF EXISTS layer CASCADE;
 
-DROP TABLE IF EXISTS buffer_delete, buffer_insert CASCADE;
-DROP TYPE IF EXISTS nwr_enum, plp_enum CASCADE;
+DROP TABLE IF EXISTS buffer_delete, buffer_insert, buffer_region, buffer_recompute CASCADE;
+DROP TYPE IF EXISTS nwr_enum, plp_enum, part_enum CASCADE;
 
 DROP TABLE IF EXISTS osm_nodes, osm_ways, osm_rels,
   osm_point, osm_line, osm_polygon, osm_roads;
\ No newline at end of file
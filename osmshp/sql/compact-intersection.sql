@@ -0,0 +1,14 @@
+/* {objtype} region {region_id}: rows of versions superseded by {keep} and
+   more newer ones, deleted objects have latest bumped by deletion. Only
+   objects changed since the previous compaction are candidates. */
+
+DELETE FROM intersection_{objtype}
+WHERE region_id = {region_id} AND ctid = ANY(ARRAY(
+  SELECT it.ctid
+  FROM obj_version v
+    INNER JOIN intersection_{objtype} it ON it.tab = v.tab AND it.osm_id = v.osm_id
+  WHERE v.tab = '{objtype}'::plp_enum AND {since}
+    AND it.region_id = {region_id}
+    AND it.ver <= v.latest - {keep}
+  LIMIT {batch_size}
+));
@@ -0,0 +1,13 @@
+/* {table} {objtype}: rows of versions superseded by {keep} and more newer
+   ones. Only objects changed since the previous compaction are
+   candidates. */
+
+DELETE FROM {table}
+WHERE ctid = ANY(ARRAY(
+  SELECT it.ctid
+  FROM obj_version v
+    INNER JOIN {table} it ON it.tab = v.tab AND it.osm_id = v.osm_id
+  WHERE v.tab = '{objtype}'::plp_enum AND {since}
+    AND it.ver <= v.latest - {keep}
+  LIMIT {batch_size}
+));
@@ -1,20 +1,68 @@
-CREATE TYPE plp_enum AS ENUM('point', 'line', 'polygon');
-CREATE TYPE nwr_enum AS ENUM('n', 'w', 'r');
+/* Script is run again by upgrade, so every object is created only if it
+   doesn't exist yet */
 
+DO $$
+BEGIN
+  CREATE TYPE plp_enum AS ENUM('point', 'line', 'polygon');
+EXCEPTION
+  WHEN duplicate_object THEN NULL;
+END
+$$;
+
+DO $$
+BEGIN
+  CREATE TYPE nwr_enum AS ENUM('n', 'w', 'r');
+EXCEPTION
+  WHEN duplicate_object THEN NULL;
+END
+$$;
 
-CREATE TABLE buffer_delete (
+
+CREATE TABLE IF NOT EXISTS buffer_delete (
   tab plp_enum,
   osm_id bigint
 );
 
 
-CREATE TABLE buffer_insert (
+CREATE TABLE IF NOT EXISTS buffer_insert (
   tab plp_enum,
   osm_id bigint
 ); 
 
 
-CREATE SCHEMA layer;
+/* Regions which need a full intersection pass instead of change set one */
+
+CREATE TABLE IF NOT EXISTS buffer_region (
+  region_id int NOT NULL
+);
+
+
+/* Unchanged objects near changed part of region boundary, intersections
+   of them are computed again without bumping their version */
+
+CREATE TABLE IF NOT EXISTS buffer_recompute (
+  tab plp_enum,
+  osm_id bigint
+);
+
+
+/* Change capture for osm_* tables, osm2pgsql replaces modified objects
+   with DELETE and INSERT so both are enough to track any change. */
+
+CREATE OR REPLACE FUNCTION buffer_capture() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO buffer_insert (tab, osm_id) VALUES (TG_ARGV[0]::plp_enum, NEW.osm_id);
+  ELSIF TG_OP = 'DELETE' THEN
+    INSERT INTO buffer_delete (tab, osm_id) VALUES (TG_ARGV[0]::plp_enum, OLD.osm_id);
+  END IF;
+
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+
+CREATE SCHEMA IF NOT EXISTS layer;
 GRANT USAGE ON SCHEMA layer TO public;
 
 
@@ -45,14 +93,149 @@ END
 $$ LANGUAGE plpgsql IMMUTABLE;
 
 
+/* Intersection tables are partitioned by region_id, every region has its
+   own intersection_<type>_<region_id> partitions */
+
+CREATE OR REPLACE FUNCTION intersection_partitions(rid int, persistence text DEFAULT '') RETURNS void AS $$
+DECLARE
+  t text;
+BEGIN
+  FOREACH t IN ARRAY ARRAY['point', 'line', 'polygon'] LOOP
+    EXECUTE format(
+      'CREATE %s TABLE IF NOT EXISTS intersection_%s_%s PARTITION OF intersection_%s FOR VALUES IN (%s)',
+      persistence, t, rid, t, rid);
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION intersection_set_logged(parent regclass) RETURNS void AS $$
+DECLARE
+  part regclass;
+BEGIN
+  FOR part IN SELECT inhrelid FROM pg_inherits WHERE inhparent = parent LOOP
+    EXECUTE format('ALTER TABLE %s SET LOGGED', part);
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
 CREATE OR REPLACE FUNCTION region_clean_itersections() RETURNS TRIGGER AS $$
+DECLARE
+  t text;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM intersection_partitions(NEW.id);
+    INSERT INTO buffer_region (region_id) VALUES (NEW.id);
+  ELSIF TG_OP = 'DELETE' THEN
+    FOREACH t IN ARRAY ARRAY['point', 'line', 'polygon'] LOOP
+      EXECUTE format('DROP TABLE IF EXISTS intersection_%s_%s', t, OLD.id);
+    END LOOP;
+    RETURN OLD;
+  ELSIF NOT ST_Equals(NEW.geom_in, OLD.geom_in) OR NOT ST_Equals(NEW.geom_out, OLD.geom_out) THEN
+    FOREACH t IN ARRAY ARRAY['point', 'line', 'polygon'] LOOP
+      EXECUTE format('TRUNCATE intersection_%s_%s', t, NEW.id);
+    END LOOP;
+
+    INSERT INTO buffer_region (region_id) VALUES (NEW.id);
+  END IF;
+
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+/* Subdivided pieces of region geometries: small polygons with tight
+   bounding boxes make spatial predicates and clipping against huge
+   administrative boundaries cheap. Maintained by trigger on region. */
+
+DO $$
+BEGIN
+  CREATE TYPE part_enum AS ENUM('geom', 'geom_in', 'geom_out');
+EXCEPTION
+  WHEN duplicate_object THEN NULL;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS region_part (
+  region_id int NOT NULL REFERENCES region (id) ON DELETE CASCADE,
+  kind part_enum NOT NULL,
+  geom geometry NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS region_part_region_idx ON region_part (region_id, kind);
+CREATE INDEX IF NOT EXISTS region_part_geom_idx ON region_part USING gist (geom);
+
+
+CREATE OR REPLACE FUNCTION region_part_build(int, part_enum, geometry) RETURNS void AS $$
+BEGIN
+  DELETE FROM region_part p WHERE p.region_id = $1 AND p.kind = $2;
+
+  INSERT INTO region_part (region_id, kind, geom)
+  SELECT $1, $2, ST_Subdivide($3, 256)
+  WHERE NOT ST_IsEmpty($3);
+END
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION region_part_update() RETURNS TRIGGER AS $$
 BEGIN
-  IF NOT ST_Equals(NEW.geom_in, OLD.geom_in) OR NOT ST_Equals(NEW.geom_out, OLD.geom_out) THEN
-    DELETE FROM intersection_point WHERE region_id = NEW.id;
-    DELETE FROM intersection_line WHERE region_id = NEW.id;
-    DELETE FROM intersection_polygon WHERE region_id = NEW.id;
+  IF TG_OP = 'INSERT' OR NOT ST_OrderingEquals(NEW.geom, OLD.geom) THEN
+    PERFORM region_part_build(NEW.id, 'geom', NEW.geom);
+  END IF;
+
+  IF TG_OP = 'INSERT' OR NOT ST_OrderingEquals(NEW.geom_in, OLD.geom_in) THEN
+    PERFORM region_part_build(NEW.id, 'geom_in', NEW.geom_in);
+  END IF;
+
+  IF TG_OP = 'INSERT' OR NOT ST_OrderingEquals(NEW.geom_out, OLD.geom_out) THEN
+    PERFORM region_part_build(NEW.id, 'geom_out', NEW.geom_out);
   END IF;
 
   RETURN NEW;
 END
-$$ LANGUAGE plpgsql;
\ No newline at end of file
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS region_part_update ON region;
+
+CREATE TRIGGER region_part_update
+  AFTER INSERT OR UPDATE OF geom, geom_in, geom_out ON region FOR EACH ROW
+  EXECUTE PROCEDURE region_part_update();
+
+
+/* Regions evaluated from relations: expression, osm_polygon ids of the
+   relations it references and dump version its geometry is valid for */
+
+CREATE TABLE IF NOT EXISTS region_eval (
+  region_id int PRIMARY KEY REFERENCES region (id) ON DELETE CASCADE,
+  expression text NOT NULL,
+  inputs bigint[] NOT NULL,
+  ts timestamp
+);
+
+
+/* Contribution of every object to layer statistics, so statistics of a
+   new version are computed from changed objects only */
+
+CREATE TABLE IF NOT EXISTS layer_stat_item (
+  region_id int NOT NULL REFERENCES region (id) ON DELETE CASCADE,
+  layer_id varchar(50) NOT NULL,
+  osm_id bigint NOT NULL,
+  criteria varchar(20) NOT NULL,
+  category varchar(20) NOT NULL,
+  f_points int,
+  f_length float,
+  f_area float
+);
+
+CREATE INDEX IF NOT EXISTS layer_stat_item_idx ON layer_stat_item (layer_id, region_id, osm_id);
+
+
+/* Objects changed since statistics of regions were computed, built once
+   per statistics update and shared by all layers */
+
+CREATE UNLOGGED TABLE IF NOT EXISTS stat_changed (
+  region_id int NOT NULL,
+  tab plp_enum NOT NULL,
+  osm_id bigint NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS stat_changed_idx ON stat_changed (tab, region_id, osm_id);
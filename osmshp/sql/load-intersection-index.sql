@@ -0,0 +1,8 @@
+/* Initial full pass is completed, intersection_{objtype} gets its key */
+
+ALTER TABLE intersection_{objtype}
+  ADD CONSTRAINT intersection_{objtype}_pk PRIMARY KEY (tab, osm_id, ver, region_id);
+
+ANALYZE intersection_{objtype};
+
+{set_logged}
@@ -1,5 +1,9 @@
 DROP TABLE IF EXISTS intersection_point, intersection_line, intersection_polygon;
 
+/* Tables are filled by initial full pass of post-update, primary keys are
+   added by load-intersection-index after it. Partitions of regions are
+   created and dropped by region_clean_itersections trigger. */
+
 CREATE TABLE intersection_point (
   tab plp_enum,
   osm_id bigint,
@@ -7,9 +11,8 @@ CREATE TABLE intersection_point (
   region_id int,
   intersects boolean,
   buffer boolean,
-  geom geometry,
-  CONSTRAINT intersection_point_pk PRIMARY KEY (tab, osm_id, ver, region_id)
-);
+  geom geometry
+) PARTITION BY LIST (region_id);
 
 CREATE TABLE intersection_line (
   tab plp_enum,
@@ -20,9 +23,8 @@ CREATE TABLE intersection_line (
   buffer boolean,
   geom geometry,
   f_points int,
-  f_length float,
-  CONSTRAINT intersection_line_pk PRIMARY KEY (tab, osm_id, ver, region_id)
-);
+  f_length float
+) PARTITION BY LIST (region_id);
 
 CREATE TABLE intersection_polygon (
   tab plp_enum,
@@ -34,12 +36,20 @@ CREATE TABLE intersection_polygon (
   geom geometry,
   f_points int,
   f_length float,
-  f_area float,
-  CONSTRAINT intersection_polygon_pk PRIMARY KEY (tab, osm_id, ver, region_id)
-);
+  f_area float
+) PARTITION BY LIST (region_id);
 
 DROP TRIGGER IF EXISTS region_clean_itersections ON region;
 
 CREATE TRIGGER region_clean_itersections
-  AFTER UPDATE ON region FOR EACH ROW
-  EXECUTE PROCEDURE region_clean_itersections();
\ No newline at end of file
+  AFTER INSERT OR UPDATE OF geom_in, geom_out OR DELETE ON region FOR EACH ROW
+  EXECUTE PROCEDURE region_clean_itersections();
+
+SELECT intersection_partitions(id, '{unlogged}') FROM region;
+
+/* Objects loaded from dump aren't captured, so every region needs full pass */
+
+TRUNCATE buffer_insert, buffer_delete, buffer_region, buffer_recompute, region_eval;
+
+INSERT INTO buffer_region (region_id)
+SELECT id FROM region;
\ No newline at end of file
@@ -0,0 +1,9 @@
+ALTER TABLE obj_membership
+  ADD CONSTRAINT obj_membership_pk PRIMARY KEY (tab, osm_id, ver);
+
+CREATE INDEX obj_category_idx ON obj_category (tab, osm_id, ver, layer_no);
+
+ANALYZE obj_membership;
+ANALYZE obj_category;
+
+{set_logged}
@@ -0,0 +1,22 @@
+DROP TABLE IF EXISTS obj_membership, obj_category;
+
+/* Layers of object version by membership_layer number, filters are
+   evaluated once per version. Keys are built by load-membership-index. */
+
+CREATE {unlogged} TABLE obj_membership (
+  tab plp_enum,
+  osm_id bigint,
+  ver int,
+  layers int[]
+);
+
+/* Matched classification criteria of object version in layer */
+
+CREATE {unlogged} TABLE obj_category (
+  tab plp_enum,
+  osm_id bigint,
+  ver int,
+  layer_no int,
+  criteria text,
+  category text
+);
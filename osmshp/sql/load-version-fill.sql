@@ -0,0 +1,4 @@
+/* ts is dump version of the latest change, NULL for objects from dump */
+
+INSERT INTO obj_version
+SELECT DISTINCT '{objtype}'::plp_enum, osm_id, 1, NULL::timestamp FROM osm_{objtype};
@@ -0,0 +1,8 @@
+ALTER TABLE obj_version
+  ADD CONSTRAINT obj_version_pk PRIMARY KEY (tab, osm_id);
+
+CREATE INDEX obj_version_ts_idx ON obj_version (tab, ts);
+
+ANALYZE obj_version;
+
+{set_logged}
@@ -0,0 +1,4 @@
+ANALYZE buffer_insert;
+ANALYZE buffer_delete;
+ANALYZE buffer_region;
+ANALYZE buffer_recompute;
@@ -0,0 +1 @@
+TRUNCATE buffer_insert, buffer_delete, buffer_region, buffer_recompute;
@@ -1 +0,0 @@
-UPDATE osm_line SET flag = true WHERE NOT flag;
\ No newline at end of file
@@ -1 +0,0 @@
-UPDATE osm_point SET flag = true WHERE NOT flag;
\ No newline at end of file
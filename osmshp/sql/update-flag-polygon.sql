@@ -1 +0,0 @@
-UPDATE osm_polygon SET flag = true WHERE NOT flag;
\ No newline at end of file
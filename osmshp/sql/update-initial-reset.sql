@@ -0,0 +1,13 @@
+/* Initial full pass wasn't completed, tables it fills are emptied and keys
+   it builds are dropped to run it again */
+
+TRUNCATE intersection_point, intersection_line, intersection_polygon,
+  obj_membership, obj_category;
+
+ALTER TABLE intersection_point DROP CONSTRAINT IF EXISTS intersection_point_pk;
+ALTER TABLE intersection_line DROP CONSTRAINT IF EXISTS intersection_line_pk;
+ALTER TABLE intersection_polygon DROP CONSTRAINT IF EXISTS intersection_polygon_pk;
+
+ALTER TABLE obj_membership DROP CONSTRAINT IF EXISTS obj_membership_pk;
+
+DROP INDEX IF EXISTS obj_category_idx;
@@ -1,4 +1,4 @@
-/* line {region.code} chunk {chunk_no} of {chunk_count} */
+/* line {scope} chunk {chunk_no} of {chunk_count} */
 
 DROP TABLE IF EXISTS tmp_intersection_line;
 
@@ -6,43 +6,72 @@ CREATE TEMP TABLE tmp_intersection_line AS
 SELECT tab AS tab, sub.osm_id AS osm_id, sub.ver AS ver, sub.region_id,
   CASE WHEN (intersects AND ST_IsEmpty(geom)) OR geom IS NULL THEN false ELSE intersects END,
   buffer,
-  CASE WHEN (intersects AND ST_IsEmpty(geom)) THEN NULL ELSE geom END,
+  /* Interior objects are taken from source table as is */
+  CASE WHEN (intersects AND ST_IsEmpty(geom)) OR NOT buffer THEN NULL ELSE geom END,
   CASE WHEN (intersects AND ST_IsEmpty(geom)) OR NOT intersects THEN NULL ELSE ST_NPoints(geom) END AS f_points,
   CASE WHEN (intersects AND ST_IsEmpty(geom)) OR NOT intersects THEN NULL ELSE ST_Length(geography(geom)) END AS f_length
-FROM ( 
-    SELECT src.tab, src.osm_id, src.ver AS ver,
-      rgn.id AS region_id,
-      CASE
-        WHEN geom_in IS NOT NULL AND ST_Within(src.geom, rgn.geom_in) THEN true
-        WHEN geom_out IS NOT NULL AND NOT ST_Intersects(src.geom, rgn.geom_out) THEN false
-        ELSE ST_Intersects(src.geom, rgn.geom)
-      END AS intersects,
-      CASE
-        WHEN geom_in IS NOT NULL AND ST_Within(src.geom, rgn.geom_in) THEN false
-        WHEN geom_out IS NOT NULL AND NOT ST_Intersects(src.geom, rgn.geom_out) THEN false
-        ELSE true
-      END buffer,
-      CASE
-        WHEN geom_in IS NOT NULL AND ST_Within(src.geom, rgn.geom_in) THEN src.geom
-        WHEN geom_out IS NOT NULL AND NOT ST_Intersects(src.geom, rgn.geom_out) THEN NULL
-        WHEN ST_Intersects(src.geom, rgn.geom) THEN ST_CollectionExtract(ST_Intersection(src.geom, rgn.geom), 2)
-        ELSE NULL
-      END geom
-    FROM
-      (
-        SELECT 'line'::plp_enum AS tab, osm_id, ver, way AS geom, is_simple
-        FROM osm_line
-        WHERE osm_id > 0 AND osm_id % {chunk_count} = {chunk_no} AND (
-          {filter_line}
+FROM (
+    SELECT zn.tab, zn.osm_id, zn.ver, zn.region_id,
+      zone <> 'out' AS intersects,
+      zone = 'buffer' AS buffer,
+      CASE zone
+        WHEN 'in' THEN zn.geom
+        WHEN 'out' THEN NULL
+        /* Region pieces touched by object are merged, so there are no seams:
+           object within them is kept as is, otherwise it's clipped */
+        ELSE (
+          SELECT CASE
+            WHEN ST_Within(zn.geom, cover.geom) THEN zn.geom
+            ELSE ST_LineMerge(ST_CollectionExtract(ST_Intersection(zn.geom, cover.geom), 2))
+          END
+          FROM (
+            SELECT ST_Union(p.geom) AS geom FROM region_part p
+            WHERE p.region_id = zn.region_id AND p.kind = 'geom'
+              AND ST_Intersects(zn.geom, p.geom)
+          ) cover
         )
-      ) src
-      INNER JOIN region rgn ON rgn.geom && src.geom
-    WHERE rgn.id = {region.id} AND NOT EXISTS(
-      SELECT * FROM intersection_line c WHERE c.tab = src.tab AND c.osm_id = src.osm_id 
-      AND c.ver = src.ver AND c.region_id = rgn.id)
+      END AS geom
+    FROM (
+        SELECT src.tab, src.osm_id, src.ver AS ver, src.geom,
+          rgn.id AS region_id,
+          CASE
+            WHEN EXISTS(
+              SELECT * FROM region_part p
+              WHERE p.region_id = rgn.id AND p.kind = 'geom_in'
+                AND ST_Within(src.geom, p.geom)
+            ) THEN 'in'
+            /* Object crossing seams of geom_in pieces */
+            WHEN ST_Within(src.geom, rgn.geom_in) THEN 'in'
+            WHEN NOT EXISTS(
+              SELECT * FROM region_part p
+              WHERE p.region_id = rgn.id AND p.kind = 'geom_out'
+                AND ST_Intersects(src.geom, p.geom)
+            ) THEN 'out'
+            ELSE 'buffer'
+          END AS zone
+        FROM
+          (
+            SELECT 'line'::plp_enum AS tab, osm_id, ver, way AS geom, is_simple
+            FROM osm_line
+            WHERE osm_id > 0 AND {chunk_filter} AND {change_filter} AND (
+              {member_line}
+            )
+          ) src
+          INNER JOIN region rgn ON rgn.geom && src.geom
+        WHERE {region_filter} AND EXISTS(
+          SELECT * FROM region_part p
+          WHERE p.region_id = rgn.id AND p.kind = 'geom_out'
+            AND p.geom && src.geom)
+        AND ({initial} OR NOT EXISTS(
+          SELECT * FROM intersection_line c WHERE c.tab = src.tab AND c.osm_id = src.osm_id
+          AND c.ver = src.ver AND c.region_id = rgn.id))
+        /* Optimization fence: evaluate zone once, not once per reference */
+        OFFSET 0
+    ) zn
+    OFFSET 0
   ) sub;
 
 
-/* NB: Number of affected rows is used to calculate chunk size */
+/* NB: Number of affected rows is logged against chunk plan estimate */
 INSERT INTO intersection_line
-SELECT * FROM tmp_intersection_line;
\ No newline at end of file
+SELECT * FROM tmp_intersection_line;
@@ -1,44 +1,65 @@
-/* point {region.code} chunk {chunk_no} of {chunk_count} */
+/* point {scope} chunk {chunk_no} of {chunk_count} */
 
 DROP TABLE IF EXISTS tmp_intersection_point;
 
 CREATE TEMP TABLE tmp_intersection_point AS
 SELECT tab AS tab, sub.osm_id AS osm_id, sub.ver AS ver, sub.region_id,
-   intersects, buffer, geom
-FROM ( 
-    SELECT src.tab, src.osm_id, src.ver AS ver,
-      rgn.id AS region_id,
-      CASE
-        WHEN geom_in IS NOT NULL AND ST_Within(src.geom, rgn.geom_in) THEN true
-        WHEN geom_out IS NOT NULL AND NOT ST_Intersects(src.geom, rgn.geom_out) THEN false
-        ELSE ST_Intersects(src.geom, rgn.geom)
-      END AS intersects,
-      CASE 
-        WHEN geom_in IS NOT NULL AND ST_Within(src.geom, rgn.geom_in) THEN false
-        WHEN geom_out IS NOT NULL AND NOT ST_Intersects(src.geom, rgn.geom_out) THEN false
-        ELSE true
-      END buffer,
-      CASE
-        WHEN geom_in IS NOT NULL AND ST_Within(src.geom, rgn.geom_in) THEN src.geom
-        WHEN geom_out IS NOT NULL AND NOT ST_Intersects(src.geom, rgn.geom_out) THEN NULL
-        WHEN ST_Intersects(src.geom, rgn.geom) THEN src.geom
+   geom IS NOT NULL AS intersects, buffer,
+   /* Interior objects are taken from source table as is */
+   CASE WHEN buffer THEN geom END
+FROM (
+    SELECT zn.tab, zn.osm_id, zn.ver, zn.region_id,
+      zone = 'buffer' AS buffer,
+      CASE zone
+        WHEN 'in' THEN zn.geom
+        WHEN 'out' THEN NULL
+        WHEN EXISTS(
+          SELECT * FROM region_part p
+          WHERE p.region_id = zn.region_id AND p.kind = 'geom'
+            AND ST_Intersects(zn.geom, p.geom)
+        ) THEN zn.geom
         ELSE NULL
-      END geom
-
-    FROM
-      (
-        SELECT 'point'::plp_enum AS tab, osm_id, ver, way AS geom, is_valid
-        FROM osm_point
-        WHERE osm_id > 0 AND osm_id % {chunk_count} = {chunk_no} AND (
-          {filter_point}
-        )
-      ) src
-      INNER JOIN region rgn ON rgn.geom && src.geom
-    WHERE rgn.id = {region.id} AND NOT EXISTS(
-      SELECT * FROM intersection_point c WHERE c.tab = src.tab AND c.osm_id = src.osm_id 
-        AND c.ver = src.ver AND c.region_id = rgn.id)
+      END AS geom
+    FROM (
+        SELECT src.tab, src.osm_id, src.ver AS ver, src.geom,
+          rgn.id AS region_id,
+          CASE
+            WHEN EXISTS(
+              SELECT * FROM region_part p
+              WHERE p.region_id = rgn.id AND p.kind = 'geom_in'
+                AND ST_Within(src.geom, p.geom)
+            ) THEN 'in'
+            /* Object lying on seam of geom_in pieces */
+            WHEN ST_Within(src.geom, rgn.geom_in) THEN 'in'
+            WHEN NOT EXISTS(
+              SELECT * FROM region_part p
+              WHERE p.region_id = rgn.id AND p.kind = 'geom_out'
+                AND ST_Intersects(src.geom, p.geom)
+            ) THEN 'out'
+            ELSE 'buffer'
+          END AS zone
+        FROM
+          (
+            SELECT 'point'::plp_enum AS tab, osm_id, ver, way AS geom, is_valid
+            FROM osm_point
+            WHERE osm_id > 0 AND {chunk_filter} AND {change_filter} AND (
+              {member_point}
+            )
+          ) src
+          INNER JOIN region rgn ON rgn.geom && src.geom
+        WHERE {region_filter} AND EXISTS(
+          SELECT * FROM region_part p
+          WHERE p.region_id = rgn.id AND p.kind = 'geom_out'
+            AND p.geom && src.geom)
+        AND ({initial} OR NOT EXISTS(
+          SELECT * FROM intersection_point c WHERE c.tab = src.tab AND c.osm_id = src.osm_id
+            AND c.ver = src.ver AND c.region_id = rgn.id))
+        /* Optimization fence: evaluate zone once, not once per reference */
+        OFFSET 0
+    ) zn
+    OFFSET 0
 )  sub;
 
-/* NB: Number of affected rows is used to calculate chunk size */
+/* NB: Number of affected rows is logged against chunk plan estimate */
 INSERT INTO intersection_point
-SELECT * FROM tmp_intersection_point;
\ No newline at end of file
+SELECT * FROM tmp_intersection_point;
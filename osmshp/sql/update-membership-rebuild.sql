@@ -0,0 +1,31 @@
+/* {objtype}: layers {rebuilt} are new or changed, current versions
+   evaluated before don't have them yet */
+
+/* Objects which got new layers aren't in the change set, they are queued
+   so the intersection pass reaches the ones without intersections yet */
+
+WITH upd AS (
+  UPDATE obj_membership m SET
+    layers = m.layers || {layers}
+  FROM osm_{objtype} src
+  WHERE m.tab = '{objtype}'::plp_enum AND src.osm_id = m.osm_id AND src.ver = m.ver
+    AND NOT m.layers && {rebuilt} AND (
+      {filter}
+    )
+  RETURNING m.tab, m.osm_id
+)
+INSERT INTO buffer_insert (tab, osm_id)
+SELECT DISTINCT tab, osm_id FROM upd;
+
+DELETE FROM obj_category
+WHERE tab = '{objtype}'::plp_enum AND layer_no = ANY({rebuilt});
+
+INSERT INTO obj_category (tab, osm_id, ver, layer_no, criteria, category)
+SELECT m.tab, m.osm_id, m.ver, c.layer_no, c.criteria, c.category
+FROM obj_membership m
+  INNER JOIN osm_{objtype} src ON src.osm_id = m.osm_id AND src.ver = m.ver
+  CROSS JOIN LATERAL (VALUES
+    {categories}
+  ) AS c (layer_no, criteria, matched, category)
+WHERE m.tab = '{objtype}'::plp_enum AND m.layers && {rebuilt}
+  AND c.matched AND c.layer_no = ANY(m.layers);
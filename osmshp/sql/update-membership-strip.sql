@@ -0,0 +1,9 @@
+/* Numbers {stale} of changed and removed layers are no longer assigned,
+   they are removed from evaluated membership */
+
+UPDATE obj_membership SET
+  layers = ARRAY(SELECT n FROM unnest(layers) n WHERE n <> ALL({stale}))
+WHERE layers && {stale};
+
+DELETE FROM obj_category
+WHERE layer_no = ANY({stale});
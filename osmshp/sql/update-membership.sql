@@ -0,0 +1,21 @@
+/* {objtype}: membership of new object versions */
+
+WITH ins AS (
+  INSERT INTO obj_membership (tab, osm_id, ver, layers)
+  SELECT DISTINCT ON (osm_id, ver) '{objtype}'::plp_enum, osm_id, ver,
+    {layers}
+  FROM osm_{objtype} src
+  WHERE {change} AND ({initial} OR NOT EXISTS(
+    SELECT * FROM obj_membership m
+    WHERE m.tab = '{objtype}'::plp_enum AND m.osm_id = src.osm_id AND m.ver = src.ver))
+  ORDER BY osm_id, ver
+  RETURNING tab, osm_id, ver, layers
+)
+INSERT INTO obj_category (tab, osm_id, ver, layer_no, criteria, category)
+SELECT ins.tab, ins.osm_id, ins.ver, c.layer_no, c.criteria, c.category
+FROM ins
+  INNER JOIN osm_{objtype} src ON src.osm_id = ins.osm_id AND src.ver = ins.ver
+  CROSS JOIN LATERAL (VALUES
+    {categories}
+  ) AS c (layer_no, criteria, matched, category)
+WHERE c.matched AND c.layer_no = ANY(ins.layers);
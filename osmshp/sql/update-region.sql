@@ -1,4 +1,50 @@
-DROP TABLE IF EXISTS tmp_region_update;
+DROP TABLE IF EXISTS tmp_region_eval, tmp_region_update, tmp_region_diff;
+
+/* Expression result depends only on relations it references if it is
+   built of nothing but relation() calls with numeric id, ST_* functions,
+   numbers and arithmetic. Anything else (subqueries, column references,
+   casts, other functions) makes it uncacheable. Region is fresh if such
+   expression is unchanged since its geometry was taken from cache and
+   none of the relations is in the change set. */
+
+CREATE TEMP TABLE tmp_region_eval AS
+SELECT region.id AS region_id,
+  regexp_replace(
+    regexp_replace(region.expression, 'relation\s*\(\s*-?\d+\s*\)', '', 'gi'),
+    'ST_\w+\s*\(', '', 'gi') ~ '^[\s\d.+*/,()-]*$' AS cacheable,
+  ARRAY(
+    SELECT -(m[1]::bigint)
+    FROM regexp_matches(region.expression, 'relation\s*\(\s*(-?\d+)\s*\)', 'gi') m
+  ) AS inputs,
+  false AS fresh
+FROM region;
+
+UPDATE tmp_region_eval t SET fresh = true
+FROM region
+  INNER JOIN region_eval c ON c.region_id = region.id
+WHERE t.region_id = region.id
+  AND t.cacheable
+  AND c.expression = region.expression
+  AND c.ts = region.geom_tstamp
+  AND NOT EXISTS(
+    SELECT * FROM buffer_insert b
+    WHERE b.tab = 'polygon'::plp_enum AND b.osm_id = ANY(t.inputs))
+  AND NOT EXISTS(
+    SELECT * FROM buffer_delete b
+    WHERE b.tab = 'polygon'::plp_enum AND b.osm_id = ANY(t.inputs));
+
+/* Geometry of fresh regions is up to date as is, triggers on region
+   don't fire as geometry columns aren't updated */
+
+UPDATE region SET
+  geom_tstamp = dump_version.ts
+FROM tmp_region_eval t, dump_version
+WHERE region.id = t.region_id AND t.fresh;
+
+UPDATE region_eval c SET
+  ts = dump_version.ts
+FROM tmp_region_eval t, dump_version
+WHERE c.region_id = t.region_id AND t.fresh;
 
 CREATE TEMP TABLE tmp_region_update AS
 SELECT region.id AS region_id,
@@ -9,6 +55,7 @@ SELECT region.id AS region_id,
   NULL::geometry AS sym_diff,
   ts AS tstamp
 FROM region
+  INNER JOIN tmp_region_eval t ON t.region_id = region.id AND NOT t.fresh
   LEFT JOIN dump_version ON 1 = 1;
 
 DELETE FROM tmp_region_update
@@ -19,31 +66,82 @@ WHERE geom_new IS NULL
 
 UPDATE tmp_region_update SET sym_diff = ST_SymDifference(geom_new, geom_curr);
 
-DELETE FROM intersection_point it
-WHERE it.buffer AND EXISTS(
-  SELECT true FROM tmp_region_update
-  WHERE NOT ST_IsEmpty(sym_diff)
-    AND tmp_region_update.region_id = it.region_id
-    AND ST_Intersects(sym_diff, it.geom)
-);
-
-DELETE FROM intersection_line it
-WHERE it.buffer AND EXISTS(
-  SELECT true FROM tmp_region_update
-  WHERE NOT ST_IsEmpty(sym_diff)
-    AND tmp_region_update.region_id = it.region_id
-    AND ST_Intersects(sym_diff, it.geom)
-);
-
-DELETE FROM intersection_polygon it
-WHERE it.buffer AND EXISTS(
-  SELECT true FROM tmp_region_update
-  WHERE NOT ST_IsEmpty(sym_diff)
-    AND tmp_region_update.region_id = it.region_id AND ST_Intersects(sym_diff, it.geom));
+/* Region evaluated for the first time needs a full pass like new one */
+
+INSERT INTO buffer_region (region_id)
+SELECT region_id FROM tmp_region_update
+WHERE geom_curr IS NULL;
+
+/* Changed area is subdivided, so only source objects near changed part of
+   boundary are probed through GiST index on osm_* tables. Their rows in
+   the region are deleted, rows of objects outside the previous boundary
+   don't have geometry, and they are queued for the intersection pass. */
+
+CREATE TEMP TABLE tmp_region_diff AS
+SELECT region_id, ST_Subdivide(sym_diff, 256) AS geom
+FROM tmp_region_update
+WHERE NOT ST_IsEmpty(sym_diff);
+
+CREATE INDEX tmp_region_diff_geom_idx ON tmp_region_diff USING gist (geom);
+
+ANALYZE tmp_region_diff;
+
+WITH cand AS (
+  SELECT DISTINCT d.region_id, src.osm_id
+  FROM tmp_region_diff d
+    INNER JOIN osm_point src ON src.way && d.geom AND ST_Intersects(d.geom, src.way)
+), del AS (
+  DELETE FROM intersection_point it
+  USING cand c
+  WHERE it.tab = 'point'::plp_enum AND it.osm_id = c.osm_id
+    AND it.region_id = c.region_id
+)
+INSERT INTO buffer_recompute (tab, osm_id)
+SELECT DISTINCT 'point'::plp_enum, osm_id FROM cand;
+
+WITH cand AS (
+  SELECT DISTINCT d.region_id, src.osm_id
+  FROM tmp_region_diff d
+    INNER JOIN osm_line src ON src.way && d.geom AND ST_Intersects(d.geom, src.way)
+), del AS (
+  DELETE FROM intersection_line it
+  USING cand c
+  WHERE it.tab = 'line'::plp_enum AND it.osm_id = c.osm_id
+    AND it.region_id = c.region_id
+)
+INSERT INTO buffer_recompute (tab, osm_id)
+SELECT DISTINCT 'line'::plp_enum, osm_id FROM cand;
+
+WITH cand AS (
+  SELECT DISTINCT d.region_id, src.osm_id
+  FROM tmp_region_diff d
+    INNER JOIN osm_polygon src ON src.way && d.geom
+    AND (NOT src.is_valid OR ST_Intersects(d.geom, src.way))
+), del AS (
+  DELETE FROM intersection_polygon it
+  USING cand c
+  WHERE it.tab = 'polygon'::plp_enum AND it.osm_id = c.osm_id
+    AND it.region_id = c.region_id
+)
+INSERT INTO buffer_recompute (tab, osm_id)
+SELECT DISTINCT 'polygon'::plp_enum, osm_id FROM cand;
 
 UPDATE region SET
   geom = src.geom_new,
   geom_tstamp = src.tstamp
 FROM
   tmp_region_update src
-WHERE region.id = src.region_id;
\ No newline at end of file
+WHERE region.id = src.region_id;
+
+/* Cache entries of evaluated regions, failed ones are evaluated again */
+
+DELETE FROM region_eval
+WHERE region_id IN (
+  SELECT region_id FROM tmp_region_eval WHERE NOT fresh);
+
+INSERT INTO region_eval (region_id, expression, inputs, ts)
+SELECT region.id, region.expression, t.inputs, src.tstamp
+FROM tmp_region_update src
+  INNER JOIN region ON region.id = src.region_id
+  INNER JOIN tmp_region_eval t ON t.region_id = src.region_id
+WHERE t.cacheable;
@@ -0,0 +1,30 @@
+/* Objects changed since statistics of regions {regions} were computed.
+   Only objects with intersections in the region are candidates, rows of
+   versions statistics were computed from are included, so both the
+   contributions objects replaced and new ones are found. Compaction
+   removes such rows, regions compacted since are computed in full. */
+
+TRUNCATE stat_changed;
+
+INSERT INTO stat_changed (region_id, tab, osm_id)
+SELECT DISTINCT it.region_id, v.tab, v.osm_id
+FROM obj_version v
+  INNER JOIN intersection_point it ON it.tab = v.tab AND it.osm_id = v.osm_id
+WHERE v.tab = 'point'::plp_enum AND v.ts > {since}
+  AND it.region_id IN ({regions});
+
+INSERT INTO stat_changed (region_id, tab, osm_id)
+SELECT DISTINCT it.region_id, v.tab, v.osm_id
+FROM obj_version v
+  INNER JOIN intersection_line it ON it.tab = v.tab AND it.osm_id = v.osm_id
+WHERE v.tab = 'line'::plp_enum AND v.ts > {since}
+  AND it.region_id IN ({regions});
+
+INSERT INTO stat_changed (region_id, tab, osm_id)
+SELECT DISTINCT it.region_id, v.tab, v.osm_id
+FROM obj_version v
+  INNER JOIN intersection_polygon it ON it.tab = v.tab AND it.osm_id = v.osm_id
+WHERE v.tab = 'polygon'::plp_enum AND v.ts > {since}
+  AND it.region_id IN ({regions});
+
+ANALYZE stat_changed;
@@ -1,5 +1,5 @@
 UPDATE osm_line SET 
   is_simple = ST_IsSimple(way), 
   is_closed = ST_IsClosed(way)
-WHERE is_simple IS NULL 
-  OR is_closed IS NULL;
\ No newline at end of file
+WHERE (is_simple IS NULL 
+  OR is_closed IS NULL) AND {change_line};
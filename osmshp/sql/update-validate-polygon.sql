@@ -1 +1 @@
-UPDATE osm_polygon SET is_valid = ST_IsValid(way) WHERE is_valid IS NULL;
\ No newline at end of file
+UPDATE osm_polygon SET is_valid = ST_IsValid(way) WHERE is_valid IS NULL AND {change_polygon};
@@ -1,15 +1,26 @@
-UPDATE obj_version v SET latest = latest + 1
-WHERE EXISTS(
-  SELECT osm_id FROM osm_line c 
-  WHERE v.tab = 'line'::plp_enum
-    AND c.osm_id = v.osm_id 
-    AND c.flag = false
+UPDATE obj_version v SET
+  latest = latest + 1,
+  ts = (SELECT ts FROM dump_version LIMIT 1)
+WHERE v.tab = 'line'::plp_enum AND v.osm_id IN (
+    SELECT osm_id FROM buffer_insert WHERE tab = 'line'::plp_enum
+  UNION
+    SELECT osm_id FROM buffer_delete WHERE tab = 'line'::plp_enum
+);
+
+INSERT INTO obj_version (tab, osm_id, latest, ts)
+SELECT DISTINCT 'line'::plp_enum, b.osm_id, 1, (SELECT ts FROM dump_version LIMIT 1)
+FROM buffer_insert b
+WHERE b.tab = 'line'::plp_enum AND NOT EXISTS(
+  SELECT * FROM obj_version v
+  WHERE v.tab = b.tab AND v.osm_id = b.osm_id
 );
 
 UPDATE osm_line src SET
   ver = obj_version.latest
 FROM obj_version
-WHERE NOT src.flag AND obj_version.tab = 'line'::plp_enum
-  AND obj_version.osm_id = src.osm_id 
-  AND obj_version.latest <> src.ver;
-
+WHERE obj_version.tab = 'line'::plp_enum
+  AND obj_version.osm_id = src.osm_id
+  AND obj_version.latest <> src.ver
+  AND src.osm_id IN (
+    SELECT osm_id FROM buffer_insert WHERE tab = 'line'::plp_enum
+  );
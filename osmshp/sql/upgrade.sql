@@ -0,0 +1,133 @@
+/* Upgrade of database created by an earlier version. Tables, functions
+   and triggers of initialize are created before by running it again, here
+   existing data is brought up to date. Every step can be run again. */
+
+/* Regions created before region_part was maintained by trigger */
+
+SELECT
+  region_part_build(r.id, 'geom', r.geom),
+  region_part_build(r.id, 'geom_in', r.geom_in),
+  region_part_build(r.id, 'geom_out', r.geom_out)
+FROM region r
+WHERE NOT EXISTS(
+  SELECT * FROM region_part p WHERE p.region_id = r.id);
+
+
+/* Change capture: objects left unprocessed by the flag sweep (flag is
+   false) are moved to the change set, osm_* tables get capture triggers
+   load-point, load-line and load-polygon create after a load */
+
+DO $$
+DECLARE
+  t text;
+BEGIN
+  FOREACH t IN ARRAY ARRAY['point', 'line', 'polygon'] LOOP
+    CONTINUE WHEN to_regclass('osm_' || t) IS NULL;
+
+    IF EXISTS(
+      SELECT * FROM information_schema.columns
+      WHERE table_name = 'osm_' || t AND column_name = 'flag'
+    ) THEN
+      EXECUTE format(
+        'INSERT INTO buffer_insert (tab, osm_id) SELECT DISTINCT %L::plp_enum, osm_id FROM osm_%s WHERE NOT flag',
+        t, t);
+      EXECUTE format('ALTER TABLE osm_%s DROP COLUMN flag', t);
+    END IF;
+
+    EXECUTE format('DROP TRIGGER IF EXISTS osm_%s_buffer ON osm_%s', t, t);
+    EXECUTE format(
+      'CREATE TRIGGER osm_%s_buffer AFTER INSERT OR DELETE ON osm_%s FOR EACH ROW EXECUTE PROCEDURE buffer_capture(%L)',
+      t, t, t);
+  END LOOP;
+END
+$$;
+
+
+/* Object versions are stamped with dump timestamp for incremental layers
+   and statistics, objects unchanged since the upgrade keep it empty */
+
+DO $$
+BEGIN
+  IF to_regclass('obj_version') IS NOT NULL THEN
+    ALTER TABLE obj_version ADD COLUMN IF NOT EXISTS ts timestamp;
+    CREATE INDEX IF NOT EXISTS obj_version_ts_idx ON obj_version (tab, ts);
+  END IF;
+END
+$$;
+
+
+/* Layer definition and region hashes, field widths and content hash for
+   export are recorded by layer build, layers without them are built from
+   scratch on the next update */
+
+ALTER TABLE layer_version
+  ADD COLUMN IF NOT EXISTS definition varchar(32),
+  ADD COLUMN IF NOT EXISTS region_hash varchar(32);
+
+ALTER TABLE layer_version
+  ADD COLUMN IF NOT EXISTS widths text;
+
+ALTER TABLE layer_version
+  ADD COLUMN IF NOT EXISTS content_hash varchar(32);
+
+
+/* Intersection tables are partitioned by region: rows of existing regions
+   are moved to partitions, region trigger maintains partitions */
+
+DO $$
+DECLARE
+  t text;
+  converted text[] := ARRAY[]::text[];
+BEGIN
+  FOREACH t IN ARRAY ARRAY['point', 'line', 'polygon'] LOOP
+    CONTINUE WHEN NOT EXISTS(
+      SELECT * FROM pg_class
+      WHERE oid = to_regclass('intersection_' || t) AND relkind = 'r');
+
+    EXECUTE format('ALTER TABLE intersection_%s RENAME TO intersection_%s_old', t, t);
+    EXECUTE format('ALTER TABLE intersection_%s_old DROP CONSTRAINT IF EXISTS intersection_%s_pk', t, t);
+    EXECUTE format(
+      'CREATE TABLE intersection_%s (LIKE intersection_%s_old) PARTITION BY LIST (region_id)',
+      t, t);
+    converted := converted || t;
+  END LOOP;
+
+  IF array_length(converted, 1) IS NULL THEN
+    RETURN;
+  END IF;
+
+  PERFORM intersection_partitions(id) FROM region;
+
+  FOREACH t IN ARRAY converted LOOP
+    EXECUTE format(
+      'INSERT INTO intersection_%s SELECT * FROM intersection_%s_old WHERE region_id IN (SELECT id FROM region)',
+      t, t);
+    EXECUTE format('DROP TABLE intersection_%s_old', t);
+    EXECUTE format(
+      'ALTER TABLE intersection_%s ADD CONSTRAINT intersection_%s_pk PRIMARY KEY (tab, osm_id, ver, region_id)',
+      t, t);
+    EXECUTE format('ANALYZE intersection_%s', t);
+  END LOOP;
+
+  DROP TRIGGER IF EXISTS region_clean_itersections ON region;
+
+  CREATE TRIGGER region_clean_itersections
+    AFTER INSERT OR UPDATE OF geom_in, geom_out OR DELETE ON region FOR EACH ROW
+    EXECUTE PROCEDURE region_clean_itersections();
+END
+$$;
+
+
+/* Compaction examines objects changed since the previous one, the first
+   compaction after upgrade examines every object */
+
+ALTER TABLE dump_version
+  ADD COLUMN IF NOT EXISTS compacted timestamp;
+
+
+/* Objects near changed region boundary are probed through osm_* tables,
+   partial index on buffer rows isn't used */
+
+DROP INDEX IF EXISTS intersection_point_buffer_idx;
+DROP INDEX IF EXISTS intersection_line_buffer_idx;
+DROP INDEX IF EXISTS intersection_polygon_buffer_idx;
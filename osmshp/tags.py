@@ -0,0 +1,254 @@
+import re
+
+# Tag keys used by layer definitions. Keys are counted across filters,
+# fields and classification of every layer, hot ones can be promoted to
+# real columns with generated osm2pgsql style. Filters are checked for
+# predicates an index on (tags->'key') or promoted column can serve:
+# <key> = '...', <key> IN (...) and <key> IS NOT NULL. For such keys of
+# selective filters partial expression indexes are suggested.
+
+KEY = re.compile(r'\<([\w\:\_]+)\>')
+
+_INDEXABLE = re.compile(
+    r"^<([\w\:\_]+)>\s*(=\s*'[^']*'|IN\s*\(|IS\s+NOT\s+NULL\b)", re.IGNORECASE)
+
+_STYLE_TYPES = ('node,way', )
+
+
+def layer_expressions(layer):
+    """ (kind, expression) pairs of layer filter, fields and
+    classification """
+
+    yield ('filter', layer.filter)
+
+    for field in layer.fields:
+        yield ('field', field.definition)
+
+    for cname in sorted(layer.classification):
+        criteria = layer.classification[cname]
+        yield ('classification', criteria.filter)
+        for cls in criteria.classes:
+            yield ('classification', cls.filter)
+
+
+def key_usage(layers):
+    """ Number of references to each key, total and by object type and
+    expression kind """
+
+    usage = dict()
+    for layer in layers:
+        for kind, expression in layer_expressions(layer):
+            for key in KEY.findall(expression):
+                u = usage.setdefault(key, dict(count=0, types=dict(), kinds=dict()))
+                u['count'] += 1
+                u['types'][layer.type] = u['types'].get(layer.type, 0) + 1
+                u['kinds'][kind] = u['kinds'].get(kind, 0) + 1
+
+    return usage
+
+
+def _split(expression, operator):
+    """ Split by AND or OR outside of parentheses and quotes """
+
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    token = re.compile(r'\s%s\s' % operator, re.IGNORECASE)
+
+    i = 0
+    while i < len(expression):
+        c = expression[i]
+        if c == "'":
+            quoted = not quoted
+        elif not quoted and c == '(':
+            depth += 1
+        elif not quoted and c == ')':
+            depth -= 1
+        elif not quoted and depth == 0:
+            m = token.match(expression, i)
+            if m:
+                parts.append(expression[start:i])
+                start = i = m.end()
+                continue
+        i += 1
+
+    parts.append(expression[start:])
+    return [p.strip() for p in parts]
+
+
+def _strip(expression):
+    """ Remove parentheses enclosing the whole expression """
+
+    expression = expression.strip()
+    while expression.startswith('(') and expression.endswith(')'):
+        depth = 0
+        for i, c in enumerate(expression):
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            if depth == 0 and i < len(expression) - 1:
+                return expression
+        expression = expression[1:-1].strip()
+    return expression
+
+
+def index_keys(expression):
+    """ Keys which indexes can serve the expression with, None if it can't
+    use an index. Every OR branch needs an indexable conjunct. """
+
+    keys = set()
+    for branch in _split(_strip(expression), 'OR'):
+        found = None
+        for conjunct in _split(_strip(branch), 'AND'):
+            conjunct = _strip(conjunct)
+            if len(_split(conjunct, 'OR')) > 1:
+                found = index_keys(conjunct)
+            else:
+                m = _INDEXABLE.match(conjunct)
+                if m:
+                    found = set([m.group(1), ])
+            if found:
+                break
+
+        if not found:
+            return None
+        keys |= found
+
+    return keys
+
+
+def index_name(objtype, key):
+    return 'osm_%s_tag_%s_idx' % (objtype, re.sub(r'\W', '_', key))
+
+
+def index_sql(objtype, key, expand):
+    """ Partial index on tag expression, predicates like = and IN imply
+    the IS NOT NULL condition, so the planner can use it for them too.
+    Index is built concurrently to keep osm_* tables writable, which
+    requires autocommit connection. """
+
+    expression = expand('<%s>' % key)
+    return 'CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON osm_%s ((%s)) WHERE %s IS NOT NULL;' % (
+        index_name(objtype, key), objtype, expression, expression)
+
+
+def read_style(filename):
+    """ Keys already listed in osm2pgsql style file """
+
+    keys = set()
+    with open(filename, 'r') as fd:
+        for line in fd:
+            line = line.split('#', 1)[0].split()
+            if len(line) >= 2:
+                keys.add(line[1])
+    return keys
+
+
+def style_lines(usage, min_count, existing=()):
+    """ osm2pgsql style lines promoting keys with at least min_count
+    references to text columns """
+
+    lines = []
+    for key, u in sorted(usage.iteritems(), key=lambda i: (-i[1]['count'], i[0])):
+        if u['count'] >= min_count and key not in existing:
+            lines.append('%-10s %-24s %-10s %s' % (
+                ','.join(_STYLE_TYPES), key, 'text', 'linear'))
+    return lines
+
+
+class TagAdvisor(object):
+
+    def __init__(self, env):
+        self.env = env
+
+    def key_fraction(self, objtype, key, sample=1.0):
+        """ Share of rows having the key, from sample of table """
+
+        expression = self.env.expand_tag_columns('<%s>' % key, objtype)
+        cur = self.env.connection.cursor()
+        cur.execute(
+            'SELECT AVG((%s IS NOT NULL)::int) FROM osm_%s TABLESAMPLE SYSTEM (%f)' % (
+                expression, objtype, sample))
+        (result, ) = cur.fetchone()
+
+        if result is None:
+            # Sample is empty on small tables
+            cur.execute('SELECT AVG((%s IS NOT NULL)::int) FROM osm_%s' % (expression, objtype))
+            (result, ) = cur.fetchone()
+
+        return float(result or 0)
+
+    def filters(self):
+        """ (layer, filter keys usable with index or None) """
+
+        for lid in sorted(self.env.layers):
+            layer = self.env.layers[lid]
+            yield layer, index_keys(layer.filter)
+
+    def indexes(self, max_fraction=0.2):
+        """ Index statements for keys of indexable filters present in no
+        more than max_fraction of rows, with (objtype, key, fraction) """
+
+        candidates = set()
+        for layer, keys in self.filters():
+            for key in keys or ():
+                candidates.add((layer.type, key))
+
+        result = []
+        for objtype, key in sorted(candidates):
+            fraction = self.key_fraction(objtype, key)
+            if fraction <= max_fraction:
+                result.append(((objtype, key, fraction), index_sql(
+                    objtype, key, self.env.tag_expander(objtype))))
+        return result
+
+    def style(self, min_count=2):
+        """ Style file content: configured style and lines for hot keys
+        it doesn't have yet """
+
+        filename = self.env.config['osm2pgsql']['style']
+        with open(filename, 'r') as fd:
+            base = fd.read()
+
+        lines = style_lines(
+            key_usage(self.env.layers.itervalues()), min_count,
+            existing=read_style(filename))
+
+        if not lines:
+            return base
+
+        return base.rstrip('\n') + '\n\n# Keys used by layer definitions\n' \
+            + '\n'.join(lines) + '\n'
+
+    def report(self, min_count=2, max_fraction=0.2):
+        usage = key_usage(self.env.layers.itervalues())
+        columns = self.env.get_tag_columns()
+        lines = []
+
+        lines.append('Keys used by layers:')
+        lines.append('  %-24s %6s %8s %8s %8s  %s' % ('', 'count', 'filter', 'field', 'class', 'columns'))
+        for key, u in sorted(usage.iteritems(), key=lambda i: (-i[1]['count'], i[0])):
+            lines.append('  %-24s %6d %8d %8d %8d  %s' % (
+                key, u['count'], u['kinds'].get('filter', 0), u['kinds'].get('field', 0),
+                u['kinds'].get('classification', 0),
+                ', '.join([t for t in sorted(u['types']) if key in columns[t]]) or '-'))
+        lines.append('')
+
+        lines.append('Filters:')
+        for layer, keys in self.filters():
+            lines.append('  %-24s %-8s %s' % (
+                layer.id, layer.type,
+                'index on ' + ', '.join(sorted(keys)) if keys else 'not indexable'))
+        lines.append('')
+
+        promoted = style_lines(usage, min_count, existing=read_style(
+            self.env.config['osm2pgsql']['style']))
+        lines.append('Keys to promote to columns (%d and more references):' % min_count)
+        lines.extend(['  ' + l for l in promoted] or ['  -'])
+        lines.append('')
+
+        lines.append('Indexes (keys in %d%% of rows and less):' % round(max_fraction * 100))
+        for (objtype, key, fraction), sql in self.indexes(max_fraction):
+            lines.append('  %s  /* %.2f%% */' % (sql, fraction * 100))
+        lines.append('')
+
+        return '\n'.join(lines)
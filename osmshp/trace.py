@@ -0,0 +1,148 @@
+import re
+import json
+import random
+import threading
+from datetime import datetime
+
+from sqlalchemy.sql.expression import text
+
+# Execution trace of SQL statements written as JSON lines. Each record has
+# statement context (phase, template, region, layer, chunk), dump version,
+# start and end, affected rows and worker thread. A sampled share of
+# statements is executed under EXPLAIN (ANALYZE, BUFFERS) and the plans
+# are stored in the record too.
+
+_COMMENT = re.compile(r'/\*.*?\*/|--[^\n]*', re.DOTALL)
+_STATEMENT_END = re.compile(r';[ \t]*(?:\n|$)')
+_EXPLAINABLE = re.compile(
+    r'^(SELECT|INSERT|UPDATE|DELETE|WITH|CREATE\s+(TEMP\s+|TEMPORARY\s+)?TABLE\s+.*?\sAS\s)',
+    re.IGNORECASE | re.DOTALL)
+
+
+def split_statements(sql):
+    """ Split SQL script by semicolons at the end of line, scripts with
+    dollar-quoted function bodies aren't supported """
+
+    result = []
+    for statement in _STATEMENT_END.split(sql):
+        if _COMMENT.sub('', statement).strip() != '':
+            result.append(statement)
+    return result
+
+
+def _plan_rows(plan):
+    node = plan['Plan']
+    if node['Node Type'] == 'ModifyTable' and 'Plans' in node:
+        node = node['Plans'][0]
+    return node.get('Actual Rows', 0)
+
+
+def explain_analyze(connection, sql):
+    """ Execute script collecting EXPLAIN (ANALYZE, BUFFERS) plans of its
+    statements. Returns rows affected by the last statement and plans. """
+
+    rowcount = -1
+    plans = []
+
+    for statement in split_statements(sql):
+        if _EXPLAINABLE.match(_COMMENT.sub('', statement).strip()):
+            result = connection.execute(text(
+                'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement))
+            (plan, ) = result.fetchone()
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            plans.append(dict(statement=statement.strip(), plan=plan[0]))
+            rowcount = _plan_rows(plan[0])
+        else:
+            rowcount = connection.execute(text(statement)).rowcount
+
+    return rowcount, plans
+
+
+class Trace(object):
+
+    def __init__(self, path, explain=0.0):
+        self.path = path
+        self.explain = explain
+        self.version = None
+        self._lock = threading.Lock()
+
+    def sample(self, sql):
+        return self.explain > 0 and '$$' not in sql \
+            and random.random() < self.explain
+
+    def write(self, record):
+        record = dict(record, version=self.version)
+        line = json.dumps(record, default=str, sort_keys=True)
+
+        with self._lock:
+            with open(self.path, 'a') as fd:
+                fd.write(line + '\n')
+
+
+def load(paths):
+    for path in paths:
+        with open(path, 'r') as fd:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _ts(value):
+    return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def _totals(records, key):
+    groups = dict()
+    for r in records:
+        k = key(r)
+        count, total, longest = groups.get(k, (0, 0.0, 0.0))
+        groups[k] = (count + 1, total + r['duration'], max(longest, r['duration']))
+    return groups
+
+
+def report(records, top=10, threshold=1.5):
+    """ Text report: slowest templates and regions, and template/region
+    pairs which became slower in the latest dump version """
+
+    records = [r for r in records if r.get('template')]
+    lines = []
+
+    def table(title, groups):
+        lines.append(title)
+        lines.append('  %-40s %8s %12s %12s %12s' % ('', 'count', 'total, s', 'avg, s', 'max, s'))
+        for k, (count, total, longest) in sorted(
+                groups.iteritems(), key=lambda i: -i[1][1])[:top]:
+            lines.append('  %-40s %8d %12.1f %12.2f %12.2f' % (
+                k, count, total, total / count, longest))
+        lines.append('')
+
+    table('Slowest templates:', _totals(records, lambda r: r['template']))
+    table('Slowest regions:', _totals(
+        [r for r in records if r.get('region')], lambda r: r['region']))
+
+    versions = sorted(set(r['version'] for r in records if r.get('version')), key=_ts)
+    if len(versions) >= 2:
+        previous, latest = versions[-2], versions[-1]
+
+        def key(r):
+            return '%s %s' % (r['template'], r.get('region') or '*')
+
+        before = _totals([r for r in records if r.get('version') == previous], key)
+        after = _totals([r for r in records if r.get('version') == latest], key)
+
+        regressions = []
+        for k, (count, total, longest) in after.iteritems():
+            if k in before:
+                avg_before = before[k][1] / before[k][0]
+                avg_after = total / count
+                if avg_before > 0 and avg_after / avg_before >= threshold:
+                    regressions.append((avg_after / avg_before, k, avg_before, avg_after))
+
+        lines.append('Regressions %s -> %s (x%.1f and more):' % (previous, latest, threshold))
+        lines.append('  %-40s %12s %12s %8s' % ('', 'before, s', 'after, s', 'ratio'))
+        for ratio, k, avg_before, avg_after in sorted(regressions, reverse=True)[:top]:
+            lines.append('  %-40s %12.2f %12.2f %8.1f' % (k, avg_before, avg_after, ratio))
+        lines.append('')
+
+    return '\n'.join(lines)
@@ -22,4 +22,16 @@ class YAMLLoader(yaml.Loader):
 
 
 YAMLLoader.add_constructor('!include', YAMLLoader.include)
-YAMLLoader.add_constructor('!path', YAMLLoader.path)
\ No newline at end of file
+YAMLLoader.add_constructor('!path', YAMLLoader.path)
+
+
+def connection_params(database):
+    """ psycopg2.connect() keyword arguments from database config section """
+
+    params = dict()
+    for k, v in database.iteritems():
+        if k == 'name':
+            k = 'database'
+        params[k] = v
+
+    return params